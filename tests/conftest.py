@@ -0,0 +1,21 @@
+import json
+
+import pytest
+
+
+class Broker:
+    """
+    Records what would be published, with JSON payloads decoded.
+    """
+
+    def __init__(self):
+        self.published = []
+
+    async def publish(self, topic, payload, kind="event"):
+        # an empty payload clears a retained topic
+        self.published.append((topic, json.loads(payload) if payload else None, kind))
+
+
+@pytest.fixture
+def broker():
+    return Broker()
@@ -0,0 +1,39 @@
+import asyncio
+import json
+
+from unifi_mqtt.aggregates import Aggregator
+from unifi_mqtt.translator import Translator
+from unifi_mqtt.unifi.controller import UnifiController
+
+
+def test_redelivered_events_are_counted_once(broker):
+    event = {
+        "_id": "event-1",
+        "key": "EVT_WU_Connected",
+        "user": "aa:aa:aa:aa:aa:01",
+        "hostname": "phone",
+        "ssid": "Home",
+        "network": "LAN",
+        "subsystem": "wlan",
+        "time": 1600000000000,
+    }
+
+    async def run():
+        controller = UnifiController(services=["network"])
+        translator = Translator(broker)
+        aggregator = Aggregator(broker, interval=60)
+        translator.connect(controller)
+        aggregator.observe(translator)
+        aggregator.connect(controller)
+        await translator.start()
+        # the same event, redelivered after a reconnect
+        await controller.emit("network", "EVT_WU_Connected", dict(event))
+        await controller.emit("network", "EVT_WU_Connected", dict(event))
+        await translator.join()
+        await translator.close()
+        await controller.close()
+        return aggregator.summaries()
+
+    summaries = dict(asyncio.run(run()))
+    events = json.loads(summaries["network/summary/events"])
+    assert events["last"] == {"Home": {"connected": 1}}
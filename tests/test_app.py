@@ -0,0 +1,49 @@
+import asyncio
+import json
+
+from unifi_mqtt.app import App, Options
+from unifi_mqtt.config import SiteConfig
+
+
+def connected(mac: str, ssid: str) -> dict:
+    return {
+        "_id": f"event-{mac}",
+        "key": "EVT_WU_Connected",
+        "user": mac,
+        "hostname": f"host-{mac[-2:]}",
+        "ssid": ssid,
+        "network": "LAN",
+        "subsystem": "wlan",
+        "time": 1600000000000,
+    }
+
+
+def test_rules_file_drops_events(tmp_path, broker):
+    rules = tmp_path / "rules.json"
+    rules.write_text(
+        json.dumps({"rules": [{"match": {"ssid": "Guest"}, "drop": True}]})
+    )
+    app = App(
+        Options(state_file=None, spool_dir=None, rules=str(rules)),
+        [SiteConfig(services=["network"])],
+    )
+
+    async def run():
+        app.build()
+        app.translator.mqtt = broker
+        await app.translator.start()
+        [controller] = app.controllers
+        await controller.emit(
+            "network", "EVT_WU_Connected", connected("aa:aa:aa:aa:aa:01", "Guest")
+        )
+        await controller.emit(
+            "network", "EVT_WU_Connected", connected("aa:aa:aa:aa:aa:02", "Home")
+        )
+        await app.translator.join()
+        await app.translator.close()
+        await controller.close()
+        return broker.published
+
+    published = asyncio.run(run())
+    assert app.translator.rules is not None
+    assert [topic for topic, _, _ in published] == ["network/wifi/home/client/host-02"]
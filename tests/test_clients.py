@@ -0,0 +1,18 @@
+from unifi_mqtt.unifi.clients import ClientTable
+
+
+def test_expire_evicts_idle_disconnected_clients():
+    clients = ClientTable(ttl=60)
+    clients.update("aa:aa:aa:aa:aa:01", {"connected": True})
+    clients.update("aa:aa:aa:aa:aa:02", {"connected": False})
+    now = clients.get("aa:aa:aa:aa:aa:02").last_seen
+
+    assert clients.expire(now + 30) == []
+    assert clients.expire(now + 61) == ["aa:aa:aa:aa:aa:02"]
+    assert clients.get("aa:aa:aa:aa:aa:02") is None
+    # connected clients are kept however long it's been
+    assert clients.get("aa:aa:aa:aa:aa:01") is not None
+
+    # the freed slot is reused
+    clients.update("aa:aa:aa:aa:aa:03", {"connected": True})
+    assert len(clients.records) == 2
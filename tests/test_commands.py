@@ -0,0 +1,129 @@
+import asyncio
+import json
+
+import pytest
+
+from unifi_mqtt.commands import CommandError, CommandHandler, parse_command
+
+
+class Response:
+    def __init__(self):
+        self.read_body = False
+
+    async def read(self):
+        self.read_body = True
+        return b'{"data": []}'
+
+
+class Controller:
+    topic_prefix = ""
+
+    def __init__(self, delays=None):
+        self.requests = []
+        self.responses = []
+        # stamgr cmd -> seconds the controller takes to answer it
+        self.delays = delays or {}
+
+    async def request(self, method, path, json=None):
+        if json is not None:
+            await asyncio.sleep(self.delays.get(json["cmd"], 0))
+        self.requests.append((method, path, json))
+        self.responses.append(Response())
+        return self.responses[-1]
+
+
+@pytest.mark.parametrize(
+    "door", ["../../api/users", "door?x=1", "door#x", "door/relay", ""]
+)
+def test_parse_command_rejects_unsafe_door_ids(door):
+    payload = json.dumps({"id": "1", "door": door}).encode()
+    with pytest.raises(CommandError):
+        parse_command("access", "unlock", payload)
+
+
+def test_parse_command_accepts_door_ids():
+    payload = json.dumps({"door": "4c2a1b3f-0000-4e1a-9f3c-aa00bb11cc22"}).encode()
+    _, target, _ = parse_command("access", "unlock", payload)
+    assert target == "4c2a1b3f-0000-4e1a-9f3c-aa00bb11cc22"
+
+
+def test_traversal_door_id_is_answered_with_an_error(broker):
+    async def run():
+        controller = Controller()
+        handler = CommandHandler(broker, [controller])
+        handler.semaphore = asyncio.Semaphore(1)
+        handler.on_message(
+            controller,
+            "access",
+            "access/command/unlock",
+            json.dumps({"id": "7", "door": "../../api/v1/users"}).encode(),
+        )
+        await asyncio.gather(*handler.tasks)
+        return controller
+
+    controller = asyncio.run(run())
+    assert controller.requests == []
+    [(topic, message, kind)] = broker.published
+    assert topic == "access/response/unlock"
+    assert message["id"] == "7"
+    assert not message["ok"]
+    assert message["error"].startswith("invalid door")
+
+
+def command(handler, controller, action_name, request_id, mac):
+    handler.on_message(
+        controller,
+        "network",
+        f"network/command/{action_name}",
+        json.dumps({"id": request_id, "mac": mac}).encode(),
+    )
+
+
+def test_client_commands_are_sent_in_arrival_order(broker):
+    a, b = "00:11:22:33:44:55", "66:77:88:99:aa:bb"
+
+    async def run():
+        # the first block answers slowly, the later flush must still wait
+        controller = Controller(delays={"block-sta": 0.05})
+        handler = CommandHandler(broker, [controller], batch_window=0.01)
+        handler.semaphore = asyncio.Semaphore(4)
+        command(handler, controller, "block", "1", a)
+        command(handler, controller, "block", "2", b)
+        command(handler, controller, "unblock", "3", a)
+        command(handler, controller, "block", "4", a)
+        await asyncio.sleep(0.02)
+        command(handler, controller, "unblock", "5", b)
+        while handler.tasks or handler.batches:
+            await asyncio.sleep(0.01)
+        return controller
+
+    controller = asyncio.run(run())
+    assert [json for _, _, json in controller.requests] == [
+        {"cmd": "block-sta", "macs": [a, b]},
+        {"cmd": "unblock-sta", "mac": a},
+        {"cmd": "block-sta", "mac": a},
+        {"cmd": "unblock-sta", "mac": b},
+    ]
+    assert all(response.read_body for response in controller.responses)
+
+
+def test_close_sends_batched_commands(broker):
+    async def run():
+        controller = Controller()
+        handler = CommandHandler(broker, [controller], batch_window=60)
+        handler.semaphore = asyncio.Semaphore(1)
+        command(handler, controller, "block", "1", "00:11:22:33:44:55")
+        await handler.close()
+        return controller
+
+    controller = asyncio.run(run())
+    assert [json for _, _, json in controller.requests] == [
+        {"cmd": "block-sta", "mac": "00:11:22:33:44:55"}
+    ]
+    assert broker.published == [
+        (
+            "network/response/block",
+            {"id": "1", "action": "block", "ok": True},
+            "response",
+        )
+    ]
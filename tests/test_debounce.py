@@ -0,0 +1,121 @@
+import asyncio
+import json
+
+import aiohttp
+
+from unifi_mqtt.translator import Translator
+from unifi_mqtt.unifi.controller import UnifiController
+
+MAC = "aa:aa:aa:aa:aa:01"
+AP = "f0:9f:c2:00:00:01"
+WINDOW = 0.3
+TIME = 1600000000000
+EVENT_IDS = {
+    "EVT_WU_Connected": "5f5e1f00c9a4d2001a8b3e71",
+    "EVT_WU_Disconnected": "5f5e1f05c9a4d2001a8b3e72",
+}
+
+
+def events_frame(key: str) -> str:
+    action = "connected to" if key == "EVT_WU_Connected" else "disconnected from"
+    return json.dumps(
+        {
+            "meta": {"rc": "ok", "message": "events"},
+            "data": [
+                {
+                    "_id": EVENT_IDS[key],
+                    "key": key,
+                    "user": MAC,
+                    "hostname": "phone",
+                    "ssid": "Home",
+                    "ap": AP,
+                    "radio": "na",
+                    "channel": "36",
+                    "subsystem": "wlan",
+                    "site_id": "5f5e1e8ac9a4d2001a8b3e01",
+                    "time": TIME,
+                    "datetime": "2020-09-13T12:26:40Z",
+                    "msg": f'User[{MAC}] has {action} AP[{AP}] with SSID "Home"',
+                }
+            ],
+        }
+    )
+
+
+def sync_frame() -> str:
+    return json.dumps(
+        {
+            "meta": {"rc": "ok", "message": "sta:sync"},
+            "data": [{"mac": MAC, "hostname": "phone", "essid": "Home"}],
+        }
+    )
+
+
+def test_flap_does_not_reach_the_retained_client_topic(broker):
+    async def run():
+        controller = UnifiController(services=["network"])
+        translator = Translator(broker, debounce_window=WINDOW, dedup_window=0)
+        translator.connect(controller)
+        await translator.start()
+        service = controller.services[0]
+
+        await service.handle_frame(aiohttp.WSMsgType.TEXT, sync_frame())
+        await asyncio.sleep(WINDOW * 3)
+        await translator.join()
+        settled = len(broker.published)
+
+        for key in ("EVT_WU_Disconnected", "EVT_WU_Connected"):
+            await service.handle_frame(aiohttp.WSMsgType.TEXT, events_frame(key))
+        await asyncio.sleep(WINDOW * 3)
+        await translator.join()
+
+        await translator.close()
+        await controller.close()
+        return broker.published[:settled], broker.published[settled:]
+
+    settled, flap = asyncio.run(run())
+    [(topic, message, kind)] = settled
+    assert topic == f"network/client/{MAC}"
+    assert message["connected"] is True
+    assert flap == []
+
+
+def test_connect_then_disconnect_publishes_only_the_outcome(broker):
+    async def run():
+        controller = UnifiController(services=["network"])
+        translator = Translator(broker, debounce_window=WINDOW, dedup_window=0)
+        translator.connect(controller)
+        await translator.start()
+        service = controller.services[0]
+
+        await service.handle_frame(aiohttp.WSMsgType.TEXT, sync_frame())
+        await service.handle_frame(
+            aiohttp.WSMsgType.TEXT, events_frame("EVT_WU_Disconnected")
+        )
+        await asyncio.sleep(WINDOW * 3)
+        await translator.join()
+
+        await translator.close()
+        await controller.close()
+        return broker.published
+
+    published = asyncio.run(run())
+    states = [m for topic, m, kind in published if topic == f"network/client/{MAC}"]
+    # the connect and disconnect merged within the window; only the outcome
+    assert [m["connected"] for m in states] == [False]
+
+    [(message, kind)] = [
+        (m, kind)
+        for topic, m, kind in published
+        if topic == "network/wifi/home/client/phone"
+    ]
+    assert kind == "event"
+    assert message["raw"]["key"] == "EVT_WU_Disconnected"
+    del message["raw"]
+    assert message == {
+        "service": "network",
+        "event": "EVT_WU_Disconnected",
+        "ts": TIME,
+        "connected": False,
+        "mac": MAC,
+    }
@@ -0,0 +1,40 @@
+from unifi_mqtt.discovery import Discovery
+from unifi_mqtt.state import StateStore
+from unifi_mqtt.translator import SERIALIZERS
+
+
+def announce(discovery, event_name, mac):
+    client = {"mac": mac, "hostname": f"host-{mac[-2:]}", "connected": False}
+    payload = {"client": client, "changes": ["connected"]}
+    event = SERIALIZERS[("network", event_name)](event_name, payload)
+    topic = f"network/{event.topic}"
+    return discovery.announce("network", event_name, payload, topic, event)
+
+
+def test_forgotten_client_entity_is_removed():
+    state = StateStore()
+    discovery = Discovery("unifi", state)
+
+    config_topic, message, kind = announce(discovery, "client:update", "aa:01")
+    assert config_topic == (
+        "homeassistant/device_tracker/unifi/network_client_aa_01/config"
+    )
+    assert message
+    assert announce(discovery, "client:update", "aa:01") is None
+
+    assert announce(discovery, "client:remove", "aa:01") == (
+        config_topic,
+        b"",
+        "discovery",
+    )
+    assert discovery.announced == {}
+    assert state.get("discovery/homeassistant/unifi") == {}
+    # nothing to clear for a client that was never announced
+    assert announce(discovery, "client:remove", "aa:02") is None
+
+
+def test_announced_entities_are_capped():
+    discovery = Discovery("unifi", StateStore(), max_entities=2)
+    for mac in ("aa:01", "aa:02", "aa:03"):
+        announce(discovery, "client:update", mac)
+    assert list(discovery.announced) == ["network/client/aa:02", "network/client/aa:03"]
@@ -0,0 +1,77 @@
+import json
+
+from unifi_mqtt.translator import RawMode, Translator
+
+
+def test_raw_fields_omits_raw_for_client_updates():
+    translator = Translator(None, raw_modes={"network": RawMode.FIELDS})
+    client = {"mac": "aa:aa:aa:aa:aa:01", "connected": True}
+    [(topic, message, kind)] = translator.translate(
+        "network", "client:update", {"client": client, "changes": {"connected": True}}
+    )
+    assert topic == "network/client/aa:aa:aa:aa:aa:01"
+    assert "raw" not in json.loads(message)
+
+
+def access_payload(event_name, data):
+    return {
+        "event": event_name,
+        "receiver_id": "",
+        "event_object_id": "b4a3e8f2-7d6c-4e1a-9c3b-2f5d8e7a6b1c",
+        "save_to_history": False,
+        "device_id": "e0a1b2c3d4f5",
+        "data": data,
+    }
+
+
+ACTOR = {
+    "id": "0a1b2c3d-4e5f-6a7b-8c9d-0e1f2a3b4c5d",
+    "type": "user",
+    "display_name": "Jane Doe",
+    "alternate_id": "",
+    "alternate_name": "",
+}
+
+UNLOCK_LOG = access_payload(
+    "access.logs.add",
+    {
+        "_id": "aBcDeFgHiJkLmNoPqRsT",
+        "@timestamp": "2023-10-04T09:12:31Z",
+        "_source": {
+            "actor": ACTOR,
+            "event": {
+                "type": "access.door.unlock",
+                "display_message": "Access Granted (NFC)",
+                "result": "ACCESS",
+                "published": 1696410751000,
+                "reason": "",
+            },
+            "authentication": {"credential_provider": "NFC", "issuer": ""},
+            "target": [
+                {"type": "UAH", "id": "e0a1b2c3d4f5", "display_name": "UA-HUB-3855"},
+                {"type": "door", "id": "7f6e5d4c", "display_name": "Front Door"},
+            ],
+        },
+    },
+)
+
+UNLOCK_CAPTURE = access_payload(
+    "access.capture.add",
+    {
+        "_id": "uVwXyZaBcDeFgHiJkLmN",
+        "_source": {
+            "actor": ACTOR,
+            "published": 1696410751420,
+            "thumbnail": "/proxy/access/api/v2/device/e0a1b2c3d4f5/capture/uVwXyZ",
+        },
+    },
+)
+
+
+def test_access_capture_is_a_duplicate_of_its_log():
+    translator = Translator(None)
+    assert not translator.is_duplicate("access", "access.logs.add", UNLOCK_LOG, "")
+    assert translator.is_duplicate("access", "access.capture.add", UNLOCK_CAPTURE, "")
+    # the same actor at another door is its own event
+    other_door = {**UNLOCK_CAPTURE, "device_id": "f0e1d2c3b4a5"}
+    assert not translator.is_duplicate("access", "access.capture.add", other_door, "")
@@ -0,0 +1,223 @@
+"""
+Summary topics aggregated from the event streams.
+
+Counters are kept incrementally as events arrive, and a summary per site is
+published every ``interval`` seconds, as retained state:
+
+    network/summary/ssid    connected clients per SSID
+    network/summary/ap      connected clients per access point
+    network/summary/events  connects/disconnects per SSID
+    access/summary/unlocks  unlocks per door
+
+Counts of events are given for the last interval (a tumbling window) and
+for the last ``window`` seconds (a sliding window over the last few
+intervals), so a dashboard can follow one topic instead of every client.
+"""
+
+import asyncio
+import logging
+
+from collections import Counter, deque
+from time import monotonic, time
+from typing import Dict, List, Optional, Tuple
+
+from . import codec
+from .constants import AGGREGATE_DEFAULT_WINDOW
+from .mqtt import Mqtt
+from .translator import NETWORK_CLIENT_EVENTS, Translator
+from .unifi.controller import UnifiController
+
+logger = logging.getLogger("unifi_mqtt.aggregates")
+
+WIRED = "wired"
+
+# the events which are counted
+EVENTS = frozenset(["client:update", "access.logs.add", *NETWORK_CLIENT_EVENTS])
+
+
+class EventCounts:
+    """
+    Counts of events per key for the current interval, and for a sliding
+    window of the last ``intervals`` intervals.
+    """
+
+    def __init__(self, intervals: int):
+        self.current = Counter()
+        # the counts of each of the last intervals, oldest first
+        self.history = deque(maxlen=intervals)
+
+    def add(self, key, amount: int = 1):
+        self.current[key] += amount
+
+    def rotate(self) -> Tuple[Counter, Counter]:
+        """
+        Close the current interval, returning its counts and the window's.
+        """
+        last = self.current
+        self.history.append(last)
+        self.current = Counter()
+        window = Counter()
+        for counts in self.history:
+            window.update(counts)
+        return last, window
+
+
+class SiteAggregates:
+    def __init__(self, intervals: int):
+        # mac -> (ssid, ap) of each connected client
+        self.clients: Dict[str, Tuple[Optional[str], Optional[str]]] = {}
+        self.ssids = Counter()
+        self.aps = Counter()
+        # (ssid, connected) -> count
+        self.connects = EventCounts(intervals)
+        # (door, success) -> count
+        self.unlocks = EventCounts(intervals)
+        self.services = set()
+
+    def update_client(self, client: dict):
+        mac = client["mac"]
+        previous = self.clients.pop(mac, None)
+        if previous is not None:
+            ssid, ap = previous
+            self._count(ssid, ap, -1)
+        if client.get("connected"):
+            ssid = client.get("essid") or (WIRED if client.get("is_wired") else None)
+            ap = client.get("ap_mac")
+            self.clients[mac] = (ssid, ap)
+            self._count(ssid, ap, 1)
+
+    def _count(self, ssid, ap, amount: int):
+        if ssid is not None:
+            self.ssids[ssid] += amount
+            if not self.ssids[ssid]:
+                del self.ssids[ssid]
+        if ap is not None:
+            self.aps[ap] += amount
+            if not self.aps[ap]:
+                del self.aps[ap]
+
+
+def _by_result(counts: Counter) -> Dict[str, Dict[str, int]]:
+    # {(key, result): n} -> {key: {result: n}}
+    result = {}
+    for (key, label), count in counts.items():
+        result.setdefault(key, {})[label] = count
+    return result
+
+
+class Aggregator:
+    def __init__(
+        self,
+        mqtt: Mqtt,
+        interval: float,
+        window: float = AGGREGATE_DEFAULT_WINDOW,
+    ):
+        self.mqtt = mqtt
+        self.interval = interval
+        self.window = window
+        self.intervals = max(1, round(window / interval))
+
+        # topic prefix -> aggregates for that site
+        self.sites: Dict[str, SiteAggregates] = {}
+        self.task = None
+
+    def observe(self, translator: Translator):
+        # events are counted as the translator publishes them, after dedup and
+        # debouncing, so redeliveries and flaps aren't counted
+        translator.add_observer(self.on_event)
+
+    def connect(self, controller: UnifiController):
+        self.sites[controller.topic_prefix] = SiteAggregates(self.intervals)
+
+    def disconnect(self, controller: UnifiController):
+        self.sites.pop(controller.topic_prefix, None)
+
+    async def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    def on_event(self, prefix: str, service_name: str, event_name: str, payload):
+        if event_name not in EVENTS:
+            return
+        site = self.sites.get(prefix)
+        if site is None:
+            return
+        try:
+            if event_name == "client:update":
+                site.update_client(payload["client"])
+                site.services.add("network")
+            elif event_name == "access.logs.add":
+                source = payload["data"]["_source"]
+                if source["event"]["type"] != "access.door.unlock":
+                    return
+                door = payload["device_id"]
+                for target in source.get("target", ()):
+                    if target.get("type") == "door":
+                        door = target["display_name"]
+                        break
+                success = source["event"]["result"] == "ACCESS"
+                site.unlocks.add((door, "granted" if success else "denied"))
+                site.services.add("access")
+            else:
+                _, connected = NETWORK_CLIENT_EVENTS[event_name]
+                ssid = payload.get("ssid") or payload.get("network") or "unknown"
+                site.connects.add((ssid, "connected" if connected else "disconnected"))
+                site.services.add("network")
+        except (KeyError, TypeError):
+            logger.debug("aggregate.skipped: %s %s", service_name, event_name)
+
+    async def run(self):
+        deadline = monotonic()
+        while True:
+            deadline += self.interval
+            await asyncio.sleep(max(0.0, deadline - monotonic()))
+            for topic, message in self.summaries():
+                await self.mqtt.publish(topic, message, "state")
+
+    def summaries(self) -> List[Tuple[str, bytes]]:
+        ts = int(time() * 1000)
+        messages = []
+        for prefix, site in self.sites.items():
+            connects, connects_window = site.connects.rotate()
+            unlocks, unlocks_window = site.unlocks.rotate()
+            header = {"ts": ts, "interval": self.interval, "window": self.window}
+            if "network" in site.services:
+                messages += [
+                    (
+                        f"{prefix}network/summary/ssid",
+                        codec.dumps({**header, "clients": dict(site.ssids)}),
+                    ),
+                    (
+                        f"{prefix}network/summary/ap",
+                        codec.dumps({**header, "clients": dict(site.aps)}),
+                    ),
+                    (
+                        f"{prefix}network/summary/events",
+                        codec.dumps(
+                            {
+                                **header,
+                                "last": _by_result(connects),
+                                "sliding": _by_result(connects_window),
+                            }
+                        ),
+                    ),
+                ]
+            if "access" in site.services:
+                messages.append(
+                    (
+                        f"{prefix}access/summary/unlocks",
+                        codec.dumps(
+                            {
+                                **header,
+                                "last": _by_result(unlocks),
+                                "sliding": _by_result(unlocks_window),
+                            }
+                        ),
+                    )
+                )
+        return messages
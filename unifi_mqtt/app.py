@@ -0,0 +1,375 @@
+import asyncio
+import logging
+import signal
+import sys
+
+from dataclasses import dataclass, field
+from functools import partial
+from typing import Callable, Coroutine, Dict, List, Optional
+
+from . import metrics
+from .aggregates import Aggregator
+from .commands import CommandHandler
+from .config import SiteConfig, build_controllers
+from .discovery import Discovery
+from .media import MediaCache, MediaFetcher, MediaMode
+from .mqtt import Mqtt, TopicClass
+from .pipeline import LoadShedder, OverflowPolicy, Priority
+from .recorder import FrameRecorder
+from .rules import Rules
+from .spool import Spool
+from .state import StateStore
+from .translator import RawMode, Translator
+from .unifi.pool import SessionPool
+from .constants import (
+    MQTT_DEFAULT_HOST,
+    MQTT_DEFAULT_PORT,
+    MQTT_DEFAULT_NAME,
+    MQTT_DEFAULT_USERNAME,
+    MQTT_DEFAULT_PASSWORD,
+    MQTT_DEFAULT_EVENT_QOS,
+    MQTT_DEFAULT_STATE_QOS,
+    MQTT_DEFAULT_COALESCE_INTERVAL,
+    PIPELINE_DEFAULT_QUEUE_SIZE,
+    PIPELINE_DEFAULT_OVERFLOW_POLICY,
+    PIPELINE_DEFAULT_PUBLISH_WORKERS,
+    PIPELINE_DEFAULT_SHED_WATERMARK,
+    UNIFI_DEFAULT_HEARTBEAT,
+    STATE_DEFAULT_FILE,
+    SPOOL_DEFAULT_DIR,
+    SPOOL_DEFAULT_MAX_BYTES,
+    SPOOL_DEFAULT_MAX_AGE,
+    SPOOL_DEFAULT_DRAIN_RATE,
+    METRICS_DEFAULT_HOST,
+    METRICS_COLLECT_TIMEOUT,
+    COMMAND_DEFAULT_CONCURRENCY,
+    DEBOUNCE_DEFAULT_WINDOW,
+    DISCOVERY_DEFAULT_PREFIX,
+    DEDUP_DEFAULT_WINDOW,
+    MEDIA_DEFAULT_DIR,
+    MEDIA_DEFAULT_MAX_BYTES,
+    MEDIA_DEFAULT_CONCURRENCY,
+    AGGREGATE_DEFAULT_INTERVAL,
+    AGGREGATE_DEFAULT_WINDOW,
+    SHUTDOWN_DRAIN_TIMEOUT,
+)
+
+try:
+    import uvloop
+except ImportError:  # pragma: no cover
+    uvloop = None
+
+logger = logging.getLogger("unifi_mqtt.app")
+
+
+def configure_logging(log_level):
+    logger = logging.getLogger("unifi_mqtt")
+    logger.propagate = False
+    logger.setLevel(getattr(logging, log_level.upper()))
+    while logger.handlers:
+        logger.removeHandler(logger.handlers[0])
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("[%(name)s] %(levelname)s %(message)s"))
+    logger.addHandler(handler)
+
+
+def run(main: Coroutine):
+    """
+    Run ``main`` on a new event loop, which is uvloop's if it's installed.
+    """
+    if uvloop is None:
+        return asyncio.run(main)
+    if sys.version_info >= (3, 11):
+        with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+            return runner.run(main)
+    uvloop.install()
+    return asyncio.run(main)
+
+
+@dataclass
+class Options:
+    """
+    Everything needed to run a set of sites, other than the sites themselves.
+
+    Kept to plain values so it can be handed to worker processes.
+    """
+
+    mqtt_host: str = MQTT_DEFAULT_HOST
+    mqtt_port: int = MQTT_DEFAULT_PORT
+    mqtt_name: str = MQTT_DEFAULT_NAME
+    mqtt_username: Optional[str] = MQTT_DEFAULT_USERNAME
+    mqtt_password: Optional[str] = MQTT_DEFAULT_PASSWORD
+    mqtt_event_qos: int = MQTT_DEFAULT_EVENT_QOS
+    mqtt_state_qos: int = MQTT_DEFAULT_STATE_QOS
+    mqtt_retain_state: bool = True
+    mqtt_coalesce_interval: float = MQTT_DEFAULT_COALESCE_INTERVAL
+    queue_size: int = PIPELINE_DEFAULT_QUEUE_SIZE
+    overflow_policy: str = PIPELINE_DEFAULT_OVERFLOW_POLICY
+    publish_workers: int = PIPELINE_DEFAULT_PUBLISH_WORKERS
+    # 0 disables shedding
+    shed_watermark: float = PIPELINE_DEFAULT_SHED_WATERMARK
+    unifi_heartbeat: float = UNIFI_DEFAULT_HEARTBEAT
+    state_file: Optional[str] = STATE_DEFAULT_FILE
+    spool_dir: Optional[str] = SPOOL_DEFAULT_DIR
+    spool_max_bytes: int = SPOOL_DEFAULT_MAX_BYTES
+    spool_max_age: float = SPOOL_DEFAULT_MAX_AGE
+    spool_drain_rate: float = SPOOL_DEFAULT_DRAIN_RATE
+    raw_modes: Dict[str, RawMode] = field(default_factory=dict)
+    debounce_window: float = DEBOUNCE_DEFAULT_WINDOW
+    dedup_window: float = DEDUP_DEFAULT_WINDOW
+    # a JSON file of routing and filter rules
+    rules: Optional[str] = None
+    aggregate_interval: float = AGGREGATE_DEFAULT_INTERVAL
+    aggregate_window: float = AGGREGATE_DEFAULT_WINDOW
+    ha_discovery: bool = False
+    ha_discovery_prefix: str = DISCOVERY_DEFAULT_PREFIX
+    # None leaves event images unfetched; otherwise a MediaMode value
+    media_mode: Optional[str] = None
+    media_dir: str = MEDIA_DEFAULT_DIR
+    media_max_bytes: int = MEDIA_DEFAULT_MAX_BYTES
+    media_concurrency: int = MEDIA_DEFAULT_CONCURRENCY
+    media_url_base: Optional[str] = None
+    record: Optional[str] = None
+    metrics_host: str = METRICS_DEFAULT_HOST
+    metrics_port: Optional[int] = None
+    commands: bool = False
+    command_concurrency: int = COMMAND_DEFAULT_CONCURRENCY
+
+
+class App:
+    """
+    Wires the controllers for a set of sites through a translator to MQTT.
+    """
+
+    def __init__(self, options: Options, sites: List[SiteConfig]):
+        self.options = options
+        self.sites = sites
+
+        self.spool = None
+        self.mqtt = None
+        self.state = None
+        self.recorder = None
+        self.pool = None
+        self.shedder = None
+        self.controllers = []
+        self.media = None
+        self.translator = None
+        self.aggregator = None
+        self.commands = None
+        self.metrics_server = None
+        self.loop = None
+        self.tasks = []
+
+    def build(self):
+        options = self.options
+
+        if options.spool_dir:
+            self.spool = Spool(
+                options.spool_dir,
+                max_bytes=options.spool_max_bytes,
+                max_age=options.spool_max_age,
+            )
+
+        self.mqtt = Mqtt(
+            host=options.mqtt_host,
+            port=options.mqtt_port,
+            name=options.mqtt_name,
+            username=options.mqtt_username,
+            password=options.mqtt_password,
+            topic_classes={
+                "event": TopicClass(qos=options.mqtt_event_qos),
+                "state": TopicClass(
+                    qos=options.mqtt_state_qos,
+                    retain=options.mqtt_retain_state,
+                    coalesce=True,
+                ),
+            },
+            coalesce_interval=options.mqtt_coalesce_interval,
+            spool=self.spool,
+            drain_rate=options.spool_drain_rate,
+        )
+
+        self.state = StateStore(options.state_file)
+        self.recorder = FrameRecorder(options.record) if options.record else None
+
+        self.pool = SessionPool()
+        if options.shed_watermark > 0:
+            self.shedder = LoadShedder({Priority.LOW: options.shed_watermark})
+        self.controllers = build_controllers(
+            self.sites,
+            self.pool,
+            state=self.state,
+            recorder=self.recorder,
+            heartbeat=options.unifi_heartbeat,
+            shedder=self.shedder,
+        )
+
+        if options.media_mode:
+            self.media = MediaFetcher(
+                self.controllers,
+                MediaCache(options.media_dir, options.media_max_bytes),
+                mode=MediaMode(options.media_mode),
+                concurrency=options.media_concurrency,
+                url_base=options.media_url_base,
+            )
+
+        self.translator = Translator(
+            self.mqtt,
+            queue_size=options.queue_size,
+            overflow_policy=OverflowPolicy(options.overflow_policy),
+            publish_workers=options.publish_workers,
+            raw_modes=options.raw_modes,
+            debounce_window=options.debounce_window,
+            dedup_window=options.dedup_window,
+            media=self.media,
+            rules=Rules.load(options.rules) if options.rules else None,
+            discovery=(
+                Discovery(options.mqtt_name, self.state, options.ha_discovery_prefix)
+                if options.ha_discovery
+                else None
+            ),
+        )
+        for controller in self.controllers:
+            self.translator.connect(controller)
+
+        if options.aggregate_interval > 0:
+            self.aggregator = Aggregator(
+                self.mqtt, options.aggregate_interval, options.aggregate_window
+            )
+            self.aggregator.observe(self.translator)
+            for controller in self.controllers:
+                self.aggregator.connect(controller)
+
+        if options.commands:
+            self.commands = CommandHandler(
+                self.mqtt, self.controllers, concurrency=options.command_concurrency
+            )
+
+    async def start(self):
+        self.loop = asyncio.get_event_loop()
+        self.build()
+        # logging in doesn't need the broker, so neither waits on the other
+        await asyncio.gather(
+            self.mqtt.connect(),
+            *(controller.ensure_login() for controller in self.controllers),
+        )
+        await self.translator.start()
+        if self.shedder is not None:
+            self.shedder.watch(
+                self.translator.translate_queue, *self.translator.publish_queues
+            )
+        if self.aggregator is not None:
+            await self.aggregator.start()
+        if self.commands is not None:
+            await self.commands.start()
+        self.tasks = [asyncio.ensure_future(self.state.run())]
+
+        metrics.REGISTRY.add_collector(self.collect_metrics)
+        if self.options.metrics_port is not None:
+            self.metrics_server = metrics.MetricsServer(
+                self.options.metrics_host,
+                self.options.metrics_port,
+                collect=partial(self.call_in_loop, metrics.REGISTRY.collect),
+                health=partial(self.call_in_loop, self.stats),
+            )
+            self.metrics_server.start()
+
+    async def run(self):
+        await self.start()
+        await asyncio.gather(*(controller.connect() for controller in self.controllers))
+
+    async def serve(self):
+        """
+        Run until SIGINT or SIGTERM, then shut down gracefully.
+        """
+        loop = asyncio.get_running_loop()
+        task = asyncio.current_task()
+        signals = (signal.SIGINT, signal.SIGTERM)
+        for signum in signals:
+            loop.add_signal_handler(signum, task.cancel)
+        try:
+            await self.run()
+        except asyncio.CancelledError:
+            logger.info("app.shutting-down")
+        finally:
+            for signum in signals:
+                loop.remove_signal_handler(signum)
+            await self.close()
+
+    async def close(self):
+        """
+        Stop taking in events, publish everything already in flight (within
+        ``SHUTDOWN_DRAIN_TIMEOUT``), then close everything down.
+        """
+        if self.mqtt is None:
+            return
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+            self.metrics_server = None
+        if self.collect_metrics in metrics.REGISTRY.collectors:
+            metrics.REGISTRY.remove_collector(self.collect_metrics)
+        # commands still need the controllers' sessions to be sent
+        if self.commands is not None:
+            await self.commands.close()
+        for controller in self.controllers:
+            await controller.close()
+        try:
+            await asyncio.wait_for(self.translator.drain(), SHUTDOWN_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("app.drain-timeout: %s", self.queue_stats())
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        await self.pool.close()
+        await self.translator.close()
+        if self.aggregator is not None:
+            await self.aggregator.close()
+        await self.mqtt.close()
+        self.state.close()
+        if self.recorder:
+            self.recorder.close()
+
+    def queue_stats(self) -> dict:
+        queues = self.translator.stats()
+        for controller in self.controllers:
+            for name, stats in controller.bus.stats().items():
+                queues[f"{controller.topic_prefix}{name}"] = stats
+        return queues
+
+    def stats(self) -> dict:
+        translator = self.translator
+        return {
+            "sites": [site.key for site in self.sites],
+            "queues": self.queue_stats(),
+            "unknown": sum(translator.unknown.values()),
+            "mqtt": {
+                "connected": self.mqtt.is_connected,
+                "coalesced": self.mqtt.coalesced,
+                "lost": self.mqtt.lost,
+                "spooled": self.spool.pending() if self.spool is not None else 0,
+            },
+        }
+
+    def collect_metrics(self):
+        for name, stats in self.queue_stats().items():
+            metrics.QUEUE_DEPTH.labels(name).set(stats["depth"])
+            metrics.QUEUE_DROPPED.labels(name).value = stats["dropped"]
+            metrics.QUEUE_COALESCED.labels(name).value = stats["coalesced"]
+        metrics.BROKER_CONNECTED.set(self.mqtt.is_connected)
+        if self.spool is not None:
+            metrics.SPOOL_BYTES.set(self.spool.pending())
+        if self.media is not None:
+            metrics.MEDIA_CACHE_BYTES.set(self.media.cache.size)
+
+    def call_in_loop(self, callback: Callable):
+        """
+        Run ``callback`` on the event loop from another thread (e.g. a metrics
+        scrape) so it never sees state part way through an update.
+        """
+
+        async def call():
+            return callback()
+
+        future = asyncio.run_coroutine_threadsafe(call(), self.loop)
+        return future.result(METRICS_COLLECT_TIMEOUT)
@@ -0,0 +1,28 @@
+import random
+
+
+class Backoff:
+    """
+    Capped exponential backoff with jitter.
+
+    Each delay is drawn from the upper half of the current window, so a set
+    of clients failing at the same moment spread out their retries without
+    any of them retrying immediately.
+    """
+
+    def __init__(
+        self, initial: float = 1.0, maximum: float = 60.0, factor: float = 2.0
+    ):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.attempts = 0
+
+    def reset(self):
+        self.attempts = 0
+
+    def next(self) -> float:
+        window = min(self.maximum, self.initial * self.factor**self.attempts)
+        if window < self.maximum:
+            self.attempts += 1
+        return random.uniform(window / 2, window)
@@ -0,0 +1,210 @@
+import asyncio
+import json
+import struct
+import tracemalloc
+import zlib
+
+from collections import Counter
+from time import perf_counter
+from typing import Iterable, List, Tuple
+
+from .constants import MQTT_DEFAULT_NAME
+from .recorder import BINARY, TEXT
+from .translator import Translator
+
+
+class MemoryBroker:
+    """
+    An in-process stand-in for ``Mqtt`` which records what would be published.
+    """
+
+    def __init__(self, name: str = MQTT_DEFAULT_NAME):
+        self.name = name
+        self.messages = 0
+        self.bytes = 0
+        self.topics = Counter()
+
+    async def connect(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def publish(self, topic, payload, kind="event"):
+        self.messages += 1
+        self.bytes += len(payload)
+        self.topics[topic] += 1
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def _mac(n: int) -> str:
+    return "00:11:22:%02x:%02x:%02x" % ((n >> 16) & 0xFF, (n >> 8) & 0xFF, n & 0xFF)
+
+
+def network_frames(count: int, clients: int = 1000) -> Iterable[Tuple[int, str]]:
+    for n in range(count):
+        client = n % clients
+        if n % 4 == 3:
+            yield TEXT, json.dumps(
+                {
+                    "meta": {"rc": "ok", "message": "sta:sync"},
+                    "data": [
+                        {
+                            "mac": _mac(client),
+                            "hostname": f"client-{client}",
+                            "ip": f"10.0.{client >> 8}.{client & 0xFF}",
+                            "ap_mac": _mac(n % 16),
+                            "essid": "Home",
+                            "network": "LAN",
+                            "is_wired": False,
+                            "rx_bytes": n,
+                        }
+                    ],
+                }
+            )
+            continue
+        yield TEXT, json.dumps(
+            {
+                "meta": {"rc": "ok", "message": "events"},
+                "data": [
+                    {
+                        "_id": f"event-{n}",
+                        "key": "EVT_WU_Connected" if n % 2 else "EVT_WU_Disconnected",
+                        "user": _mac(client),
+                        "hostname": f"client-{client}",
+                        "ssid": "Home",
+                        "network": "LAN",
+                        "ap": _mac(n % 16),
+                        "subsystem": "wlan",
+                        "time": 1600000000000 + n,
+                    }
+                ],
+            }
+        )
+
+
+def access_frames(count: int, doors: int = 20) -> Iterable[Tuple[int, str]]:
+    for n in range(count):
+        door = n % doors
+        source = {
+            "event": {
+                "type": "access.door.unlock",
+                "result": "ACCESS" if n % 10 else "BLOCKED",
+                "published": 1600000000000 + n * 1000,
+                "log_key": f"log-{n}",
+            },
+            "actor": {"id": f"user-{n % 50}", "display_name": f"User {n % 50}"},
+            "target": [
+                {"type": "building", "display_name": "HQ"},
+                {"type": "floor", "display_name": "Floor 1"},
+                {"type": "door", "display_name": f"Door {door}"},
+            ],
+        }
+        yield TEXT, json.dumps(
+            {
+                "event": "access.logs.add",
+                "device_id": f"device-{door}",
+                "data": json.dumps({"_id": f"log-{n}", "_source": source}),
+            }
+        )
+
+
+def _packet(packet_type: int, payload: dict, deflate: bool = False) -> bytes:
+    data = json.dumps(payload).encode("utf-8")
+    if deflate:
+        data = zlib.compress(data)
+    return struct.pack("!BBBxI", packet_type, 1, int(deflate), len(data)) + data
+
+
+def protect_frames(count: int, cameras: int = 50) -> Iterable[Tuple[int, bytes]]:
+    for n in range(count):
+        camera = f"camera-{n % cameras}"
+        if n % 5:
+            # camera stat updates dominate the real stream
+            yield BINARY, _packet(
+                1,
+                {
+                    "action": "update",
+                    "newUpdateId": f"update-{n}",
+                    "modelKey": "camera",
+                    "id": camera,
+                },
+            ) + _packet(2, {"stats": {"rxBytes": n, "txBytes": n}, "upSince": n}, True)
+            continue
+        event_id = f"event-{n // 10}"
+        if n % 10 == 0:
+            action, data = "add", {"type": "motion", "camera": camera, "start": n}
+        else:
+            action, data = "update", {"end": n, "score": 80}
+        yield BINARY, _packet(
+            1,
+            {
+                "action": action,
+                "newUpdateId": f"update-{n}",
+                "modelKey": "event",
+                "id": event_id,
+            },
+        ) + _packet(2, data)
+
+
+PATHS = {
+    "network": network_frames,
+    "access": access_frames,
+    "protect": protect_frames,
+}
+
+
+async def run_path(service_name: str, frames: List[Tuple[int, object]]) -> dict:
+    broker = MemoryBroker()
+    # imported here, so the CLI can list PATHS without loading aiohttp
+    from .unifi.controller import UnifiController
+
+    controller = UnifiController(services=[service_name])
+    translator = Translator(broker)
+    translator.connect(controller)
+    await translator.start()
+
+    latencies = []
+    translator.observe_latency = latencies.append
+    service = controller.services[0]
+
+    started = perf_counter()
+    for n, (msg_type, data) in enumerate(frames):
+        await service.handle_frame(msg_type, data)
+        if n % 1000 == 0:
+            await asyncio.sleep(0)
+    await translator.join()
+    elapsed = perf_counter() - started
+
+    await translator.close()
+    await controller.close()
+    return {
+        "frames": len(frames),
+        "published": broker.messages,
+        "elapsed": elapsed,
+        "frames_per_sec": len(frames) / elapsed,
+        "events_per_sec": broker.messages / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+async def run_benchmark(service_name: str, count: int) -> dict:
+    frames = list(PATHS[service_name](count))
+    result = await run_path(service_name, frames)
+
+    # memory is measured on a second pass, as tracing skews the timings
+    tracemalloc.start()
+    try:
+        await run_path(service_name, frames)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    result["kb_per_10k_events"] = peak / 1024 / max(result["published"], 1) * 10000
+    return result
@@ -1,38 +1,90 @@
-import ipaddress
 import logging
-import asyncio
 import os
 
+from time import time
+
 import click
 
-from .mqtt import Mqtt
-from .unifi.controller import UnifiController
-from .translator import Translator
+# only what the options need is imported up front; aiohttp and the MQTT
+# client are loaded by the command which runs, not for --help
+from .bench import PATHS
+from .config import (
+    ConfigError,
+    SiteConfig,
+    finalize_sites,
+    load_config,
+)
+from .media import MediaMode
+from .pipeline import OverflowPolicy
+from .rules import Rules
+from .translator import RawMode
 from .constants import (
     UNIFI_DEFAULT_HOST,
     UNIFI_DEFAULT_PASSWORD,
     UNIFI_DEFAULT_PORT,
     UNIFI_DEFAULT_USERNAME,
     UNIFI_DEFAULT_SITE,
+    UNIFI_DEFAULT_HEARTBEAT,
     MQTT_DEFAULT_HOST,
     MQTT_DEFAULT_PORT,
     MQTT_DEFAULT_NAME,
     MQTT_DEFAULT_USERNAME,
     MQTT_DEFAULT_PASSWORD,
+    MQTT_DEFAULT_EVENT_QOS,
+    MQTT_DEFAULT_STATE_QOS,
+    MQTT_DEFAULT_COALESCE_INTERVAL,
+    PIPELINE_DEFAULT_QUEUE_SIZE,
+    PIPELINE_DEFAULT_OVERFLOW_POLICY,
+    PIPELINE_DEFAULT_PUBLISH_WORKERS,
+    PIPELINE_DEFAULT_SHED_WATERMARK,
+    STATE_DEFAULT_FILE,
+    SPOOL_DEFAULT_DIR,
+    SPOOL_DEFAULT_MAX_BYTES,
+    SPOOL_DEFAULT_MAX_AGE,
+    SPOOL_DEFAULT_DRAIN_RATE,
+    SUPERVISOR_DEFAULT_WORKERS,
+    METRICS_DEFAULT_HOST,
+    COMMAND_DEFAULT_CONCURRENCY,
+    POLL_DEFAULT_INTERVAL,
+    DEBOUNCE_DEFAULT_WINDOW,
+    DISCOVERY_DEFAULT_PREFIX,
+    DEDUP_DEFAULT_WINDOW,
+    MEDIA_DEFAULT_DIR,
+    MEDIA_DEFAULT_MAX_BYTES,
+    MEDIA_DEFAULT_CONCURRENCY,
+    AGGREGATE_DEFAULT_INTERVAL,
+    AGGREGATE_DEFAULT_WINDOW,
 )
 
 logging.basicConfig(level=logging.INFO)
 
 
-def configure_logging(log_level):
-    logger = logging.getLogger("unifi_mqtt")
-    logger.propagate = False
-    logger.setLevel(getattr(logging, log_level.upper()))
-    while logger.handlers:
-        logger.removeHandler(logger.handlers[0])
-    handler = logging.StreamHandler()
-    handler.setFormatter(logging.Formatter("[%(name)s] %(levelname)s %(message)s"))
-    logger.addHandler(handler)
+def parse_raw_modes(values, services):
+    raw_modes = {}
+    for value in values:
+        service, _, mode = value.rpartition("=")
+        try:
+            mode = RawMode(mode)
+        except ValueError:
+            raise click.BadParameter(
+                f"unknown raw mode: {mode}", param_hint="--raw-mode"
+            )
+        for name in [service] if service else services:
+            raw_modes[name] = mode
+    return raw_modes
+
+
+def parse_poll(values):
+    poll = {}
+    for value in values:
+        path, _, interval = value.partition("=")
+        try:
+            poll[path] = float(interval) if interval else POLL_DEFAULT_INTERVAL
+        except ValueError:
+            raise click.BadParameter(
+                f"invalid interval: {interval}", param_hint="--poll"
+            )
+    return poll
 
 
 @click.command()
@@ -40,14 +92,172 @@ def configure_logging(log_level):
 @click.option("--unifi-port", default=UNIFI_DEFAULT_PORT, type=int)
 @click.option("--unifi-username", default=UNIFI_DEFAULT_USERNAME)
 @click.option("--unifi-password", default=UNIFI_DEFAULT_PASSWORD)
-@click.option("--unifi-site", default=UNIFI_DEFAULT_SITE)
+@click.option("--unifi-site", multiple=True, default=[UNIFI_DEFAULT_SITE])
 @click.option("--unifi-service", multiple=True, default=["network"])
 @click.option("--secure/--insecure", default=True)
+@click.option(
+    "--unifi-heartbeat",
+    default=UNIFI_DEFAULT_HEARTBEAT,
+    type=float,
+    help="Seconds between websocket pings, which detect a dead connection.",
+)
+@click.option(
+    "--poll",
+    multiple=True,
+    help=(
+        "Poll a REST endpoint (stat/device, stat/health or stat/sta) for state "
+        "which isn't pushed, e.g. stat/device=10 to poll every 10 seconds."
+    ),
+)
+@click.option(
+    "--config",
+    type=click.Path(exists=True, dir_okay=False),
+    help="JSON file describing several controllers/sites (overrides --unifi-*).",
+)
 @click.option("--mqtt-host", default=MQTT_DEFAULT_HOST)
 @click.option("--mqtt-port", default=MQTT_DEFAULT_PORT, type=int)
 @click.option("--mqtt-name", default=MQTT_DEFAULT_NAME)
 @click.option("--mqtt-username", default=MQTT_DEFAULT_USERNAME)
 @click.option("--mqtt-password", default=MQTT_DEFAULT_PASSWORD)
+@click.option(
+    "--mqtt-event-qos", default=MQTT_DEFAULT_EVENT_QOS, type=click.IntRange(0, 2)
+)
+@click.option(
+    "--mqtt-state-qos", default=MQTT_DEFAULT_STATE_QOS, type=click.IntRange(0, 2)
+)
+@click.option("--mqtt-retain-state/--no-mqtt-retain-state", default=True)
+@click.option(
+    "--mqtt-coalesce-interval", default=MQTT_DEFAULT_COALESCE_INTERVAL, type=float
+)
+@click.option("--queue-size", default=PIPELINE_DEFAULT_QUEUE_SIZE, type=int)
+@click.option(
+    "--overflow-policy",
+    default=PIPELINE_DEFAULT_OVERFLOW_POLICY,
+    type=click.Choice([p.value for p in OverflowPolicy]),
+)
+@click.option("--publish-workers", default=PIPELINE_DEFAULT_PUBLISH_WORKERS, type=int)
+@click.option(
+    "--shed-watermark",
+    default=PIPELINE_DEFAULT_SHED_WATERMARK,
+    type=click.FloatRange(0, 1),
+    help=(
+        "Shed low priority frames (e.g. sta:sync) once a queue is this full, "
+        "as a fraction of --queue-size. 0 disables shedding."
+    ),
+)
+@click.option(
+    "--state-file",
+    default=STATE_DEFAULT_FILE,
+    type=click.Path(dir_okay=False),
+    help="Where to persist resume state (e.g. the Protect lastUpdateId).",
+)
+@click.option(
+    "--spool-dir",
+    default=SPOOL_DEFAULT_DIR,
+    type=click.Path(file_okay=False),
+    help="Where to spool messages while the broker is unreachable.",
+)
+@click.option("--no-spool", is_flag=True, default=False)
+@click.option("--spool-max-bytes", default=SPOOL_DEFAULT_MAX_BYTES, type=int)
+@click.option("--spool-max-age", default=SPOOL_DEFAULT_MAX_AGE, type=float)
+@click.option("--spool-drain-rate", default=SPOOL_DEFAULT_DRAIN_RATE, type=float)
+@click.option(
+    "--raw-mode",
+    "raw_modes",
+    multiple=True,
+    help=(
+        "How much of the upstream payload to include as `raw`: full, fields or "
+        "none. Use service=mode (e.g. network=none) to set it per service."
+    ),
+)
+@click.option(
+    "--debounce",
+    default=DEBOUNCE_DEFAULT_WINDOW,
+    type=float,
+    help=(
+        "Seconds a client connect/disconnect must hold before it's published; "
+        "a client flipping back within this window publishes nothing."
+    ),
+)
+@click.option(
+    "--dedup-window",
+    default=DEDUP_DEFAULT_WINDOW,
+    type=float,
+    help=(
+        "Seconds to remember events for, dropping any redelivered within "
+        "this window (e.g. after a reconnect). 0 disables."
+    ),
+)
+@click.option(
+    "--rules",
+    type=click.Path(exists=True, dir_okay=False),
+    help="A JSON file of rules to drop, rename, project or reroute events.",
+)
+@click.option(
+    "--aggregate-interval",
+    default=AGGREGATE_DEFAULT_INTERVAL,
+    type=float,
+    help=(
+        "Publish client count and event rate summaries every this many "
+        "seconds. 0 disables them."
+    ),
+)
+@click.option(
+    "--aggregate-window",
+    default=AGGREGATE_DEFAULT_WINDOW,
+    type=float,
+    help="The span in seconds of the summaries' sliding window.",
+)
+@click.option(
+    "--ha-discovery/--no-ha-discovery",
+    default=False,
+    help="Announce clients, doors and cameras via Home Assistant MQTT discovery.",
+)
+@click.option("--ha-discovery-prefix", default=DISCOVERY_DEFAULT_PREFIX)
+@click.option(
+    "--media",
+    "media_mode",
+    type=click.Choice([m.value for m in MediaMode]),
+    help=(
+        "Fetch Access capture and Protect event images, and publish them to "
+        "<event topic>/image as binary or as a URL to the cached file."
+    ),
+)
+@click.option(
+    "--media-dir",
+    default=MEDIA_DEFAULT_DIR,
+    type=click.Path(file_okay=False),
+    help="Where to cache fetched images.",
+)
+@click.option("--media-max-bytes", default=MEDIA_DEFAULT_MAX_BYTES, type=int)
+@click.option("--media-concurrency", default=MEDIA_DEFAULT_CONCURRENCY, type=int)
+@click.option(
+    "--media-url-base",
+    help="The URL the media directory is served at; otherwise file:// URLs.",
+)
+@click.option(
+    "--record",
+    type=click.Path(dir_okay=False, writable=True),
+    help="Record raw websocket frames to this file for later replay.",
+)
+@click.option(
+    "--commands/--no-commands",
+    default=False,
+    help="Accept controller commands on <name>/<service>/command/<action>.",
+)
+@click.option("--command-concurrency", default=COMMAND_DEFAULT_CONCURRENCY, type=int)
+@click.option("--metrics-host", default=METRICS_DEFAULT_HOST)
+@click.option(
+    "--metrics-port",
+    type=int,
+    help="Serve Prometheus metrics on this port (at /metrics).",
+)
+@click.option(
+    "--workers",
+    default=SUPERVISOR_DEFAULT_WORKERS,
+    type=click.IntRange(1),
+    help="Shard sites across this many worker processes.",
+)
 @click.option(
     "--log-level",
     default="info",
@@ -61,55 +271,211 @@ def main(
     unifi_site,
     unifi_service,
     secure,
+    unifi_heartbeat,
+    poll,
+    config,
     log_level,
     mqtt_host,
     mqtt_port,
     mqtt_name,
     mqtt_username,
     mqtt_password,
+    mqtt_event_qos,
+    mqtt_state_qos,
+    mqtt_retain_state,
+    mqtt_coalesce_interval,
+    queue_size,
+    overflow_policy,
+    publish_workers,
+    shed_watermark,
+    state_file,
+    spool_dir,
+    no_spool,
+    spool_max_bytes,
+    spool_max_age,
+    spool_drain_rate,
+    raw_modes,
+    debounce,
+    dedup_window,
+    rules,
+    aggregate_interval,
+    aggregate_window,
+    ha_discovery,
+    ha_discovery_prefix,
+    media_mode,
+    media_dir,
+    media_max_bytes,
+    media_concurrency,
+    media_url_base,
+    record,
+    commands,
+    command_concurrency,
+    metrics_host,
+    metrics_port,
+    workers,
 ):
+    from .app import App, Options, configure_logging, run
+
     os.environ["PYTHONUNBUFFERED"] = "true"
 
     configure_logging(log_level)
 
-    mqtt = Mqtt(
-        host=mqtt_host,
-        port=mqtt_port,
-        name=mqtt_name,
-        username=mqtt_username,
-        password=mqtt_password,
-    )
-
-    # enable unsafe mode for aiohttp's ClientSession CookieJar if unifi_host is an IP address instead of a FQDN
     try:
-        ipaddress.ip_address(unifi_host)  # check if unifi_host is a valid IP address
-        use_unsafe_cookie_jar = True
-    except ValueError:  # a ValueError indicates that unifi_host is not a valid IP address
-        use_unsafe_cookie_jar = False
-
-    controller = UnifiController(
-        host=unifi_host,
-        port=unifi_port,
-        username=unifi_username,
-        password=unifi_password,
-        site=unifi_site,
-        verify_ssl=secure,
-        use_unsafe_cookie_jar=use_unsafe_cookie_jar,
-        services=unifi_service,
+        if config:
+            sites = load_config(config)
+        else:
+            sites = finalize_sites(
+                [
+                    SiteConfig(
+                        host=unifi_host,
+                        port=unifi_port,
+                        username=unifi_username,
+                        password=unifi_password,
+                        site=site,
+                        services=list(unifi_service),
+                        verify_ssl=secure,
+                        poll=parse_poll(poll),
+                    )
+                    for site in unifi_site
+                ]
+            )
+        if rules:
+            # fail now rather than in every worker
+            Rules.load(rules)
+    except ConfigError as exc:
+        raise click.UsageError(str(exc))
+
+    options = Options(
+        mqtt_host=mqtt_host,
+        mqtt_port=mqtt_port,
+        mqtt_name=mqtt_name,
+        mqtt_username=mqtt_username,
+        mqtt_password=mqtt_password,
+        mqtt_event_qos=mqtt_event_qos,
+        mqtt_state_qos=mqtt_state_qos,
+        mqtt_retain_state=mqtt_retain_state,
+        mqtt_coalesce_interval=mqtt_coalesce_interval,
+        queue_size=queue_size,
+        overflow_policy=overflow_policy,
+        publish_workers=publish_workers,
+        shed_watermark=shed_watermark,
+        unifi_heartbeat=unifi_heartbeat,
+        state_file=state_file,
+        spool_dir=None if no_spool else spool_dir,
+        spool_max_bytes=spool_max_bytes,
+        spool_max_age=spool_max_age,
+        spool_drain_rate=spool_drain_rate,
+        raw_modes=parse_raw_modes(
+            raw_modes, {service for site in sites for service in site.services}
+        ),
+        debounce_window=debounce,
+        dedup_window=dedup_window,
+        rules=rules,
+        aggregate_interval=aggregate_interval,
+        aggregate_window=aggregate_window,
+        ha_discovery=ha_discovery,
+        ha_discovery_prefix=ha_discovery_prefix,
+        media_mode=media_mode,
+        media_dir=media_dir,
+        media_max_bytes=media_max_bytes,
+        media_concurrency=media_concurrency,
+        media_url_base=media_url_base,
+        record=record,
+        commands=commands,
+        command_concurrency=command_concurrency,
+        metrics_host=metrics_host,
+        metrics_port=metrics_port,
     )
 
-    translator = Translator(mqtt)
-    translator.connect(controller)
+    if workers > 1:
+        # only the supervisor needs multiprocessing
+        from .supervisor import Supervisor
 
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(mqtt.connect())
-    loop.run_until_complete(controller.connect())
+        Supervisor(options, sites, workers, log_level=log_level).run()
+        return
 
-    try:
-        loop.run_forever()
-    except KeyboardInterrupt:
-        print("Shutting Down!")
-        loop.close()
+    run(App(options, sites).serve())
+
+
+@click.command()
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--speed",
+    default=1.0,
+    type=float,
+    help="Replay speed relative to the recording, or 0 for as fast as possible.",
+)
+@click.option(
+    "--log-level",
+    default="warning",
+    type=click.Choice(["error", "warning", "info", "debug"]),
+)
+def replay(path, speed, log_level):
+    """
+    Replay a recording through the services and translator.
+    """
+    from .app import configure_logging, run
+    from .bench import MemoryBroker
+    from .recorder import read_frames, replay_frames
+    from .translator import Translator
+    from .unifi.controller import UnifiController
+
+    configure_logging(log_level)
+
+    services = sorted({frame.service for frame in read_frames(path)})
+
+    async def replay_all():
+        broker = MemoryBroker()
+        controller = UnifiController(services=services)
+        translator = Translator(broker)
+        translator.connect(controller)
+        await translator.start()
+        started = time()
+        frames = await replay_frames(
+            path, {service.name: service for service in controller.services}, speed
+        )
+        await translator.join()
+        elapsed = time() - started
+        await translator.close()
+        await controller.close()
+
+        click.echo(f"replayed {frames} frames in {elapsed:.2f}s")
+        click.echo(f"published {broker.messages} messages ({broker.bytes} bytes)")
+        for topic, count in broker.topics.most_common(20):
+            click.echo(f"  {count:8d} {topic}")
+
+    run(replay_all())
+
+
+@click.command()
+@click.option(
+    "--path",
+    "paths",
+    multiple=True,
+    default=sorted(PATHS),
+    type=click.Choice(sorted(PATHS)),
+)
+@click.option("--events", default=50000, type=int, help="Frames to feed per path.")
+def bench(paths, events):
+    """
+    Benchmark the ingest-to-publish pipeline with synthetic frames.
+    """
+    from .app import configure_logging, run
+    from .bench import run_benchmark
+
+    configure_logging("error")
+
+    click.echo(
+        f"{'path':10} {'frames/s':>10} {'events/s':>10} {'p50 ms':>8} "
+        f"{'p99 ms':>8} {'KiB/10k':>8}"
+    )
+    for path in paths:
+        result = run(run_benchmark(path, events))
+        click.echo(
+            f"{path:10} {result['frames_per_sec']:10.0f} "
+            f"{result['events_per_sec']:10.0f} {result['p50_ms']:8.2f} "
+            f"{result['p99_ms']:8.2f} {result['kb_per_10k_events']:8.0f}"
+        )
 
 
 if __name__ == "__main__":
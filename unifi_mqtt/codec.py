@@ -0,0 +1,48 @@
+"""
+JSON encoding and decoding for the hot path.
+
+Uses orjson or msgspec when either is installed, falling back to the standard
+library. ``loads`` accepts ``str``, ``bytes`` or ``memoryview`` and ``dumps``
+always returns compact UTF-8 ``bytes``.
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:  # pragma: no cover
+    msgspec = None
+
+
+if orjson is not None:
+    name = "orjson"
+
+    loads = orjson.loads
+
+    def dumps(obj) -> bytes:
+        return orjson.dumps(obj, default=str)
+
+
+elif msgspec is not None:
+    name = "msgspec"
+
+    loads = msgspec.json.Decoder().decode
+    dumps = msgspec.json.Encoder(enc_hook=str).encode
+
+else:
+    name = "json"
+
+    _encoder = json.JSONEncoder(separators=(",", ":"), default=str)
+
+    def loads(data):
+        if isinstance(data, memoryview):
+            data = str(data, "utf-8")
+        return json.loads(data)
+
+    def dumps(obj) -> bytes:
+        return _encoder.encode(obj).encode("utf-8")
@@ -0,0 +1,303 @@
+"""
+Controller actions requested over MQTT.
+
+Commands are published to ``<name>/[<prefix>/]<service>/command/<action>``
+with a JSON payload naming the target and an optional correlation ``id``:
+
+    unifi/network/command/block      {"id": "42", "mac": "00:11:22:33:44:55"}
+    unifi/access/command/unlock      {"id": "43", "door": "<device id>"}
+
+and the outcome is published to ``<service>/response/<action>`` with the
+same ``id``. Commands for the same batchable action (the ``stamgr`` client
+commands) which arrive within a short window are sent as one request. A
+site's batches are sent one after another in the order their commands
+arrived, so blocking and then unblocking a client leaves it unblocked.
+"""
+
+import asyncio
+import logging
+import re
+
+from functools import partial
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from . import codec, metrics
+from .constants import (
+    COMMAND_DEFAULT_BATCH_WINDOW,
+    COMMAND_DEFAULT_CONCURRENCY,
+    SHUTDOWN_DRAIN_TIMEOUT,
+)
+from .mqtt import Mqtt
+from .unifi.controller import UnifiController
+
+logger = logging.getLogger("unifi_mqtt.commands")
+
+MAC_RE = re.compile(r"^[0-9a-f]{2}(:[0-9a-f]{2}){5}$")
+# door ids are put into the request path, so nothing else may get through
+DOOR_RE = re.compile(r"^[0-9A-Za-z-]+$")
+
+# target field -> the pattern a target must match
+TARGET_PATTERNS = {"mac": MAC_RE, "door": DOOR_RE}
+
+
+class CommandError(ValueError):
+    def __init__(self, message: str, request_id=None):
+        super().__init__(message)
+        self.request_id = request_id
+
+
+async def send(controller: UnifiController, method: str, path: str, **kwargs):
+    response = await controller.request(method, path, **kwargs)
+    # read the body so the connection goes back to the pool
+    await response.read()
+
+
+async def stamgr(controller: UnifiController, targets: List[str], cmd: str):
+    if len(targets) == 1:
+        data = {"cmd": cmd, "mac": targets[0]}
+    else:
+        data = {"cmd": cmd, "macs": targets}
+    await send(controller, "POST", "cmd/stamgr", json=data)
+
+
+async def restart_device(controller: UnifiController, targets: List[str]):
+    for mac in targets:
+        await send(
+            controller, "POST", "cmd/devmgr", json={"cmd": "restart", "mac": mac}
+        )
+
+
+async def unlock_door(controller: UnifiController, targets: List[str]):
+    for door in targets:
+        await send(
+            controller, "PUT", f"/proxy/access/api/v2/device/{door}/relay_unlock"
+        )
+
+
+class Action(NamedTuple):
+    # the payload field naming the target
+    field: str
+    call: Callable[[UnifiController, List[str]], Awaitable[None]]
+    # whether several targets can be sent in one request
+    batch: bool = False
+
+
+ACTIONS: Dict[str, Dict[str, Action]] = {
+    "network": {
+        "block": Action("mac", partial(stamgr, cmd="block-sta"), batch=True),
+        "unblock": Action("mac", partial(stamgr, cmd="unblock-sta"), batch=True),
+        "reconnect": Action("mac", partial(stamgr, cmd="kick-sta"), batch=True),
+        "restart-device": Action("mac", restart_device),
+    },
+    "access": {
+        "unlock": Action("door", unlock_door),
+    },
+}
+
+
+def parse_command(service_name: str, action_name: str, payload: bytes):
+    """
+    Return the (action, target, correlation id) for a command message.
+    """
+    try:
+        data = codec.loads(payload)
+    except Exception:
+        raise CommandError("payload is not valid JSON")
+    if not isinstance(data, dict):
+        raise CommandError("payload must be a JSON object")
+    request_id = data.get("id")
+
+    action = ACTIONS[service_name].get(action_name)
+    if action is None:
+        raise CommandError(f"unknown action: {action_name}", request_id)
+
+    target = data.get(action.field)
+    if not isinstance(target, str) or not target:
+        raise CommandError(f"missing {action.field}", request_id)
+    if action.field == "mac":
+        target = target.lower()
+    if not TARGET_PATTERNS[action.field].match(target):
+        raise CommandError(f"invalid {action.field}: {target}", request_id)
+    return action, target, request_id
+
+
+class CommandHandler:
+    def __init__(
+        self,
+        mqtt: Mqtt,
+        controllers: List[UnifiController],
+        concurrency: int = COMMAND_DEFAULT_CONCURRENCY,
+        batch_window: float = COMMAND_DEFAULT_BATCH_WINDOW,
+    ):
+        self.mqtt = mqtt
+        self.controllers = controllers
+        self.concurrency = concurrency
+        self.batch_window = batch_window
+
+        # (controller, service) -> [(action name, action, {target: [ids]})],
+        # in the order the batches were started
+        self.batches = {}
+        # (controller, service) -> the task sending the last flushed batches
+        self.flushes = {}
+        self.semaphore = None
+        self.tasks = set()
+
+    async def start(self):
+        # bounds concurrent controller requests, however many commands arrive
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        for controller in self.controllers:
+            for service in controller.services:
+                if service.name not in ACTIONS:
+                    continue
+                await self.mqtt.subscribe(
+                    f"{controller.topic_prefix}{service.name}/command/#",
+                    partial(self.on_message, controller, service.name),
+                )
+
+    async def close(self, timeout: float = SHUTDOWN_DRAIN_TIMEOUT):
+        """
+        Send the commands already batched and wait (up to ``timeout``) for
+        those in flight, so nobody is left without a response.
+        """
+        for key in list(self.batches):
+            self._flush_batches(key)
+        if self.tasks:
+            await asyncio.wait(self.tasks, timeout=timeout)
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks.clear()
+
+    def on_message(
+        self,
+        controller: UnifiController,
+        service_name: str,
+        topic: str,
+        payload: bytes,
+    ):
+        action_name = topic.rsplit("/", 1)[-1]
+        try:
+            action, target, request_id = parse_command(
+                service_name, action_name, payload
+            )
+        except CommandError as exc:
+            metrics.COMMANDS.labels(service_name, action_name, "invalid").inc()
+            self._spawn(
+                self.respond(
+                    controller,
+                    service_name,
+                    action_name,
+                    [exc.request_id],
+                    error=str(exc),
+                )
+            )
+            return
+
+        if not action.batch:
+            self._spawn(
+                self.execute(
+                    controller,
+                    service_name,
+                    action_name,
+                    action,
+                    {target: [request_id]},
+                )
+            )
+            return
+
+        key = (controller, service_name)
+        pending = self.batches.get(key)
+        if pending is None:
+            pending = self.batches[key] = []
+            asyncio.get_event_loop().call_later(
+                self.batch_window, self._flush_batches, key
+            )
+        batch = self._batch_for(pending, action_name, action, target)
+        batch.setdefault(target, []).append(request_id)
+
+    @staticmethod
+    def _batch_for(pending: List, action_name: str, action: Action, target: str):
+        # the newest batch for this action can take the target, unless a later
+        # batch for another action already has it: that one has to go first
+        for batch_action_name, _, batch in reversed(pending):
+            if batch_action_name == action_name:
+                return batch
+            if target in batch:
+                break
+        batch = {}
+        pending.append((action_name, action, batch))
+        return batch
+
+    def _flush_batches(self, key: Tuple):
+        controller, service_name = key
+        pending = self.batches.pop(key, None)
+        if not pending:
+            return
+        previous = self.flushes.get(key)
+        task = self._spawn(
+            self.execute_batches(previous, controller, service_name, pending)
+        )
+        self.flushes[key] = task
+        task.add_done_callback(partial(self._forget_flush, key))
+
+    def _forget_flush(self, key: Tuple, task: asyncio.Task):
+        if self.flushes.get(key) is task:
+            del self.flushes[key]
+
+    def _spawn(self, coro) -> asyncio.Task:
+        task = asyncio.ensure_future(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def execute_batches(
+        self,
+        previous: Optional[asyncio.Task],
+        controller: UnifiController,
+        service_name: str,
+        pending: List,
+    ):
+        # an earlier flush may still be sending, and must land first
+        if previous is not None:
+            await asyncio.wait([previous])
+        for action_name, action, batch in pending:
+            await self.execute(controller, service_name, action_name, action, batch)
+
+    async def execute(
+        self,
+        controller: UnifiController,
+        service_name: str,
+        action_name: str,
+        action: Action,
+        targets: Dict[str, List],
+    ):
+        error = None
+        async with self.semaphore:
+            metrics.COMMAND_REQUESTS.labels(service_name, action_name).inc()
+            try:
+                await action.call(controller, list(targets))
+            except Exception as exc:
+                logger.warning(
+                    "command.failed %s/%s: %s", service_name, action_name, exc
+                )
+                error = str(exc) or type(exc).__name__
+
+        result = "error" if error else "ok"
+        request_ids = [i for ids in targets.values() for i in ids]
+        metrics.COMMANDS.labels(service_name, action_name, result).inc(len(request_ids))
+        await self.respond(controller, service_name, action_name, request_ids, error)
+
+    async def respond(
+        self,
+        controller: UnifiController,
+        service_name: str,
+        action_name: str,
+        request_ids: List,
+        error: str = None,
+    ):
+        topic = f"{controller.topic_prefix}{service_name}/response/{action_name}"
+        for request_id in request_ids:
+            message = {"id": request_id, "action": action_name, "ok": error is None}
+            if error is not None:
+                message["error"] = error
+            await self.mqtt.publish(topic, codec.dumps(message), "response")
@@ -0,0 +1,148 @@
+import ipaddress
+import json
+
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+from .constants import (
+    UNIFI_DEFAULT_HOST,
+    UNIFI_DEFAULT_PASSWORD,
+    UNIFI_DEFAULT_PORT,
+    UNIFI_DEFAULT_USERNAME,
+    UNIFI_DEFAULT_SITE,
+    UNIFI_DEFAULT_HEARTBEAT,
+)
+from .pipeline import LoadShedder
+from .recorder import FrameRecorder
+from .state import StateStore
+from .unifi.poller import ENDPOINTS
+
+if TYPE_CHECKING:
+    from .unifi.controller import UnifiController
+    from .unifi.pool import SessionPool
+
+# services which are per host rather than per site
+HOST_SERVICES = frozenset(["access", "protect"])
+
+
+class ConfigError(ValueError):
+    pass
+
+
+@dataclass
+class SiteConfig:
+    host: str = UNIFI_DEFAULT_HOST
+    port: int = UNIFI_DEFAULT_PORT
+    username: str = UNIFI_DEFAULT_USERNAME
+    password: str = UNIFI_DEFAULT_PASSWORD
+    site: str = UNIFI_DEFAULT_SITE
+    services: List[str] = field(default_factory=lambda: ["network"])
+    verify_ssl: bool = True
+    # the topic prefix for this site, defaulting to the site name when more
+    # than one site is configured
+    prefix: Optional[str] = None
+    # REST endpoint -> poll interval in seconds
+    poll: Dict[str, float] = field(default_factory=dict)
+
+    @property
+    def key(self) -> str:
+        return f"{self.host}:{self.port}/{self.site}"
+
+
+def is_ip_address(host: str) -> bool:
+    try:
+        ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return True
+
+
+def load_config(path: str) -> List[SiteConfig]:
+    """
+    Load sites from a JSON config file, e.g.:
+
+        {"controllers": [{"host": "unifi", "username": "...", "password": "...",
+                          "services": ["network", "protect"],
+                          "poll": {"stat/device": 10, "stat/health": 60},
+                          "sites": ["default", {"site": "branch", "prefix": "b"}]}]}
+    """
+    with open(path, "r") as fp:
+        data = json.load(fp)
+
+    sites = []
+    for controller in data.get("controllers", []):
+        for site in controller.get("sites", [UNIFI_DEFAULT_SITE]):
+            if isinstance(site, str):
+                site = {"site": site}
+            sites.append(
+                SiteConfig(
+                    host=controller.get("host", UNIFI_DEFAULT_HOST),
+                    port=controller.get("port", UNIFI_DEFAULT_PORT),
+                    username=controller.get("username", UNIFI_DEFAULT_USERNAME),
+                    password=controller.get("password", UNIFI_DEFAULT_PASSWORD),
+                    site=site["site"],
+                    services=list(
+                        site.get("services", controller.get("services", ["network"]))
+                    ),
+                    verify_ssl=controller.get("verify_ssl", True),
+                    prefix=site.get("prefix"),
+                    poll=dict(site.get("poll", controller.get("poll", {}))),
+                )
+            )
+    return finalize_sites(sites)
+
+
+def finalize_sites(sites: List[SiteConfig]) -> List[SiteConfig]:
+    if not sites:
+        raise ConfigError("no sites configured")
+
+    hosts = set()
+    for site in sites:
+        unknown = set(site.poll) - set(ENDPOINTS)
+        if unknown:
+            raise ConfigError(f"unknown poll endpoints: {', '.join(sorted(unknown))}")
+        if (site.host, site.port) in hosts:
+            site.services = [s for s in site.services if s not in HOST_SERVICES]
+        else:
+            hosts.add((site.host, site.port))
+        if site.prefix is None:
+            site.prefix = site.site if len(sites) > 1 else ""
+
+    prefixes = [site.prefix for site in sites]
+    if len(set(prefixes)) != len(prefixes):
+        raise ConfigError("sites must have unique topic prefixes")
+    return sites
+
+
+def build_controllers(
+    sites: List[SiteConfig],
+    pool: "SessionPool",
+    state: Optional[StateStore] = None,
+    recorder: Optional[FrameRecorder] = None,
+    heartbeat: float = UNIFI_DEFAULT_HEARTBEAT,
+    shedder: Optional[LoadShedder] = None,
+) -> List["UnifiController"]:
+    # imported here, as loading configs shouldn't load aiohttp
+    from .unifi.controller import UnifiController
+
+    return [
+        UnifiController(
+            host=site.host,
+            port=site.port,
+            username=site.username,
+            password=site.password,
+            site=site.site,
+            verify_ssl=site.verify_ssl,
+            # aiohttp's cookie jar ignores cookies from IP addresses unless unsafe
+            use_unsafe_cookie_jar=is_ip_address(site.host),
+            services=site.services,
+            state=state,
+            recorder=recorder,
+            pool=pool,
+            topic_prefix=f"{site.prefix}/" if site.prefix else "",
+            poll=site.poll,
+            heartbeat=heartbeat,
+            shedder=shedder,
+        )
+        for site in sites
+    ]
@@ -3,9 +3,88 @@ UNIFI_DEFAULT_PORT = 443
 UNIFI_DEFAULT_USERNAME = "admin"
 UNIFI_DEFAULT_PASSWORD = "ubnt"
 UNIFI_DEFAULT_SITE = "default"
+UNIFI_DEFAULT_RECONNECT_INITIAL = 1.0
+UNIFI_DEFAULT_RECONNECT_MAX = 60.0
+UNIFI_DEFAULT_HEARTBEAT = 15.0
 
 MQTT_DEFAULT_HOST = "localhost"
 MQTT_DEFAULT_PORT = 1883
 MQTT_DEFAULT_NAME = "unifi"
 MQTT_DEFAULT_USERNAME = "mqtt"
 MQTT_DEFAULT_PASSWORD = "mqtt"
+MQTT_DEFAULT_EVENT_QOS = 0
+MQTT_DEFAULT_STATE_QOS = 1
+MQTT_DEFAULT_COALESCE_INTERVAL = 0.25
+
+PIPELINE_DEFAULT_QUEUE_SIZE = 1000
+PIPELINE_DEFAULT_OVERFLOW_POLICY = "block"
+PIPELINE_DEFAULT_PUBLISH_WORKERS = 4
+# how full a queue gets (as a fraction) before low priority frames are shed
+PIPELINE_DEFAULT_SHED_WATERMARK = 0.8
+
+FORMAT_CACHE_SIZE = 4096
+
+STATE_DEFAULT_FILE = "unifi-mqtt-state.json"
+STATE_DEFAULT_FLUSH_INTERVAL = 5.0
+
+SPOOL_DEFAULT_DIR = "unifi-mqtt-spool"
+SPOOL_DEFAULT_SEGMENT_SIZE = 8 * 1024 * 1024
+SPOOL_DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+SPOOL_DEFAULT_MAX_AGE = 24 * 60 * 60
+SPOOL_DEFAULT_DRAIN_BATCH = 100
+SPOOL_DEFAULT_DRAIN_RATE = 500
+
+SUPERVISOR_DEFAULT_WORKERS = 1
+SUPERVISOR_HASH_REPLICAS = 64
+SUPERVISOR_STATS_INTERVAL = 10.0
+# a worker which stays up this long has its restart backoff reset
+SUPERVISOR_STABLE_AFTER = 60.0
+SUPERVISOR_STOP_TIMEOUT = 15.0
+
+METRICS_DEFAULT_HOST = "127.0.0.1"
+# how long a scrape waits for the event loop to collect values
+METRICS_COLLECT_TIMEOUT = 5.0
+
+COMMAND_DEFAULT_CONCURRENCY = 4
+# commands for the same action arriving within this window share a request
+COMMAND_DEFAULT_BATCH_WINDOW = 0.05
+
+POLL_DEFAULT_INTERVAL = 30.0
+
+# disconnected clients are forgotten once they've been gone this long
+CLIENTS_DEFAULT_TTL = 24 * 60 * 60
+CLIENTS_EXPIRE_INTERVAL = 60.0
+
+# how long a client's connect/disconnect must hold before it's published
+DEBOUNCE_DEFAULT_WINDOW = 0.0
+DEBOUNCE_TICK = 0.1
+
+DISCOVERY_DEFAULT_PREFIX = "homeassistant"
+# how long a momentary binary sensor (door unlock, doorbell) stays on
+DISCOVERY_OFF_DELAY = 5
+# how many announced entities are remembered (and persisted); past that the
+# least recently announced are forgotten, and re-announced if seen again
+DISCOVERY_MAX_ENTITIES = 10_000
+
+# how long an event is remembered for dropping redelivered duplicates
+DEDUP_DEFAULT_WINDOW = 300.0
+DEDUP_BUCKETS = 10
+DEDUP_MAX_KEYS = 100_000
+# an access log and the capture taken for it land within this many ms
+DEDUP_ACCESS_WINDOW_MS = 2000
+
+MEDIA_DEFAULT_DIR = "unifi-mqtt-media"
+MEDIA_DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+MEDIA_DEFAULT_CONCURRENCY = 2
+MEDIA_DEFAULT_QUEUE_SIZE = 100
+
+# events waiting for each queued (not direct) controller event handler
+BUS_DEFAULT_QUEUE_SIZE = 1000
+
+# how often summary topics are published (0 disables them), and the span of
+# their sliding window
+AGGREGATE_DEFAULT_INTERVAL = 0.0
+AGGREGATE_DEFAULT_WINDOW = 900.0
+
+# how long shutdown waits for in-flight messages to be published
+SHUTDOWN_DRAIN_TIMEOUT = 10.0
@@ -0,0 +1,164 @@
+"""
+Home Assistant MQTT discovery for the topics the translator publishes.
+
+Each entity's config is published (retained) the first time its topic is
+seen, and again only if its name changes. What's been announced is kept in
+the state store, so restarts and reconnects don't re-send every config. A
+forgotten client's config is cleared, which removes its entity.
+"""
+
+import re
+
+from typing import Callable, Dict, Optional, Tuple
+
+from . import codec
+from .constants import (
+    DISCOVERY_DEFAULT_PREFIX,
+    DISCOVERY_MAX_ENTITIES,
+    DISCOVERY_OFF_DELAY,
+)
+from .state import StateStore
+
+OBJECT_ID_RE = re.compile(r"[^a-zA-Z0-9_-]+")
+
+TRACKER = {
+    "source_type": "router",
+    "payload_home": "home",
+    "payload_not_home": "not_home",
+    "value_template": "{{ 'home' if value_json.connected else 'not_home' }}",
+}
+DOOR = {
+    "device_class": "lock",
+    "value_template": "{{ 'ON' if value_json.success else 'OFF' }}",
+    "off_delay": DISCOVERY_OFF_DELAY,
+}
+MOTION = {
+    "device_class": "motion",
+    "value_template": "{{ 'ON' if value_json.active else 'OFF' }}",
+}
+DOORBELL = {
+    "value_template": "{{ 'ON' if value_json.active else 'OFF' }}",
+    "off_delay": DISCOVERY_OFF_DELAY,
+}
+
+# (component, name, config) for an entity
+Entity = Tuple[str, str, dict]
+
+
+def client_entity(event_name, event, payload) -> Optional[Entity]:
+    client = payload["client"]
+    return "device_tracker", client.get("hostname") or client["mac"], TRACKER
+
+
+def door_entity(event_name, event, payload) -> Optional[Entity]:
+    # the same unlock is also published by target path; announce it once
+    if not event.topic.startswith("device/"):
+        return None
+    name = payload["device_id"]
+    for target in payload["data"]["_source"].get("target", ()):
+        if target.get("type") == "door":
+            name = target["display_name"]
+            break
+    return "binary_sensor", f"{name} unlock", DOOR
+
+
+# protect event -> (name suffix, config)
+CAMERA_ENTITIES = {
+    "motion": ("motion", MOTION),
+    "ring": ("doorbell", DOORBELL),
+    "smart_detect": ("smart detection", MOTION),
+}
+
+
+def camera_entity(event_name, event, payload) -> Optional[Entity]:
+    suffix, config = CAMERA_ENTITIES[event_name]
+    return "binary_sensor", f"{payload['camera']} {suffix}", config
+
+
+EntityBuilder = Callable[[str, object, dict], Optional[Entity]]
+
+ENTITIES: Dict[Tuple[str, str], EntityBuilder] = {
+    ("network", "client:update"): client_entity,
+    ("access", "access.logs.add"): door_entity,
+    **{("protect", event): camera_entity for event in CAMERA_ENTITIES},
+}
+
+# events removing an entity -> its component
+REMOVALS: Dict[Tuple[str, str], str] = {
+    ("network", "client:remove"): "device_tracker",
+}
+
+
+class Discovery:
+    def __init__(
+        self,
+        name: str,
+        state: StateStore,
+        prefix: str = DISCOVERY_DEFAULT_PREFIX,
+        max_entities: int = DISCOVERY_MAX_ENTITIES,
+    ):
+        # our MQTT name, which prefixes every state topic
+        self.name = name
+        self.node_id = OBJECT_ID_RE.sub("_", name)
+        self.prefix = prefix
+        self.state = state
+        self.max_entities = max_entities
+
+        # state topic -> the entity name last announced for it, least recently
+        # announced first
+        state_key = f"discovery/{prefix}/{self.node_id}"
+        self.announced = state.get(state_key) or {}
+        state.set(state_key, self.announced)
+
+    def announce(
+        self, service_name: str, event_name: str, payload: dict, topic: str, event
+    ) -> Optional[Tuple[str, bytes, str]]:
+        """
+        Return the discovery message for an event's entity, if it hasn't
+        already been announced.
+        """
+        component = REMOVALS.get((service_name, event_name))
+        if component is not None:
+            return self.remove(component, topic)
+        builder = ENTITIES.get((service_name, event_name))
+        if builder is None:
+            return None
+        entity = builder(event_name, event, payload)
+        if entity is None:
+            return None
+        component, name, config = entity
+        if self.announced.get(topic) == name:
+            return None
+
+        object_id = OBJECT_ID_RE.sub("_", topic)
+        state_topic = f"{self.name}/{topic}"
+        message = codec.dumps(
+            {
+                "name": name,
+                "unique_id": f"{self.node_id}_{object_id}",
+                "object_id": f"{self.node_id}_{object_id}",
+                "state_topic": state_topic,
+                "json_attributes_topic": state_topic,
+                **config,
+            }
+        )
+        self.announced.pop(topic, None)
+        self.announced[topic] = name
+        while len(self.announced) > self.max_entities:
+            del self.announced[next(iter(self.announced))]
+        self.state.mark_dirty()
+        return self.config_topic(component, topic), message, "discovery"
+
+    def remove(self, component: str, topic: str) -> Optional[Tuple[str, bytes, str]]:
+        """
+        Return the message clearing an announced entity's config.
+        """
+        if self.announced.pop(topic, None) is None:
+            return None
+        self.state.mark_dirty()
+        # an empty retained config deletes the entity
+        return self.config_topic(component, topic), b"", "discovery"
+
+    def config_topic(self, component: str, topic: str) -> str:
+        object_id = OBJECT_ID_RE.sub("_", topic)
+        return f"{self.prefix}/{component}/{self.node_id}/{object_id}/config"
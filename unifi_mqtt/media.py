@@ -0,0 +1,245 @@
+"""
+Fetches the images behind Access captures and Protect events.
+
+Fetching is kept off the publish path: the translator hands each event over
+once its messages are queued, a small pool of downloaders fetches the image
+through the controller's shared session, and the result is queued on the
+same publish shard as the event, so it always follows it. Images are kept in
+a size-capped LRU directory, so a redelivered event is never fetched twice.
+"""
+
+import asyncio
+import logging
+import os
+import re
+import threading
+
+from collections import OrderedDict
+from enum import Enum
+from pathlib import Path
+from time import perf_counter
+from typing import TYPE_CHECKING, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from . import codec, metrics
+from .constants import (
+    MEDIA_DEFAULT_CONCURRENCY,
+    MEDIA_DEFAULT_MAX_BYTES,
+    MEDIA_DEFAULT_QUEUE_SIZE,
+)
+from .pipeline import BoundedQueue, OverflowPolicy
+
+if TYPE_CHECKING:
+    from .unifi.controller import UnifiController
+
+logger = logging.getLogger("unifi_mqtt.media")
+
+FILENAME_RE = re.compile(r"[^a-zA-Z0-9_.-]+")
+
+
+class MediaMode(Enum):
+    # publish the image itself
+    BINARY = "binary"
+    # publish where the cached image can be found
+    URL = "url"
+
+
+class MediaCache:
+    """
+    A directory of images, least recently used first out once it's over
+    ``max_bytes``. Thread safe, so files can be written from an executor.
+    """
+
+    def __init__(self, path: str, max_bytes: int = MEDIA_DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.size = 0
+        # filename -> size, oldest first
+        self.files = OrderedDict()
+        self._lock = threading.Lock()
+
+        os.makedirs(path, exist_ok=True)
+        for entry in sorted(os.scandir(path), key=lambda e: e.stat().st_mtime):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                self.files[entry.name] = entry.stat().st_size
+                self.size += self.files[entry.name]
+        self._evict()
+
+    def get(self, name: str) -> Optional[str]:
+        with self._lock:
+            if name not in self.files:
+                return None
+            self.files.move_to_end(name)
+        return os.path.join(self.path, name)
+
+    def read(self, name: str) -> Optional[bytes]:
+        path = self.get(name)
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as fp:
+                return fp.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, name: str, data: bytes) -> str:
+        path = os.path.join(self.path, name)
+        # written aside and renamed, so a reader never sees a partial image
+        with open(path + ".tmp", "wb") as fp:
+            fp.write(data)
+        os.replace(path + ".tmp", path)
+        with self._lock:
+            self.size += len(data) - self.files.pop(name, 0)
+            self.files[name] = len(data)
+            self._evict()
+        return path
+
+    def _evict(self):
+        while self.size > self.max_bytes and len(self.files) > 1:
+            name, size = self.files.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+
+
+def protect_thumbnail(event_name: str, payload: dict) -> Optional[Tuple[str, str]]:
+    # the thumbnail covers the whole event, so wait for it to end
+    if not payload.get("end"):
+        return None
+    event_id = payload["id"]
+    return event_id, f"/proxy/protect/api/events/{event_id}/thumbnail"
+
+
+def access_capture(event_name: str, payload: dict) -> Optional[Tuple[str, str]]:
+    data = payload["data"]
+    # the capture's image path on the controller
+    path = data["_source"].get("thumbnail")
+    if not path:
+        return None
+    return data["_id"], path
+
+
+# (service, event) -> the (id, path) of an event's image, if it has one
+SOURCES: Dict[Tuple[str, str], Callable[[str, dict], Optional[Tuple[str, str]]]] = {
+    ("access", "access.capture.add"): access_capture,
+    ("protect", "motion"): protect_thumbnail,
+    ("protect", "ring"): protect_thumbnail,
+    ("protect", "smart_detect"): protect_thumbnail,
+}
+
+# (event topic, topic, payload, kind, received) -> queued after the event
+Publish = Callable[[str, str, bytes, str, float], Awaitable[None]]
+
+
+class MediaFetcher:
+    def __init__(
+        self,
+        controllers: List["UnifiController"],
+        cache: MediaCache,
+        mode: MediaMode = MediaMode.BINARY,
+        concurrency: int = MEDIA_DEFAULT_CONCURRENCY,
+        queue_size: int = MEDIA_DEFAULT_QUEUE_SIZE,
+        url_base: Optional[str] = None,
+    ):
+        # topic prefix -> controller, to fetch through the right session
+        self.controllers = {c.topic_prefix: c for c in controllers}
+        self.cache = cache
+        self.mode = mode
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        # where the cache directory is served from; otherwise file:// URLs
+        self.url_base = url_base
+
+        self.publish = None
+        self.queue = None
+        self.tasks = []
+
+    async def start(self, publish: Publish):
+        self.publish = publish
+        # when images can't be fetched fast enough, the oldest are skipped
+        self.queue = BoundedQueue("media", self.queue_size, OverflowPolicy.DROP_OLDEST)
+        self.tasks = [
+            asyncio.ensure_future(self._fetch_worker()) for _ in range(self.concurrency)
+        ]
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def submit(
+        self,
+        service_name: str,
+        event_name: str,
+        payload: dict,
+        prefix: str,
+        messages: list,
+        received: float,
+    ):
+        """
+        Queue the image for an event whose ``messages`` have been queued.
+        """
+        source = SOURCES.get((service_name, event_name))
+        if source is None or not messages:
+            return
+        try:
+            image = source(event_name, payload)
+        except (KeyError, TypeError):
+            return
+        if image is None:
+            return
+        event_id, path = image
+        name = FILENAME_RE.sub("_", f"{prefix}{service_name}-{event_id}") + ".jpg"
+        # the event's own message comes after any discovery config
+        event_topic, _, kind = messages[-1]
+        if kind == "rerouted":
+            return
+        self.queue.put_nowait((prefix, path, name, event_id, event_topic, received))
+
+    async def _fetch_worker(self):
+        queue = self.queue
+        loop = asyncio.get_event_loop()
+        while True:
+            prefix, path, name, event_id, event_topic, received = await queue.get()
+            try:
+                await self.fetch(
+                    loop, prefix, path, name, event_id, event_topic, received
+                )
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                metrics.MEDIA_FETCHES.labels("error").inc()
+                logger.warning("media.fetch-failed %s: %s", path, exc)
+            queue.task_done()
+
+    async def fetch(self, loop, prefix, path, name, event_id, event_topic, received):
+        cached = self.cache.get(name)
+        if cached is not None:
+            metrics.MEDIA_FETCHES.labels("cached").inc()
+            if self.mode is MediaMode.BINARY:
+                data = await loop.run_in_executor(None, self.cache.read, name)
+                if data is None:
+                    return
+        else:
+            started = perf_counter()
+            response = await self.controllers[prefix].get(path)
+            data = await response.read()
+            metrics.MEDIA_FETCH_SECONDS.observe(perf_counter() - started)
+            metrics.MEDIA_FETCHES.labels("ok").inc()
+            # disk writes happen off the loop
+            cached = await loop.run_in_executor(None, self.cache.put, name, data)
+
+        if self.mode is MediaMode.BINARY:
+            payload = data
+        else:
+            payload = codec.dumps({"event_id": event_id, "url": self.url_for(cached)})
+        await self.publish(
+            event_topic, f"{event_topic}/image", payload, "media", received
+        )
+
+    def url_for(self, path: str) -> str:
+        if self.url_base:
+            return f"{self.url_base.rstrip('/')}/{os.path.basename(path)}"
+        return Path(path).resolve().as_uri()
@@ -0,0 +1,429 @@
+"""
+A small metrics registry rendered in the Prometheus text format.
+
+Labelled metrics are resolved to a child once (e.g.
+``FRAMES.labels("network")``) and callers keep the child, so recording a
+sample is just an attribute update: no string formatting, and no locking as
+everything is updated from the event loop. Scrapes are served from a
+background thread, which hands collection back to the loop (see
+``App.call_in_loop``).
+"""
+
+import bisect
+import logging
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Iterable, List, Optional, Sequence, Tuple
+
+from . import codec
+
+logger = logging.getLogger("unifi_mqtt.metrics")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+)
+
+Labels = Tuple[Tuple[str, str], ...]
+Sample = Tuple[str, Labels, float]
+# (name, type, help, samples)
+Family = Tuple[str, str, str, List[Sample]]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        # called before each collection, to refresh values read from elsewhere
+        self.collectors = []
+
+    def register(self, metric: "Metric"):
+        self.metrics.append(metric)
+
+    def add_collector(self, callback: Callable[[], None]):
+        self.collectors.append(callback)
+
+    def remove_collector(self, callback: Callable[[], None]):
+        self.collectors.remove(callback)
+
+    def collect(self) -> List[Family]:
+        for callback in list(self.collectors):
+            try:
+                callback()
+            except Exception:
+                logger.exception("metrics.collector-error")
+        return [metric.collect() for metric in self.metrics]
+
+
+REGISTRY = Registry()
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class _GaugeChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum")
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        # the last count is the implicit +Inf bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        registry: Optional[Registry] = None,
+    ):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.children = {}
+        (registry or REGISTRY).register(self)
+
+    def labels(self, *values: str):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self, labels: Labels, child) -> Iterable[Sample]:
+        yield self.name, labels, child.value
+
+    def collect(self) -> Family:
+        samples = []
+        for values, child in list(self.children.items()):
+            samples.extend(self._samples(tuple(zip(self.label_names, values)), child))
+        return self.name, self.type, self.help, samples
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, *args, buckets: Sequence[float] = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def _samples(self, labels: Labels, child) -> Iterable[Sample]:
+        counts = list(child.counts)
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            total += count
+            yield f"{self.name}_bucket", labels + (("le", _format_value(bound)),), total
+        yield f"{self.name}_sum", labels, child.sum
+        yield f"{self.name}_count", labels, total
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, bool):
+        return str(int(value))
+    return repr(value)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def add_labels(families: List[Family], labels: Labels) -> List[Family]:
+    return [
+        (name, type, help, [(s, labels + l, v) for s, l, v in samples])
+        for name, type, help, samples in families
+    ]
+
+
+def render(families: List[Family]) -> str:
+    """
+    Render families in the Prometheus text format, merging any which share a
+    name (e.g. the same metric collected from several workers).
+    """
+    merged = {}
+    for name, type, help, samples in families:
+        if name in merged:
+            merged[name][2].extend(samples)
+        else:
+            merged[name] = (type, help, list(samples))
+
+    lines = []
+    for name, (type, help, samples) in merged.items():
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {type}")
+        for sample_name, labels, value in samples:
+            if labels:
+                label_str = ",".join(f'{k}="{_escape(v)}"' for k, v in labels)
+                lines.append(f"{sample_name}{{{label_str}}} {_format_value(value)}")
+            else:
+                lines.append(f"{sample_name} {_format_value(value)}")
+    lines.append("")
+    return "\n".join(lines)
+
+
+class MetricsServer:
+    """
+    Serves ``/metrics`` (and optionally ``/health`` as JSON) from a thread, so
+    handling a scrape never blocks the event loop.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        collect: Callable[[], List[Family]] = REGISTRY.collect,
+        health: Optional[Callable[[], dict]] = None,
+    ):
+        self.host = host
+        self.port = port
+        self.collect = collect
+        self.health = health
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body = render(server.collect()).encode("utf-8")
+                    content_type = CONTENT_TYPE
+                elif self.path == "/health" and server.health is not None:
+                    body = codec.dumps(server.health())
+                    content_type = "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, name="metrics", daemon=True
+        )
+        self.thread.start()
+        logger.info("metrics.listening: %s:%d", self.host, self.server.server_port)
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+FRAMES = Counter("unifi_mqtt_frames_total", "Websocket frames received.", ["service"])
+FRAME_ERRORS = Counter(
+    "unifi_mqtt_frame_errors_total",
+    "Websocket frames which failed to decode or handle.",
+    ["service"],
+)
+DECODE_SECONDS = Histogram(
+    "unifi_mqtt_decode_seconds", "Time to decode a websocket frame.", ["service"]
+)
+SERIALIZE_SECONDS = Histogram(
+    "unifi_mqtt_serialize_seconds",
+    "Time to serialize an event into MQTT messages.",
+    ["service"],
+)
+PUBLISH_LATENCY = Histogram(
+    "unifi_mqtt_publish_latency_seconds",
+    "Time from an event being emitted to its message being published.",
+)
+BROKER_RTT = Histogram(
+    "unifi_mqtt_broker_rtt_seconds",
+    "Time for the broker to acknowledge a QoS 1 or 2 publish.",
+)
+MESSAGES = Counter("unifi_mqtt_messages_total", "Messages published.", ["kind"])
+MESSAGES_SPOOLED = Counter(
+    "unifi_mqtt_messages_spooled_total",
+    "Messages spooled to disk while the broker was unreachable.",
+)
+MESSAGES_LOST = Counter(
+    "unifi_mqtt_messages_lost_total",
+    "Messages dropped while the broker was unreachable.",
+)
+UNKNOWN_EVENTS = Counter(
+    "unifi_mqtt_unknown_events_total",
+    "Events with no serializer.",
+    ["service"],
+)
+SERIALIZE_ERRORS = Counter(
+    "unifi_mqtt_serialize_errors_total",
+    "Events whose serializer raised.",
+    ["service"],
+)
+QUEUE_DEPTH = Gauge("unifi_mqtt_queue_depth", "Items waiting in a queue.", ["queue"])
+QUEUE_DROPPED = Counter(
+    "unifi_mqtt_queue_dropped_total", "Items dropped by a full queue.", ["queue"]
+)
+QUEUE_COALESCED = Counter(
+    "unifi_mqtt_queue_coalesced_total",
+    "Items replaced by a newer item with the same key.",
+    ["queue"],
+)
+RECONNECTS = Counter(
+    "unifi_mqtt_reconnects_total", "Websocket reconnect attempts.", ["service"]
+)
+BROKER_RECONNECTS = Counter(
+    "unifi_mqtt_broker_reconnects_total", "MQTT broker reconnect attempts."
+)
+BROKER_CONNECTED = Gauge(
+    "unifi_mqtt_broker_connected", "Whether the MQTT broker is connected."
+)
+SPOOL_BYTES = Gauge("unifi_mqtt_spool_bytes", "Bytes waiting in the disk spool.")
+LOGINS = Counter("unifi_mqtt_logins_total", "Successful controller logins.")
+WORKERS_ALIVE = Gauge("unifi_mqtt_workers_alive", "Worker processes running.")
+WORKER_RESTARTS = Counter(
+    "unifi_mqtt_worker_restarts_total", "Worker processes restarted after exiting."
+)
+REAUTHS = Counter("unifi_mqtt_reauths_total", "Logins forced by a rejected request.")
+COMMANDS = Counter(
+    "unifi_mqtt_commands_total",
+    "Commands received over MQTT, by result.",
+    ["service", "action", "result"],
+)
+COMMAND_REQUESTS = Counter(
+    "unifi_mqtt_command_requests_total",
+    "Controller requests made to carry out commands.",
+    ["service", "action"],
+)
+POLLS = Counter(
+    "unifi_mqtt_polls_total", "REST polls, by result.", ["endpoint", "result"]
+)
+POLL_CHANGES = Counter(
+    "unifi_mqtt_poll_changes_total",
+    "Entities which changed between polls.",
+    ["endpoint"],
+)
+DEBOUNCED = Counter(
+    "unifi_mqtt_debounced_events_total",
+    "Client connect/disconnect events suppressed as flaps or superseded.",
+)
+DUPLICATES = Counter(
+    "unifi_mqtt_duplicate_events_total",
+    "Events dropped as duplicates of one recently seen.",
+    ["service"],
+)
+MEDIA_FETCHES = Counter(
+    "unifi_mqtt_media_fetches_total",
+    "Event images fetched, by result (ok, cached or error).",
+    ["result"],
+)
+MEDIA_FETCH_SECONDS = Histogram(
+    "unifi_mqtt_media_fetch_seconds", "Time to download an event image."
+)
+MEDIA_CACHE_BYTES = Gauge(
+    "unifi_mqtt_media_cache_bytes", "Bytes of event images cached on disk."
+)
+HANDLER_LAG = Histogram(
+    "unifi_mqtt_handler_lag_seconds",
+    "Time an event waits in a controller event handler's queue.",
+    ["handler"],
+)
+HANDLER_ERRORS = Counter(
+    "unifi_mqtt_handler_errors_total",
+    "Controller event handler calls which raised.",
+    ["handler"],
+)
+HANDLER_DROPPED = Counter(
+    "unifi_mqtt_handler_dropped_total",
+    "Events dropped by a controller event handler's full queue.",
+    ["handler"],
+)
+FILTERED_EVENTS = Counter(
+    "unifi_mqtt_filtered_events_total",
+    "Events dropped by a routing rule.",
+    ["service"],
+)
+FRAMES_SKIPPED = Counter(
+    "unifi_mqtt_frames_skipped_total",
+    "Websocket frames for ignored messages, skipped without decoding.",
+    ["service"],
+)
+FRAMES_SHED = Counter(
+    "unifi_mqtt_frames_shed_total",
+    "Low priority websocket frames shed while the pipeline was backed up.",
+    ["service", "message"],
+)
@@ -1,18 +1,54 @@
+import asyncio
 import logging
 
-from asyncio_mqtt import Client
+from asyncio_mqtt import Client, MqttError
+from dataclasses import dataclass
+from paho.mqtt.client import topic_matches_sub
+from time import perf_counter
+from typing import Callable, Dict, Optional
 
+from . import metrics
+from .backoff import Backoff
 from .constants import (
     MQTT_DEFAULT_PORT,
     MQTT_DEFAULT_NAME,
     MQTT_DEFAULT_USERNAME,
     MQTT_DEFAULT_PASSWORD,
+    MQTT_DEFAULT_COALESCE_INTERVAL,
+    SPOOL_DEFAULT_DRAIN_BATCH,
+    SPOOL_DEFAULT_DRAIN_RATE,
 )
-
+from .spool import Spool
 
 logger = logging.getLogger("unifi_mqtt.mqtt")
 
 
+@dataclass
+class TopicClass:
+    qos: int = 0
+    retain: bool = False
+    # only publish the latest of several queued updates to the same topic
+    coalesce: bool = False
+    # publish the topic as given, rather than under our name
+    absolute: bool = False
+
+
+DEFAULT_TOPIC_CLASSES = {
+    # one-off occurrences (a door unlock, a motion event)
+    "event": TopicClass(qos=0, retain=False, coalesce=False),
+    # the current state of something, which late subscribers should see
+    "state": TopicClass(qos=1, retain=True, coalesce=True),
+    # replies to commands, which the sender is waiting on
+    "response": TopicClass(qos=1, retain=False, coalesce=False),
+    # event images, which follow their event
+    "media": TopicClass(qos=0, retain=False, coalesce=False),
+    # messages a rule has rerouted outside our name
+    "rerouted": TopicClass(qos=0, retain=False, coalesce=False, absolute=True),
+    # Home Assistant discovery configs, under the discovery prefix
+    "discovery": TopicClass(qos=1, retain=True, coalesce=False, absolute=True),
+}
+
+
 class Mqtt:
     def __init__(
         self,
@@ -21,33 +57,249 @@ class Mqtt:
         username: str = MQTT_DEFAULT_USERNAME,
         password: str = MQTT_DEFAULT_PASSWORD,
         name: str = MQTT_DEFAULT_NAME,
+        topic_classes: Optional[Dict[str, TopicClass]] = None,
+        coalesce_interval: float = MQTT_DEFAULT_COALESCE_INTERVAL,
+        spool: Optional[Spool] = None,
+        drain_batch: int = SPOOL_DEFAULT_DRAIN_BATCH,
+        drain_rate: float = SPOOL_DEFAULT_DRAIN_RATE,
     ):
         self.username = username
         self.password = password
         self.host = host
         self.port = port
         self.name = name
+        self.topic_classes = {**DEFAULT_TOPIC_CLASSES, **(topic_classes or {})}
+        self.coalesce_interval = coalesce_interval
 
         self.self = None
 
-        self.client = Client(
+        # messages which can't be published are written here and replayed,
+        # at no more than `drain_rate` per second, once the broker is back
+        self.spool = spool
+        self.drain_batch = drain_batch
+        self.drain_rate = drain_rate
+
+        self.client = None
+        self.is_connected = False
+        self.is_closed = False
+        self.backoff = Backoff(maximum=30)
+
+        # full topic -> (payload, topic class) awaiting the next flush
+        self.pending = {}
+        self.coalesced = 0
+        self.lost = 0
+        # retained topics published live since we (re)connected, which must
+        # not be overwritten by older values replayed from the spool
+        self.live_retained = set()
+        # full topic filter -> (callback, qos)
+        self.subscriptions = {}
+
+        self._has_pending = None
+        self._flush_task = None
+        self._reconnect_task = None
+        self._drain_task = None
+        self._listen_task = None
+
+    async def connect(self):
+        self.is_closed = False
+        self._has_pending = asyncio.Event()
+        self._flush_task = asyncio.ensure_future(self._flush_loop())
+        try:
+            await self._connect()
+        except MqttError as exc:
+            # keep going; messages are spooled until the broker is reachable
+            logger.warning("mqtt.connect-failed: %s", exc)
+            self._schedule_reconnect()
+
+    async def close(self):
+        self.is_closed = True
+        tasks = [
+            t
+            for t in (
+                self._flush_task,
+                self._reconnect_task,
+                self._drain_task,
+                self._listen_task,
+            )
+            if t is not None
+        ]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.flush()
+        if self.is_connected:
+            self.is_connected = False
+            await self.client.disconnect()
+        if self.spool is not None:
+            self.spool.close()
+
+    async def _connect(self):
+        # asyncio_mqtt clients can't be reused once disconnected
+        client = Client(
             hostname=self.host,
             port=self.port,
             username=self.username,
             password=self.password,
         )
+        await client.connect()
+        self.client = client
+        self.is_connected = True
+        self.backoff.reset()
+        self.live_retained.clear()
+        logger.info("mqtt.connected")
 
-    async def connect(self):
-        await self.client.connect()
+        if self.subscriptions:
+            self._listen_task = asyncio.ensure_future(self._listen(client))
 
-    async def close(self):
-        await self.client.disconnect()
+        if self.spool is not None and self.spool.pending():
+            if self._drain_task is None or self._drain_task.done():
+                self._drain_task = asyncio.ensure_future(self._drain())
+
+    def _on_disconnect(self, exc: BaseException):
+        if not self.is_connected:
+            return
+        self.is_connected = False
+        logger.warning("mqtt.disconnected: %s", exc)
+        self._schedule_reconnect()
+
+    def _schedule_reconnect(self):
+        if self.is_closed:
+            return
+        if self._reconnect_task is None or self._reconnect_task.done():
+            self._reconnect_task = asyncio.ensure_future(self._reconnect_loop())
+
+    async def _reconnect_loop(self):
+        while not self.is_connected and not self.is_closed:
+            await asyncio.sleep(self.backoff.next())
+            metrics.BROKER_RECONNECTS.inc()
+            try:
+                await self._connect()
+            except MqttError as exc:
+                logger.warning("mqtt.connect-failed: %s", exc)
 
-    async def publish(self, topic, payload):
+    async def subscribe(
+        self, topic: str, callback: Callable[[str, bytes], None], qos: int = 1
+    ):
+        """
+        Call ``callback(topic, payload)`` for each message on ``topic`` (which
+        may contain wildcards), relative to our name like published topics.
+        """
         full_topic = f"{self.name}/{topic}"
-        logger.info("mqtt.publish %s", full_topic)
+        self.subscriptions[full_topic] = (callback, qos)
+        if not self.is_connected:
+            return
+        if self._listen_task is None or self._listen_task.done():
+            self._listen_task = asyncio.ensure_future(self._listen(self.client))
+            return
+        try:
+            await self.client.subscribe(full_topic, qos)
+        except MqttError as exc:
+            self._on_disconnect(exc)
+
+    async def _listen(self, client: Client):
+        try:
+            async with client.unfiltered_messages() as messages:
+                # each connection starts a clean session, so subscribe again
+                for full_topic, (_, qos) in list(self.subscriptions.items()):
+                    await client.subscribe(full_topic, qos)
+                async for message in messages:
+                    # a retained command would otherwise run on every reconnect
+                    if message.retain:
+                        continue
+                    self._dispatch(message.topic, message.payload)
+        except MqttError as exc:
+            if client is self.client:
+                self._on_disconnect(exc)
+
+    def _dispatch(self, full_topic: str, payload: bytes):
+        topic = full_topic[len(self.name) + 1 :]
+        for topic_filter, (callback, _) in self.subscriptions.items():
+            if topic_matches_sub(topic_filter, full_topic):
+                try:
+                    callback(topic, payload)
+                except Exception:
+                    logger.exception("mqtt.subscriber-error")
+
+    async def _drain(self):
+        interval = self.drain_batch / self.drain_rate
+        while self.is_connected:
+            records, cursor = self.spool.read(self.drain_batch)
+            if not records:
+                self.spool.commit(cursor)
+                break
+            try:
+                for record in records:
+                    if record.retain and record.topic in self.live_retained:
+                        continue
+                    await self.client.publish(
+                        record.topic,
+                        record.payload,
+                        qos=record.qos,
+                        retain=record.retain,
+                    )
+            except MqttError as exc:
+                # the batch is replayed again after reconnecting
+                self._on_disconnect(exc)
+                break
+            self.spool.commit(cursor)
+            logger.info(
+                "mqtt.drained %d (%d bytes left)", len(records), self.spool.pending()
+            )
+            await asyncio.sleep(interval)
+
+    async def publish(self, topic, payload, kind="event"):
+        topic_class = self.topic_classes[kind]
+        full_topic = topic if topic_class.absolute else f"{self.name}/{topic}"
+
+        if topic_class.coalesce:
+            if full_topic in self.pending:
+                self.coalesced += 1
+            self.pending[full_topic] = (payload, topic_class)
+            self._has_pending.set()
+            return
+
+        await self._send(full_topic, payload, topic_class)
+
+    async def flush(self):
+        pending, self.pending = self.pending, {}
+        for full_topic, (payload, topic_class) in pending.items():
+            try:
+                await self._send(full_topic, payload, topic_class)
+            except Exception:
+                logger.exception("mqtt.publish-error")
+
+    async def _flush_loop(self):
+        while True:
+            await self._has_pending.wait()
+            # give further updates a moment to land on top of this one
+            await asyncio.sleep(self.coalesce_interval)
+            self._has_pending.clear()
+            await self.flush()
+
+    async def _send(self, full_topic, payload, topic_class: TopicClass):
+        if self.is_connected:
+            started = perf_counter()
+            try:
+                await self.client.publish(
+                    full_topic, payload, qos=topic_class.qos, retain=topic_class.retain
+                )
+            except MqttError as exc:
+                self._on_disconnect(exc)
+            else:
+                if topic_class.qos:
+                    # qos 0 publishes return without waiting on the broker
+                    metrics.BROKER_RTT.observe(perf_counter() - started)
+                if topic_class.retain:
+                    self.live_retained.add(full_topic)
+                return
 
-        await self.client.publish(full_topic, payload)
+        if self.spool is None:
+            self.lost += 1
+            metrics.MESSAGES_LOST.inc()
+            logger.warning("mqtt.lost %s", full_topic)
+            return
+        metrics.MESSAGES_SPOOLED.inc()
+        self.spool.append(full_topic, payload, topic_class.qos, topic_class.retain)
 
     # # The callback for when the client receives a CONNACK response from the server.
     # def _on_connect(client, userdata, flags, rc):
@@ -0,0 +1,285 @@
+import asyncio
+import math
+from collections import OrderedDict
+from enum import Enum
+from itertools import count
+from typing import Any, Dict, Hashable, List, Tuple
+
+
+class OverflowPolicy(Enum):
+    # wait for room in the queue (applies backpressure to the producer)
+    BLOCK = "block"
+    # discard the oldest pending item to make room
+    DROP_OLDEST = "drop-oldest"
+    # replace a pending item with the same key, otherwise discard the oldest
+    COALESCE = "coalesce"
+
+
+class Priority(Enum):
+    # periodic state which the next update repeats in full (e.g. sta:sync)
+    LOW = "low"
+    NORMAL = "normal"
+
+
+class BoundedQueue:
+    """
+    A bounded FIFO queue with a configurable overflow policy.
+
+    Items may be put with a ``key`` (e.g. the MQTT topic) which the ``coalesce``
+    policy uses to replace a still-pending item rather than queueing another.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        maxsize: int,
+        policy: OverflowPolicy = OverflowPolicy.BLOCK,
+    ):
+        self.name = name
+        self.maxsize = maxsize
+        self.policy = policy
+
+        self._items = OrderedDict()
+        self._seq = count()
+        self._not_empty = asyncio.Event()
+        self._not_full = asyncio.Event()
+        self._not_full.set()
+        # items put but not yet marked done by a consumer
+        self._unfinished = 0
+        self._finished = asyncio.Event()
+        self._finished.set()
+
+        self.total = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.high_water = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def full(self) -> bool:
+        return len(self._items) >= self.maxsize
+
+    def stats(self) -> dict:
+        return {
+            "depth": len(self._items),
+            "high_water": self.high_water,
+            "total": self.total,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+        }
+
+    async def put(self, item, key=None):
+        if self.policy is OverflowPolicy.BLOCK:
+            while self.full():
+                self._not_full.clear()
+                await self._not_full.wait()
+        self.put_nowait(item, key)
+
+    def put_nowait(self, item, key=None):
+        items = self._items
+        self.total += 1
+        if key is None or self.policy is not OverflowPolicy.COALESCE:
+            key = next(self._seq)
+        elif key in items:
+            items[key] = item
+            self.coalesced += 1
+            return
+
+        if len(items) >= self.maxsize:
+            if self.policy is OverflowPolicy.BLOCK:
+                raise asyncio.QueueFull
+            items.popitem(last=False)
+            self.dropped += 1
+            self.task_done()
+
+        items[key] = item
+        self._unfinished += 1
+        self._finished.clear()
+        if len(items) > self.high_water:
+            self.high_water = len(items)
+        self._not_empty.set()
+
+    async def get(self):
+        while not self._items:
+            self._not_empty.clear()
+            await self._not_empty.wait()
+        _, item = self._items.popitem(last=False)
+        self._not_full.set()
+        return item
+
+    def task_done(self):
+        self._unfinished -= 1
+        if self._unfinished <= 0:
+            self._unfinished = 0
+            self._finished.set()
+
+    async def join(self):
+        await self._finished.wait()
+
+
+class TimerWheel:
+    """
+    A hashed timing wheel.
+
+    Timers are bucketed into slots by the tick they expire on, so scheduling
+    and cancelling are O(1) dict operations and each tick only looks at one
+    slot. The owner calls ``advance`` once per ``tick`` seconds; expiry is
+    rounded up to the next tick.
+    """
+
+    def __init__(self, tick: float, horizon: float):
+        self.tick = tick
+        # enough slots that a timer within the horizon never wraps around
+        self.slots = [{} for _ in range(math.ceil(horizon / tick) + 1)]
+        # key -> expiry tick
+        self.timers = {}
+        self.current = 0
+
+    def __len__(self) -> int:
+        return len(self.timers)
+
+    def schedule(self, key: Hashable, delay: float, value: Any):
+        self.cancel(key)
+        expiry = self.current + max(1, math.ceil(delay / self.tick))
+        self.slots[expiry % len(self.slots)][key] = (expiry, value)
+        self.timers[key] = expiry
+
+    def cancel(self, key: Hashable) -> Any:
+        """
+        Cancel the timer for ``key``, returning its value (or ``None``).
+        """
+        expiry = self.timers.pop(key, None)
+        if expiry is None:
+            return None
+        return self.slots[expiry % len(self.slots)].pop(key)[1]
+
+    def get(self, key: Hashable) -> Any:
+        expiry = self.timers.get(key)
+        if expiry is None:
+            return None
+        return self.slots[expiry % len(self.slots)][key][1]
+
+    def replace(self, key: Hashable, value: Any):
+        """
+        Replace the value of a scheduled timer, keeping its expiry.
+        """
+        expiry = self.timers[key]
+        self.slots[expiry % len(self.slots)][key] = (expiry, value)
+
+    def clear(self) -> List[Tuple[Hashable, Any]]:
+        """
+        Cancel every timer, returning their (key, value) in expiry order.
+        """
+        pending = sorted(self.timers.items(), key=lambda item: item[1])
+        expired = [
+            (key, self.slots[expiry % len(self.slots)].pop(key)[1])
+            for key, expiry in pending
+        ]
+        self.timers.clear()
+        return expired
+
+    def advance(self) -> List[Tuple[Hashable, Any]]:
+        """
+        Move on one tick, returning the (key, value) of every expired timer.
+        """
+        self.current += 1
+        slot = self.slots[self.current % len(self.slots)]
+        expired = [
+            (key, value)
+            for key, (expiry, value) in slot.items()
+            if expiry <= self.current
+        ]
+        for key, _ in expired:
+            del slot[key]
+            del self.timers[key]
+        return expired
+
+
+class DedupWindow:
+    """
+    Remembers the keys seen in roughly the last ``window`` seconds.
+
+    Keys are kept (as their hashes) in a ring of sets which each cover a
+    slice of the window, and the oldest slice is cleared as time moves on, so
+    there's no per-key expiry and memory is capped at ``max_keys``. Once a
+    slice is full, further keys in it aren't remembered, so an overloaded
+    window lets duplicates through rather than growing.
+    """
+
+    def __init__(self, window: float, buckets: int, max_keys: int):
+        self.span = window / buckets
+        self.buckets = [set() for _ in range(buckets)]
+        self.bucket_size = max(1, max_keys // buckets)
+        # the slice of time (now // span) the newest bucket covers
+        self.current = None
+
+    def __len__(self) -> int:
+        return sum(len(bucket) for bucket in self.buckets)
+
+    def seen(self, key: Hashable, now: float) -> bool:
+        """
+        Return whether ``key`` was seen within the window, remembering it.
+        """
+        current = int(now // self.span)
+        if current != self.current:
+            self._rotate(current)
+        digest = hash(key)
+        for bucket in self.buckets:
+            if digest in bucket:
+                return True
+        bucket = self.buckets[current % len(self.buckets)]
+        if len(bucket) < self.bucket_size:
+            bucket.add(digest)
+        return False
+
+    def _rotate(self, current: int):
+        if self.current is None or current - self.current >= len(self.buckets):
+            for bucket in self.buckets:
+                bucket.clear()
+        else:
+            for n in range(self.current + 1, current + 1):
+                self.buckets[n % len(self.buckets)].clear()
+        self.current = current
+
+
+class LoadShedder:
+    """
+    Decides when to shed lower priority work, from how backed up the queues
+    it watches are.
+
+    A priority is shed once the fullest queue passes its watermark (a
+    fraction of the queue's size), and until that queue is back under half
+    the watermark, so shedding doesn't flap on and off at the boundary.
+    Priorities without a watermark are never shed.
+    """
+
+    def __init__(self, watermarks: Dict[Priority, float]):
+        self.watermarks = watermarks
+        self.queues: List[BoundedQueue] = []
+        # priorities currently being shed
+        self.shedding = set()
+
+    def watch(self, *queues: BoundedQueue):
+        self.queues.extend(queues)
+
+    def pressure(self) -> float:
+        """
+        Return how full the fullest watched queue is, from 0 to 1.
+        """
+        return max((len(q) / q.maxsize for q in self.queues), default=0.0)
+
+    def sheds(self, priority: Priority) -> bool:
+        watermark = self.watermarks.get(priority)
+        if watermark is None:
+            return False
+        pressure = self.pressure()
+        if priority in self.shedding:
+            if pressure < watermark / 2:
+                self.shedding.discard(priority)
+                return False
+            return True
+        if pressure >= watermark:
+            self.shedding.add(priority)
+            return True
+        return False
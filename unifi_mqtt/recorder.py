@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import struct
+
+from time import time
+from typing import Dict, Iterator, NamedTuple
+
+logger = logging.getLogger("unifi_mqtt.recorder")
+
+MAGIC = b"UMQR1\n"
+
+# timestamp, frame type (websocket opcode), service name length, data length
+FRAME_HEADER = struct.Struct("!dBBI")
+
+# websocket opcodes, matching aiohttp.WSMsgType
+TEXT = 0x1
+BINARY = 0x2
+
+
+class Frame(NamedTuple):
+    ts: float
+    service: str
+    type: int
+    data: object
+
+
+class FrameRecorder:
+    """
+    Records raw websocket frames, as received, to a compact binary file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.frames = 0
+        self._fp = open(path, "wb")
+        self._fp.write(MAGIC)
+
+    def record(self, service: str, msg_type: int, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        service_bytes = service.encode("utf-8")
+        self._fp.write(
+            FRAME_HEADER.pack(time(), int(msg_type), len(service_bytes), len(data))
+        )
+        self._fp.write(service_bytes)
+        self._fp.write(data)
+        self.frames += 1
+
+    def close(self):
+        self._fp.close()
+
+
+def read_frames(path: str) -> Iterator[Frame]:
+    with open(path, "rb") as fp:
+        if fp.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a frame recording")
+        while True:
+            header = fp.read(FRAME_HEADER.size)
+            if len(header) < FRAME_HEADER.size:
+                return
+            ts, msg_type, service_len, data_len = FRAME_HEADER.unpack(header)
+            service = fp.read(service_len).decode("utf-8")
+            data = fp.read(data_len)
+            if msg_type == TEXT:
+                data = data.decode("utf-8")
+            yield Frame(ts, service, msg_type, data)
+
+
+async def replay_frames(path: str, services: Dict[str, object], speed: float = 1.0):
+    """
+    Feed recorded frames through the matching services.
+
+    Frames are replayed with their original spacing divided by ``speed``, or
+    as fast as possible when ``speed`` is 0. Returns the number of frames fed.
+    """
+    count = 0
+    first_ts = None
+    started = time()
+    for frame in read_frames(path):
+        service = services.get(frame.service)
+        if service is None:
+            continue
+        if speed > 0:
+            if first_ts is None:
+                first_ts = frame.ts
+            delay = (frame.ts - first_ts) / speed - (time() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await service.handle_frame(frame.type, frame.data)
+        count += 1
+        if count % 1000 == 0:
+            # let the pipeline workers keep up when replaying at max speed
+            await asyncio.sleep(0)
+    return count
@@ -0,0 +1,211 @@
+"""
+Routing and filter rules, loaded from a JSON file:
+
+    {"rules": [
+        {"match": {"service": "network", "ssid": "Guest"}, "drop": true},
+        {"match": {"oui": "b8:27:eb"}, "topic": "pi/{topic}"},
+        {"match": {"door": "Front Door"}, "fields": ["success", "ts"]},
+        {"match": {"event": "ring"}, "reroute": "doorbell/{topic}"}
+    ]}
+
+The first matching rule applies. Rules are indexed by (service, event) when
+loaded, and the candidates for each (service, event) are resolved once, so
+matching an event is a dict lookup plus set membership tests on the few
+attributes its candidates ask about.
+"""
+
+import json
+
+from string import Formatter
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+from .config import ConfigError
+
+# match keys, besides service and event, tested against event attributes
+ATTRIBUTES = ("ssid", "network", "mac", "oui", "door")
+TEMPLATE_FIELDS = frozenset(["topic", "service", "event"])
+
+
+def network_attributes(payload: dict) -> dict:
+    mac = payload.get("user")
+    return {
+        "ssid": payload.get("ssid"),
+        "network": payload.get("network"),
+        "mac": mac,
+        "oui": mac[:8] if mac else None,
+    }
+
+
+def client_attributes(payload: dict) -> dict:
+    client = payload["client"]
+    mac = client["mac"]
+    return {
+        "ssid": client.get("essid"),
+        "network": client.get("network"),
+        "mac": mac,
+        "oui": mac[:8],
+    }
+
+
+def access_attributes(payload: dict) -> dict:
+    for target in payload["data"]["_source"].get("target", ()):
+        if target.get("type") == "door":
+            return {"door": target.get("display_name")}
+    return {}
+
+
+def event_attributes(service_name: str, event_name: str, payload) -> dict:
+    if not isinstance(payload, dict):
+        return {}
+    try:
+        if service_name == "network":
+            if event_name in ("client:update", "client:remove"):
+                return client_attributes(payload)
+            return network_attributes(payload)
+        if service_name == "access" and "data" in payload:
+            return access_attributes(payload)
+    except (KeyError, TypeError, AttributeError):
+        pass
+    return {}
+
+
+def _values(rule_index: int, key: str, value) -> FrozenSet[str]:
+    values = value if isinstance(value, list) else [value]
+    if not values or not all(isinstance(v, str) for v in values):
+        raise ConfigError(f"rule {rule_index}: {key} must be a string or list")
+    if key in ("mac", "oui"):
+        values = [v.lower() for v in values]
+    return frozenset(values)
+
+
+def _template(rule_index: int, template) -> str:
+    if not isinstance(template, str) or not template:
+        raise ConfigError(f"rule {rule_index}: topics must be non-empty strings")
+    for _, name, _, _ in Formatter().parse(template):
+        if name is not None and name not in TEMPLATE_FIELDS:
+            raise ConfigError(f"rule {rule_index}: unknown topic field {{{name}}}")
+    return template
+
+
+class Rule:
+    def __init__(self, index: int, spec: dict):
+        if not isinstance(spec, dict):
+            raise ConfigError(f"rule {index}: must be an object")
+        unknown = set(spec) - {"match", "drop", "topic", "fields", "reroute"}
+        if unknown:
+            raise ConfigError(
+                f"rule {index}: unknown keys {', '.join(sorted(unknown))}"
+            )
+        match = spec.get("match", {})
+        if not isinstance(match, dict):
+            raise ConfigError(f"rule {index}: match must be an object")
+        unknown = set(match) - {"service", "event", *ATTRIBUTES}
+        if unknown:
+            raise ConfigError(
+                f"rule {index}: unknown match keys {', '.join(sorted(unknown))}"
+            )
+
+        self.index = index
+        self.services = (
+            _values(index, "service", match["service"]) if "service" in match else None
+        )
+        self.events = (
+            _values(index, "event", match["event"]) if "event" in match else None
+        )
+        # attribute -> accepted values
+        self.conditions: Tuple[Tuple[str, FrozenSet[str]], ...] = tuple(
+            (key, _values(index, key, match[key])) for key in ATTRIBUTES if key in match
+        )
+
+        self.drop = bool(spec.get("drop", False))
+        self.topic = _template(index, spec["topic"]) if "topic" in spec else None
+        self.reroute = _template(index, spec["reroute"]) if "reroute" in spec else None
+        fields = spec.get("fields")
+        if fields is not None and (
+            not isinstance(fields, list) or not all(isinstance(f, str) for f in fields)
+        ):
+            raise ConfigError(f"rule {index}: fields must be a list of strings")
+        self.fields = tuple(fields) if fields is not None else None
+
+        if self.topic and self.reroute:
+            raise ConfigError(f"rule {index}: use either topic or reroute")
+        if self.drop == bool(self.topic or self.reroute or self.fields is not None):
+            raise ConfigError(
+                f"rule {index}: either drop, or set topic, reroute and/or fields"
+            )
+
+    def matches(self, attributes: dict) -> bool:
+        for key, values in self.conditions:
+            value = attributes.get(key)
+            if key in ("mac", "oui") and value:
+                value = value.lower()
+            if value not in values:
+                return False
+        return True
+
+    def route(self, topic: str, service_name: str, event_name: str) -> Tuple[str, bool]:
+        """
+        Return the (topic, whether it's absolute) for an event's topic.
+        """
+        template = self.reroute or self.topic
+        if template is None:
+            return topic, False
+        topic = template.format(topic=topic, service=service_name, event=event_name)
+        return topic, self.reroute is not None
+
+    def project(self, data: dict) -> dict:
+        return {k: data[k] for k in self.fields if k in data}
+
+
+class Rules:
+    def __init__(self, rules: List[Rule]):
+        self.rules = rules
+        # (service or None, event or None) -> rules, in file order
+        self.index: Dict[Tuple[Optional[str], Optional[str]], List[Rule]] = {}
+        for rule in rules:
+            for service_name in rule.services or (None,):
+                for event_name in rule.events or (None,):
+                    self.index.setdefault((service_name, event_name), []).append(rule)
+        # (service, event) -> the rules which could apply to it
+        self._candidates: Dict[Tuple[str, str], Tuple[Rule, ...]] = {}
+
+    def __len__(self) -> int:
+        return len(self.rules)
+
+    @classmethod
+    def load(cls, path: str) -> "Rules":
+        try:
+            with open(path) as fp:
+                spec = json.load(fp)
+        except (OSError, ValueError) as exc:
+            raise ConfigError(f"can't load rules from {path}: {exc}")
+        if not isinstance(spec, dict) or not isinstance(spec.get("rules"), list):
+            raise ConfigError(f'{path}: expected {{"rules": [...]}}')
+        return cls([Rule(index, rule) for index, rule in enumerate(spec["rules"])])
+
+    def candidates(self, service_name: str, event_name: str) -> Tuple[Rule, ...]:
+        key = (service_name, event_name)
+        candidates = self._candidates.get(key)
+        if candidates is None:
+            index = self.index
+            rules = {
+                rule.index: rule
+                for k in (key, (service_name, None), (None, event_name), (None, None))
+                for rule in index.get(k, ())
+            }
+            candidates = self._candidates[key] = tuple(rules[i] for i in sorted(rules))
+        return candidates
+
+    def match(self, service_name: str, event_name: str, payload) -> Optional[Rule]:
+        candidates = self.candidates(service_name, event_name)
+        if not candidates:
+            return None
+        attributes = None
+        for rule in candidates:
+            if rule.conditions:
+                if attributes is None:
+                    attributes = event_attributes(service_name, event_name, payload)
+                if not rule.matches(attributes):
+                    continue
+            return rule
+        return None
@@ -0,0 +1,219 @@
+import logging
+import mmap
+import os
+import struct
+
+from time import time
+from typing import List, NamedTuple, Tuple
+
+from .constants import (
+    SPOOL_DEFAULT_SEGMENT_SIZE,
+    SPOOL_DEFAULT_MAX_BYTES,
+    SPOOL_DEFAULT_MAX_AGE,
+)
+
+logger = logging.getLogger("unifi_mqtt.spool")
+
+# payload length, timestamp, qos, retain, topic length
+RECORD_HEADER = struct.Struct("!IdBBH")
+
+SEGMENT_SUFFIX = ".seg"
+CURSOR_FILE = "cursor"
+
+
+class SpoolRecord(NamedTuple):
+    ts: float
+    topic: str
+    payload: bytes
+    qos: int
+    retain: bool
+
+
+class Spool:
+    """
+    A durable, append-only log of messages which couldn't be published.
+
+    Messages are appended to numbered segment files and read back through a
+    memory map from a replay cursor (segment, offset) that's persisted as
+    batches are committed. Fully replayed segments are deleted, and the
+    oldest segments are discarded once the spool exceeds its size or age
+    caps, so it never grows without bound.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        segment_size: int = SPOOL_DEFAULT_SEGMENT_SIZE,
+        max_bytes: int = SPOOL_DEFAULT_MAX_BYTES,
+        max_age: float = SPOOL_DEFAULT_MAX_AGE,
+    ):
+        self.path = path
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+        os.makedirs(path, exist_ok=True)
+
+        # segment id -> size in bytes
+        self.segments = {}
+        for filename in os.listdir(path):
+            if filename.endswith(SEGMENT_SUFFIX):
+                segment = int(filename[: -len(SEGMENT_SUFFIX)])
+                self.segments[segment] = os.path.getsize(self._segment_path(segment))
+
+        self.cursor = self._load_cursor()
+        self.dropped = 0
+
+        self._writer = None
+        self._writer_segment = None
+
+    def pending(self) -> int:
+        """
+        Return the number of unreplayed bytes in the spool.
+        """
+        segment, offset = self.cursor
+        return sum(
+            size - (offset if s == segment else 0)
+            for s, size in self.segments.items()
+            if s >= segment
+        )
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.path, f"{segment:010d}{SEGMENT_SUFFIX}")
+
+    def _load_cursor(self) -> Tuple[int, int]:
+        try:
+            with open(os.path.join(self.path, CURSOR_FILE), "r") as fp:
+                segment, offset = (int(x) for x in fp.read().split())
+        except (OSError, ValueError):
+            segment, offset = 0, 0
+        if segment not in self.segments:
+            return (min(self.segments), 0) if self.segments else (0, 0)
+        return segment, offset
+
+    def _save_cursor(self):
+        cursor_path = os.path.join(self.path, CURSOR_FILE)
+        tmp_path = f"{cursor_path}.tmp"
+        with open(tmp_path, "w") as fp:
+            fp.write("%d %d" % self.cursor)
+        os.replace(tmp_path, cursor_path)
+
+    def append(self, topic: str, payload, qos: int = 0, retain: bool = False):
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        topic_bytes = topic.encode("utf-8")
+
+        if (
+            self._writer is None
+            or self.segments[self._writer_segment] >= self.segment_size
+        ):
+            self._roll()
+
+        self._writer.write(
+            RECORD_HEADER.pack(len(payload), time(), qos, retain, len(topic_bytes))
+        )
+        self._writer.write(topic_bytes)
+        self._writer.write(payload)
+        self._writer.flush()
+        self.segments[self._writer_segment] += (
+            RECORD_HEADER.size + len(topic_bytes) + len(payload)
+        )
+
+    def _roll(self):
+        if self._writer is not None:
+            self._writer.close()
+        segment = max(self.segments) + 1 if self.segments else 0
+        self._writer = open(self._segment_path(segment), "ab")
+        self._writer_segment = segment
+        self.segments[segment] = 0
+        if self.cursor[0] not in self.segments:
+            self.cursor = (min(self.segments), 0)
+        self._enforce_caps()
+
+    def _enforce_caps(self):
+        cutoff = time() - self.max_age
+        while len(self.segments) > 1:
+            oldest = min(self.segments)
+            if oldest == self._writer_segment:
+                break
+            too_big = sum(self.segments.values()) > self.max_bytes
+            too_old = os.path.getmtime(self._segment_path(oldest)) < cutoff
+            if not (too_big or too_old):
+                break
+            logger.warning("spool.discard segment=%d", oldest)
+            self.dropped += 1
+            self._remove_segment(oldest)
+
+    def _remove_segment(self, segment: int):
+        self.segments.pop(segment, None)
+        try:
+            os.unlink(self._segment_path(segment))
+        except FileNotFoundError:
+            pass
+        if self.cursor[0] <= segment:
+            remaining = [s for s in self.segments if s > segment]
+            self.cursor = (min(remaining), 0) if remaining else (segment + 1, 0)
+
+    def read(self, limit: int) -> Tuple[List[SpoolRecord], Tuple[int, int]]:
+        """
+        Read up to ``limit`` records from the cursor.
+
+        Returns the records and the cursor to ``commit`` once they've been
+        handled.
+        """
+        records = []
+        segment, offset = self.cursor
+        cutoff = time() - self.max_age
+        while len(records) < limit and segment in self.segments:
+            size = self.segments[segment]
+            if offset < size:
+                offset = self._read_segment(
+                    segment, offset, size, limit, records, cutoff
+                )
+            if offset < size or segment == self._writer_segment:
+                break
+            later = [s for s in self.segments if s > segment]
+            if not later:
+                break
+            segment, offset = min(later), 0
+        return records, (segment, offset)
+
+    def _read_segment(self, segment, offset, size, limit, records, cutoff) -> int:
+        with open(self._segment_path(segment), "rb") as fp:
+            with mmap.mmap(fp.fileno(), size, access=mmap.ACCESS_READ) as view:
+                while offset < size and len(records) < limit:
+                    if offset + RECORD_HEADER.size > size:
+                        # a torn write from a crash mid-append
+                        return size
+                    payload_len, ts, qos, retain, topic_len = RECORD_HEADER.unpack_from(
+                        view, offset
+                    )
+                    start = offset + RECORD_HEADER.size
+                    end = start + topic_len + payload_len
+                    if end > size:
+                        return size
+                    if ts >= cutoff:
+                        records.append(
+                            SpoolRecord(
+                                ts,
+                                view[start : start + topic_len].decode("utf-8"),
+                                view[start + topic_len : end],
+                                qos,
+                                bool(retain),
+                            )
+                        )
+                    offset = end
+        return offset
+
+    def commit(self, cursor: Tuple[int, int]):
+        segment = cursor[0]
+        for s in [s for s in self.segments if s < segment]:
+            if s != self._writer_segment:
+                self._remove_segment(s)
+        self.cursor = cursor
+        self._save_cursor()
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
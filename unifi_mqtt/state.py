@@ -0,0 +1,87 @@
+import asyncio
+import json
+import logging
+import os
+import tempfile
+
+from typing import Optional
+
+from .constants import STATE_DEFAULT_FLUSH_INTERVAL
+
+logger = logging.getLogger("unifi_mqtt.state")
+
+
+class StateStore:
+    """
+    A small key/value store persisted to a local JSON file.
+
+    Updates are kept in memory and written out periodically (and on close)
+    by atomically replacing the file, so a crash never leaves it truncated.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        flush_interval: float = STATE_DEFAULT_FLUSH_INTERVAL,
+    ):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.data = self._load()
+        self.is_dirty = False
+
+    def _load(self) -> dict:
+        if not self.path:
+            return {}
+        try:
+            with open(self.path, "r") as fp:
+                return json.load(fp)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError):
+            logger.exception("state.load-failed")
+            return {}
+
+    def get(self, key: str, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key: str, value):
+        if self.data.get(key) != value:
+            self.data[key] = value
+            self.is_dirty = True
+
+    def mark_dirty(self):
+        """
+        Flag the store for writing after a value was updated in place.
+        """
+        self.is_dirty = True
+
+    def flush(self):
+        if not self.is_dirty or not self.path:
+            return
+        self.is_dirty = False
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".state-")
+        try:
+            with os.fdopen(fd, "w") as fp:
+                json.dump(self.data, fp)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(tmp_path, self.path)
+        except OSError:
+            self.is_dirty = True
+            logger.exception("state.flush-failed")
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+    async def run(self):
+        try:
+            while True:
+                await asyncio.sleep(self.flush_interval)
+                self.flush()
+        finally:
+            self.flush()
+
+    def close(self):
+        self.flush()
@@ -0,0 +1,356 @@
+"""
+Runs sites across several worker processes.
+
+Sites are assigned to workers with a consistent hash of their key, so adding
+or removing a worker only moves the sites it gains or loses. Each worker runs
+its own controllers, translator and MQTT connection, and reports its stats
+back to the supervisor over a pipe. The supervisor restarts workers that
+exit, with backoff, and logs aggregate stats.
+"""
+
+import asyncio
+import bisect
+import dataclasses
+import hashlib
+import logging
+import multiprocessing
+import os
+import signal
+
+from multiprocessing.connection import Connection, wait
+from time import monotonic
+from typing import Dict, List, Optional
+
+from . import metrics
+from .app import App, Options, configure_logging, run
+from .backoff import Backoff
+from .config import SiteConfig
+from .constants import (
+    SUPERVISOR_HASH_REPLICAS,
+    SUPERVISOR_STATS_INTERVAL,
+    SUPERVISOR_STABLE_AFTER,
+    SUPERVISOR_STOP_TIMEOUT,
+)
+
+logger = logging.getLogger("unifi_mqtt.supervisor")
+
+
+def _hash(value: str) -> int:
+    # hash() is salted per process, so can't be used to agree on placement
+    return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    def __init__(self, nodes: List[int], replicas: int = SUPERVISOR_HASH_REPLICAS):
+        points = sorted(
+            (_hash(f"{node}#{replica}"), node)
+            for node in nodes
+            for replica in range(replicas)
+        )
+        self.points = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+
+    def get(self, key: str) -> int:
+        index = bisect.bisect(self.points, _hash(key)) % len(self.points)
+        return self.nodes[index]
+
+
+def shard_sites(sites: List[SiteConfig], workers: int) -> List[List[SiteConfig]]:
+    ring = HashRing(list(range(workers)))
+    shards = [[] for _ in range(workers)]
+    for site in sites:
+        shards[ring.get(site.key)].append(site)
+    return shards
+
+
+def worker_path(path: Optional[str], index: int) -> Optional[str]:
+    if not path:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.worker-{index}{ext}"
+
+
+def worker_options(options: Options, index: int) -> Options:
+    # workers can't share a state file, spool, media cache or recording
+    return dataclasses.replace(
+        options,
+        state_file=worker_path(options.state_file, index),
+        spool_dir=(
+            os.path.join(options.spool_dir, f"worker-{index}")
+            if options.spool_dir
+            else None
+        ),
+        media_dir=os.path.join(options.media_dir, f"worker-{index}"),
+        record=worker_path(options.record, index),
+        # the supervisor serves metrics for every worker
+        metrics_port=None,
+    )
+
+
+async def _run_worker(app: App, conn: Connection, stats_interval: float):
+    async def report():
+        while True:
+            await asyncio.sleep(stats_interval)
+            conn.send((app.stats(), metrics.REGISTRY.collect()))
+
+    # the supervisor stops workers with SIGTERM
+    asyncio.get_running_loop().add_signal_handler(
+        signal.SIGTERM, asyncio.current_task().cancel
+    )
+    try:
+        await app.start()
+        await asyncio.gather(
+            report(), *(controller.connect() for controller in app.controllers)
+        )
+    except asyncio.CancelledError:
+        pass
+    finally:
+        await app.close()
+
+
+def run_worker(
+    index: int,
+    options: Options,
+    sites: List[SiteConfig],
+    conn: Connection,
+    log_level: str,
+    stats_interval: float,
+):
+    # Ctrl-C reaches the whole process group; leave stopping to the supervisor
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    configure_logging(log_level)
+
+    try:
+        run(_run_worker(App(options, sites), conn, stats_interval))
+    except BrokenPipeError:
+        logger.warning("worker.supervisor-gone: %d", index)
+    finally:
+        conn.close()
+
+
+class Worker:
+    def __init__(self, index: int, options: Options, sites: List[SiteConfig]):
+        self.index = index
+        self.options = options
+        self.sites = sites
+        self.process = None
+        self.conn = None
+        self.started = 0.0
+        self.restarts = 0
+        self.restart_at = 0.0
+        self.backoff = Backoff()
+        self.stats = {}
+        self.metrics = []
+        self.last_seen = None
+
+    @property
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+
+class Supervisor:
+    def __init__(
+        self,
+        options: Options,
+        sites: List[SiteConfig],
+        workers: int,
+        log_level: str = "info",
+        stats_interval: float = SUPERVISOR_STATS_INTERVAL,
+    ):
+        self.log_level = log_level
+        self.metrics_host = options.metrics_host
+        self.metrics_port = options.metrics_port
+        self.metrics_server = None
+        self.stats_interval = stats_interval
+        # spawn rather than fork, so workers never inherit a running loop
+        self.context = multiprocessing.get_context("spawn")
+        self.workers = [
+            Worker(index, worker_options(options, index), shard)
+            for index, shard in enumerate(shard_sites(sites, workers))
+            if shard
+        ]
+        self.is_stopping = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._on_signal)
+        for worker in self.workers:
+            logger.info(
+                "supervisor.worker-sites: %d %s",
+                worker.index,
+                ", ".join(site.key for site in worker.sites),
+            )
+            self.start_worker(worker)
+
+        metrics.REGISTRY.add_collector(self.update_metrics)
+        if self.metrics_port is not None:
+            self.metrics_server = metrics.MetricsServer(
+                self.metrics_host,
+                self.metrics_port,
+                collect=self.collect_metrics,
+                health=self.health,
+            )
+            self.metrics_server.start()
+
+        next_report = monotonic() + self.stats_interval
+        try:
+            while not self.is_stopping:
+                self.poll(timeout=1.0)
+                if monotonic() >= next_report:
+                    next_report += self.stats_interval
+                    self.report()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def _on_signal(self, signum, frame):
+        self.is_stopping = True
+
+    def start_worker(self, worker: Worker):
+        reader, writer = self.context.Pipe(duplex=False)
+        worker.process = self.context.Process(
+            target=run_worker,
+            args=(
+                worker.index,
+                worker.options,
+                worker.sites,
+                writer,
+                self.log_level,
+                self.stats_interval,
+            ),
+            name=f"unifi-mqtt-worker-{worker.index}",
+            daemon=True,
+        )
+        worker.process.start()
+        writer.close()
+        worker.conn = reader
+        worker.started = monotonic()
+        logger.info(
+            "supervisor.worker-started: %d pid=%d", worker.index, worker.process.pid
+        )
+
+    def poll(self, timeout: float):
+        waitables = []
+        for worker in self.workers:
+            if worker.process is not None:
+                waitables += [worker.conn, worker.process.sentinel]
+        ready = set(wait(waitables, timeout))
+
+        now = monotonic()
+        for worker in self.workers:
+            if worker.process is None:
+                if now >= worker.restart_at:
+                    worker.restarts += 1
+                    metrics.WORKER_RESTARTS.inc()
+                    self.start_worker(worker)
+                continue
+            if worker.conn in ready:
+                self._receive(worker)
+            if worker.process.sentinel in ready:
+                self._on_exit(worker)
+
+    def _receive(self, worker: Worker):
+        try:
+            while worker.conn.poll():
+                worker.stats, worker.metrics = worker.conn.recv()
+                worker.last_seen = monotonic()
+        except (EOFError, OSError):
+            # the process has gone; its sentinel will say so
+            pass
+
+    def _on_exit(self, worker: Worker):
+        worker.process.join()
+        logger.warning(
+            "supervisor.worker-exited: %d code=%s",
+            worker.index,
+            worker.process.exitcode,
+        )
+        worker.conn.close()
+        worker.process = None
+        worker.conn = None
+        if monotonic() - worker.started >= SUPERVISOR_STABLE_AFTER:
+            worker.backoff.reset()
+        worker.restart_at = monotonic() + worker.backoff.next()
+
+    def stop(self):
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+            self.metrics_server = None
+        for worker in self.workers:
+            if worker.is_alive:
+                worker.process.terminate()
+        deadline = monotonic() + SUPERVISOR_STOP_TIMEOUT
+        for worker in self.workers:
+            if worker.process is None:
+                continue
+            worker.process.join(max(0.0, deadline - monotonic()))
+            if worker.process.is_alive():
+                logger.warning("supervisor.worker-killed: %d", worker.index)
+                worker.process.kill()
+                worker.process.join()
+            worker.conn.close()
+            worker.process = None
+            worker.conn = None
+
+    def health(self) -> Dict[int, dict]:
+        return {
+            worker.index: {
+                "alive": worker.is_alive,
+                "pid": worker.process.pid if worker.process is not None else None,
+                "restarts": worker.restarts,
+                "last_seen": worker.last_seen,
+                "sites": [site.key for site in worker.sites],
+            }
+            for worker in self.workers
+        }
+
+    def aggregate(self) -> dict:
+        totals = {
+            "workers": len(self.workers),
+            "alive": 0,
+            "restarts": 0,
+            "depth": 0,
+            "dropped": 0,
+            "coalesced": 0,
+            "unknown": 0,
+            "mqtt_connected": 0,
+            "mqtt_lost": 0,
+            "spooled": 0,
+        }
+        for worker in self.workers:
+            totals["alive"] += worker.is_alive
+            totals["restarts"] += worker.restarts
+            stats = worker.stats
+            if not stats:
+                continue
+            for queue in stats["queues"].values():
+                totals["depth"] += queue["depth"]
+                totals["dropped"] += queue["dropped"]
+                totals["coalesced"] += queue["coalesced"]
+            totals["unknown"] += stats["unknown"]
+            totals["mqtt_connected"] += stats["mqtt"]["connected"]
+            totals["mqtt_lost"] += stats["mqtt"]["lost"]
+            totals["spooled"] += stats["mqtt"]["spooled"]
+        return totals
+
+    def update_metrics(self):
+        metrics.WORKERS_ALIVE.set(sum(worker.is_alive for worker in self.workers))
+
+    def collect_metrics(self) -> List[metrics.Family]:
+        # worker metrics are as of their last report
+        families = metrics.REGISTRY.collect()
+        for worker in self.workers:
+            families.extend(
+                metrics.add_labels(worker.metrics, (("worker", str(worker.index)),))
+            )
+        return families
+
+    def report(self):
+        stale = monotonic() - self.stats_interval * 3
+        for worker in self.workers:
+            if worker.is_alive and (worker.last_seen or worker.started) < stale:
+                logger.warning("supervisor.worker-stale: %d", worker.index)
+        logger.info(
+            "supervisor.stats: %s",
+            " ".join(f"{key}={value}" for key, value in self.aggregate().items()),
+        )
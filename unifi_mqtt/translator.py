@@ -1,42 +1,149 @@
+import asyncio
 import logging
-import json
 import re
+from collections import Counter
 from dataclasses import dataclass, field
-from time import time
-from typing import List, Optional, Union
+from enum import Enum
+from functools import lru_cache, partial
+from time import monotonic, perf_counter, time
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Dict,
+    Hashable,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
-from .mqtt import Mqtt
-from .unifi.controller import UnifiController
+from . import codec, metrics
+from .constants import (
+    DEBOUNCE_DEFAULT_WINDOW,
+    DEBOUNCE_TICK,
+    DEDUP_ACCESS_WINDOW_MS,
+    DEDUP_BUCKETS,
+    DEDUP_DEFAULT_WINDOW,
+    DEDUP_MAX_KEYS,
+    FORMAT_CACHE_SIZE,
+    PIPELINE_DEFAULT_QUEUE_SIZE,
+    PIPELINE_DEFAULT_PUBLISH_WORKERS,
+)
+from .discovery import Discovery
+from .pipeline import BoundedQueue, DedupWindow, OverflowPolicy, TimerWheel
+from .rules import Rules
 
+if TYPE_CHECKING:
+    # only needed for annotations; importing them loads aiohttp and the MQTT
+    # client, which the CLI shouldn't pay for just to list RawMode's values
+    from .media import MediaFetcher
+    from .mqtt import Mqtt
+    from .unifi.controller import UnifiController
 
 logger = logging.getLogger("unifi_mqtt.translator")
 
 
+class RawMode(Enum):
+    # include the upstream payload as-is
+    FULL = "full"
+    # include only the whitelisted top-level fields (see RAW_FIELDS)
+    FIELDS = "fields"
+    # omit the upstream payload entirely
+    NONE = "none"
+
+
+RAW_FIELDS = {
+    "network": ("_id", "key", "user", "hostname", "ssid", "ap", "network", "time"),
+    "access": ("event", "event_object_id", "device_id"),
+    "protect": ("id", "type", "camera", "start", "end", "score", "smartDetectTypes"),
+}
+# events we build ourselves (from the client table or polls), which have no
+# upstream payload to whitelist fields from; their message already has it all
+RAW_OWN_EVENTS = frozenset(
+    [
+        ("network", "client:update"),
+        ("network", "client:remove"),
+        ("network", "device:state"),
+        ("network", "health:state"),
+    ]
+)
+
+
 @dataclass
 class Event:
     topic: str
     data: dict = field(default_factory=dict)
+    # the topic class, which decides qos/retain/coalescing when published
+    kind: str = "event"
 
 
 mqtt_translation_table = str.maketrans({".": "", " ": "-", "_": "-"})
 mqtt_regex_object = re.compile(r"[^a-zA-Z0-9:\-\s]+")
 
 
+# the set of hostnames, SSIDs and doors is small and stable, so their
+# formatted names are cached rather than recomputed for every event
+@lru_cache(maxsize=FORMAT_CACHE_SIZE)
 def format_name(name):
     name = name.translate(mqtt_translation_table).lower()
     return mqtt_regex_object.sub("-", name).rstrip("-")
 
 
 def format_target(target_list):
-    targets = {t["type"]: t for t in target_list}
+    return _format_target(tuple((t["type"], t["display_name"]) for t in target_list))
+
+
+@lru_cache(maxsize=FORMAT_CACHE_SIZE)
+def _format_target(targets):
+    display_names = dict(targets)
     return "/".join(
-        format_name(targets[k]["display_name"])
+        format_name(display_names[k])
         for k in ("building", "floor", "door")
-        if k in targets
+        if k in display_names
     )
 
 
+def serialize_status(event, payload):
+    return Event(event)
+
+
+def serialize_client(event, payload):
+    client = payload["client"]
+    return Event(
+        f"client/{client['mac']}",
+        {**client, "changes": sorted(payload["changes"])},
+        kind="state",
+    )
+
+
+def serialize_client_removal(event, payload):
+    mac = payload["client"]["mac"]
+    return Event(f"client/{mac}", {"mac": mac, "removed": True}, kind="state")
+
+
+# polled snapshot event -> topic prefix
+SNAPSHOT_EVENTS = {
+    "device:state": "device",
+    "health:state": "health",
+}
+
+
+def serialize_snapshot(event, payload):
+    return Event(f"{SNAPSHOT_EVENTS[event]}/{payload['id']}", payload, kind="state")
+
+
+# network event -> (topic prefix, connected)
+NETWORK_CLIENT_EVENTS = {
+    "EVT_WU_Connected": ("wifi", True),
+    "EVT_WU_Disconnected": ("wifi", False),
+    "EVT_LU_Connected": ("lan", True),
+    "EVT_LU_Disconnected": ("lan", False),
+}
+
+
 def serialize_network(event, payload):
+    medium, connected = NETWORK_CLIENT_EVENTS[event]
+
     # use the device's MAC address instead of its hostname as client_name if a hostname is not available for that client
     if "hostname" in payload:
         client_name = format_name(payload["hostname"])
@@ -49,120 +156,528 @@ def serialize_network(event, payload):
     else:
         network_name = format_name(payload["network"])
 
-    if event == "EVT_WU_Disconnected":
-        return Event(
-            f"wifi/{network_name}/client/{client_name}",
-            {
-                "connected": False,
-                "mac": payload["user"],
-                "ts": payload["time"],
-            },
-        )
-    if event == "EVT_WU_Connected":
-        return Event(
-            f"wifi/{network_name}/client/{client_name}",
-            {
-                "connected": True,
-                "mac": payload["user"],
-                "ts": payload["time"],
-            },
-        )
-    if event == "EVT_LU_Connected":
-        return Event(
-            f"lan/{network_name}/client/{client_name}",
-            {
-                "connected": True,
-                "mac": payload["user"],
-                "ts": payload["time"],
-            },
-        )
-    if event == "EVT_LU_Disconnected":
-        return Event(
-            f"lan/{network_name}/client/{client_name}",
-            {
-                "connected": False,
-                "mac": payload["user"],
-                "ts": payload["time"],
-            },
-        )
-    return None, {}
+    return Event(
+        f"{medium}/{network_name}/client/{client_name}",
+        {
+            "connected": connected,
+            "mac": payload["user"],
+            "ts": payload["time"],
+        },
+    )
 
 
 def serialize_access(event, payload):
-    if event == "access.logs.add":
-        source = payload["data"]["_source"]
-        if source["event"]["type"] == "access.door.unlock":
-            data = {
-                "success": source["event"]["result"] == "ACCESS",
-                "actor": {
-                    "id": source["actor"]["id"],
-                    "display_name": source["actor"]["display_name"],
-                },
-                "ts": source["event"]["published"],
-            }
-            target_path = format_target(source["target"])
-            return [
-                Event(
-                    f"device/{payload['device_id']}/unlock",
-                    data,
-                ),
-                Event(
-                    f"target/{target_path}/unlock",
-                    data,
-                ),
-            ]
+    source = payload["data"]["_source"]
+    if source["event"]["type"] == "access.door.unlock":
+        data = {
+            "success": source["event"]["result"] == "ACCESS",
+            "actor": {
+                "id": source["actor"]["id"],
+                "display_name": source["actor"]["display_name"],
+            },
+            "ts": source["event"]["published"],
+        }
+        target_path = format_target(source["target"])
+        return [
+            Event(
+                f"device/{payload['device_id']}/unlock",
+                data,
+            ),
+            Event(
+                f"target/{target_path}/unlock",
+                data,
+            ),
+        ]
 
 
-def serialize(name, event, payload) -> Union[Optional[Event], List[Event]]:
-    if event in ("connected", "disconnected"):
-        return Event(event)
+def serialize_capture(event, payload):
+    data = payload["data"]
+    return Event(
+        f"device/{payload['device_id']}/capture",
+        {"capture_id": data["_id"], "ts": data["_source"].get("published")},
+    )
+
+
+# protect event -> topic suffix
+PROTECT_EVENTS = {
+    "motion": "motion",
+    "ring": "ring",
+    "smart_detect": "smart-detect",
+}
+
+
+def serialize_protect(event, payload):
+    camera = payload.get("camera")
+    if not camera:
+        return None
+    data = {
+        "event_id": payload["id"],
+        "active": not payload.get("end"),
+        "ts": payload.get("end") or payload.get("start"),
+    }
+    if "score" in payload:
+        data["score"] = payload["score"]
+    if event == "smart_detect":
+        data["types"] = payload.get("smartDetectTypes", [])
+    return Event(f"camera/{camera}/{PROTECT_EVENTS[event]}", data)
+
+
+Serializer = Callable[[str, dict], Union[Optional[Event], List[Event]]]
+
+
+def build_serializers() -> Dict[Tuple[Optional[str], str], Serializer]:
+    """
+    Build the registry mapping (service, event) to a serializer.
+
+    A service of ``None`` matches events from any service.
+    """
+    serializers = {
+        (None, "connected"): serialize_status,
+        (None, "disconnected"): serialize_status,
+        ("network", "client:update"): serialize_client,
+        ("network", "client:remove"): serialize_client_removal,
+        ("access", "access.logs.add"): serialize_access,
+        ("access", "access.capture.add"): serialize_capture,
+    }
+    for event in NETWORK_CLIENT_EVENTS:
+        serializers[("network", event)] = serialize_network
+    for event in SNAPSHOT_EVENTS:
+        serializers[("network", event)] = serialize_snapshot
+    for event in PROTECT_EVENTS:
+        serializers[("protect", event)] = serialize_protect
+    return serializers
+
+
+SERIALIZERS = build_serializers()
+
+
+def get_serializer(serializers, name, event) -> Optional[Serializer]:
+    return serializers.get((name, event)) or serializers.get((None, event))
+
+
+def network_event_key(payload) -> Hashable:
+    # events carry the controller's id; otherwise what, when and who
+    event_id = payload.get("_id")
+    if event_id is not None:
+        return event_id
+    return payload.get("key"), payload.get("time"), payload.get("user")
 
-    if name == "network":
-        return serialize_network(event, payload)
-    if name == "access":
-        return serialize_access(event, payload)
-    print(event, payload)
+
+def access_key(payload) -> Hashable:
+    # a log and the capture taken for it have their own ids, but the same
+    # door and actor at (about) the same time, so either repeats the other
+    data = payload["data"]
+    source = data["_source"]
+    actor = source.get("actor", {}).get("id")
+    published = source.get("event", {}).get("published") or source.get("published")
+    if actor is None or published is None:
+        return data["_id"]
+    return payload["device_id"], actor, published // DEDUP_ACCESS_WINDOW_MS
+
+
+def protect_event_key(payload) -> Hashable:
+    # an event is updated in place, so only an identical update is a repeat
+    return (
+        payload["id"],
+        payload.get("start"),
+        payload.get("end"),
+        payload.get("score"),
+        tuple(payload.get("smartDetectTypes") or ()),
+    )
+
+
+# (service, event) -> what identifies a redelivered copy of the event; state
+# events aren't listed, as they're already diffed and coalesced
+DEDUP_KEYS: Dict[Tuple[str, str], Callable[[dict], Hashable]] = {
+    ("access", "access.logs.add"): access_key,
+    ("access", "access.capture.add"): access_key,
+    **{("network", event): network_event_key for event in NETWORK_CLIENT_EVENTS},
+    **{("protect", event): protect_event_key for event in PROTECT_EVENTS},
+}
+
+
+def serialize(name, event, payload) -> Union[Optional[Event], List[Event]]:
+    serializer = get_serializer(SERIALIZERS, name, event)
+    if serializer is None:
+        return None
+    return serializer(event, payload)
 
 
 class Translator:
-    def __init__(self, mqtt: Mqtt):
+    def __init__(
+        self,
+        mqtt: "Mqtt",
+        queue_size: int = PIPELINE_DEFAULT_QUEUE_SIZE,
+        overflow_policy: OverflowPolicy = OverflowPolicy.BLOCK,
+        publish_workers: int = PIPELINE_DEFAULT_PUBLISH_WORKERS,
+        raw_modes: Optional[Dict[str, RawMode]] = None,
+        debounce_window: float = DEBOUNCE_DEFAULT_WINDOW,
+        discovery: Optional[Discovery] = None,
+        dedup_window: float = DEDUP_DEFAULT_WINDOW,
+        media: Optional["MediaFetcher"] = None,
+        rules: Optional[Rules] = None,
+    ):
         self.mqtt = mqtt
+        # announces entities to Home Assistant as their topics are first seen
+        self.discovery = discovery
+        self.raw_modes = raw_modes or {}
+        self.serializers = dict(SERIALIZERS)
+        # (service, event) -> count of events we have no serializer for
+        self.unknown = Counter()
+        self.queue_size = queue_size
+        self.overflow_policy = overflow_policy
+        self.publish_workers = publish_workers
+        # client connect/disconnect events are held this long, and dropped if
+        # the client flips back in the meantime
+        self.debounce_window = debounce_window
+        self.debounced = None
+        # events redelivered (e.g. after a reconnect) within the window are
+        # dropped before they're serialized
+        self.dedup = (
+            DedupWindow(dedup_window, DEDUP_BUCKETS, DEDUP_MAX_KEYS)
+            if dedup_window > 0
+            else None
+        )
+
+        # fetches event images once the event itself is queued
+        self.media = media
+        # drop, rename, project or reroute events, before they're encoded
+        self.rules = rules
+
+        # controller -> the handler registered with it
+        self.handlers = {}
+        self.translate_queue = None
+        self.publish_queues = ()
+        self.tasks = []
+        # optionally called with each message's ingest-to-publish latency
+        self.observe_latency = None
+        # called with (prefix, service, event, payload) for each event which
+        # made it past dedup and debouncing
+        self.observers: List[Callable[[str, str, str, dict], None]] = []
 
-    def connect(self, controller: UnifiController):
-        controller.add_handler(self.on_emit)
+    def connect(self, controller: "UnifiController"):
+        handler = partial(self.on_emit, prefix=controller.topic_prefix)
+        self.handlers[controller] = handler
+        # on_emit only queues the event, so it's called inline
+        controller.add_handler(handler, name="translator", direct=True)
 
-    def disconnect(self, controller: UnifiController):
-        controller.remove_handler(self.on_emit)
+    def disconnect(self, controller: "UnifiController"):
+        controller.remove_handler(self.handlers.pop(controller))
+
+    async def start(self):
+        # queues are created here so they bind to the running loop
+        self.translate_queue = BoundedQueue(
+            "translate", self.queue_size, self.overflow_policy
+        )
+        # each publish worker owns a queue and topics are sharded across them,
+        # which keeps messages for a single topic in order
+        self.publish_queues = tuple(
+            BoundedQueue(f"publish-{n}", self.queue_size, self.overflow_policy)
+            for n in range(self.publish_workers)
+        )
+        self.tasks = [asyncio.ensure_future(self._translate_worker())]
+        self.tasks.extend(
+            asyncio.ensure_future(self._publish_worker(queue))
+            for queue in self.publish_queues
+        )
+        if self.media is not None:
+            await self.media.start(self.publish_after)
+        if self.debounce_window > 0:
+            self.debounced = TimerWheel(DEBOUNCE_TICK, self.debounce_window)
+            self.tasks.append(asyncio.ensure_future(self._debounce_worker()))
+
+    async def close(self):
+        if self.media is not None:
+            await self.media.close()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def join(self):
+        """
+        Wait until everything handed to the translator has been published.
+        """
+        await self.translate_queue.join()
+        for queue in self.publish_queues:
+            await queue.join()
+
+    async def drain(self):
+        """
+        Publish everything handed to the translator, including events held
+        for debouncing and images still being fetched.
+        """
+        if self.translate_queue is None:
+            return
+        await self.translate_queue.join()
+        if self.debounced is not None:
+            for _, (event_name, payload, prefix, received) in self.debounced.clear():
+                await self.process("network", event_name, payload, prefix, received)
+        if self.media is not None and self.media.queue is not None:
+            await self.media.queue.join()
+        await self.join()
+
+    def stats(self) -> dict:
+        return {
+            queue.name: queue.stats()
+            for queue in (
+                self.translate_queue,
+                *self.publish_queues,
+                self.media.queue if self.media is not None else None,
+            )
+            if queue is not None
+        }
+
+    async def on_emit(
+        self, service_name: str, event_name: str, payload: dict, prefix: str = ""
+    ):
+        await self.translate_queue.put(
+            (service_name, event_name, payload, prefix, perf_counter())
+        )
 
-    async def on_emit(self, service_name: str, event_name: str, payload: dict):
+    def translate(
+        self, service_name: str, event_name: str, payload: dict, prefix: str = ""
+    ):
+        serializer = get_serializer(self.serializers, service_name, event_name)
+        if serializer is None:
+            self.unknown[(service_name, event_name)] += 1
+            metrics.UNKNOWN_EVENTS.labels(service_name).inc()
+            return []
+
+        rule = None
+        if self.rules is not None:
+            rule = self.rules.match(service_name, event_name, payload)
+            if rule is not None and rule.drop:
+                metrics.FILTERED_EVENTS.labels(service_name).inc()
+                return []
+
+        started = perf_counter()
         try:
-            event_or_events = serialize(service_name, event_name, payload)
-        except Exception as exc:
+            event_or_events = serializer(event_name, payload)
+        except Exception:
+            metrics.SERIALIZE_ERRORS.labels(service_name).inc()
             logger.exception("serialize-error")
-            logger.debug(f"serialize-error/service_name: {service_name}")
-            logger.debug(f"serialize-error/event_name: {event_name}")
-            logger.debug(f"serialize-error/payload: {payload}")
-            return
+            logger.debug("serialize-error: %s %s %s", service_name, event_name, payload)
+            return []
 
         if not event_or_events:
-            return
+            return []
 
         if isinstance(event_or_events, Event):
             events = [event_or_events]
         else:
             events = event_or_events
 
+        # the raw payload is encoded once and spliced into every message
+        raw = self.encode_raw(service_name, event_name, payload)
+        ts = int(time() * 1000)
+        messages = []
         for event in events:
-            await self.mqtt.publish(
-                f"{service_name}/{event.topic}",
-                json.dumps(
-                    {
-                        "raw": payload,
-                        "service": service_name,
-                        "event": event_name,
-                        # set a default timestamp
-                        "ts": int(time() * 1000),
-                        **event.data,
-                    }
-                ),
+            data = event.data
+            topic = event.topic
+            is_absolute = False
+            if rule is not None:
+                if rule.fields is not None:
+                    data = rule.project(data)
+                topic, is_absolute = rule.route(topic, service_name, event_name)
+            message = codec.dumps(
+                {
+                    "service": service_name,
+                    "event": event_name,
+                    # set a default timestamp
+                    "ts": ts,
+                    **data,
+                }
             )
+            if raw is not None:
+                message = b'{"raw":' + raw + b"," + message[1:]
+            if is_absolute:
+                messages.append((topic, message, "rerouted"))
+                continue
+            topic = f"{prefix}{service_name}/{topic}"
+            if self.discovery is not None:
+                announcement = self.discovery.announce(
+                    service_name, event_name, payload, topic, event
+                )
+                if announcement is not None:
+                    messages.append(announcement)
+            messages.append((topic, message, event.kind))
+        metrics.SERIALIZE_SECONDS.labels(service_name).observe(perf_counter() - started)
+        return messages
+
+    def encode_raw(
+        self, service_name: str, event_name: str, payload
+    ) -> Optional[bytes]:
+        mode = self.raw_modes.get(service_name, RawMode.FULL)
+        if mode is RawMode.NONE or payload is None:
+            return None
+        if mode is RawMode.FIELDS and isinstance(payload, dict):
+            if (service_name, event_name) in RAW_OWN_EVENTS:
+                return None
+            fields = RAW_FIELDS.get(service_name, ())
+            payload = {k: payload[k] for k in fields if k in payload}
+        return codec.dumps(payload)
+
+    def is_duplicate(
+        self, service_name: str, event_name: str, payload: dict, prefix: str
+    ) -> bool:
+        key_func = DEDUP_KEYS.get((service_name, event_name))
+        if key_func is None:
+            return False
+        try:
+            key = (prefix, service_name, key_func(payload))
+        except (KeyError, TypeError, AttributeError):
+            # malformed; let the serializer report it
+            return False
+        if self.dedup.seen(key, monotonic()):
+            metrics.DUPLICATES.labels(service_name).inc()
+            return True
+        return False
+
+    def debounce(self, event_name: str, payload: dict, prefix: str, received: float):
+        """
+        Hold a client connect/disconnect event until it's held for the window.
+
+        An opposite event for the same client within the window cancels both,
+        and a repeat replaces the held event and restarts the window.
+        """
+        key = (prefix, payload["user"])
+        _, connected = NETWORK_CLIENT_EVENTS[event_name]
+        held = self.debounced.cancel(key)
+        if held is not None:
+            if NETWORK_CLIENT_EVENTS[held[0]][1] != connected:
+                # a flap: the client is back where it started
+                metrics.DEBOUNCED.inc(2)
+                return
+            metrics.DEBOUNCED.inc()
+        self.debounced.schedule(
+            key, self.debounce_window, (event_name, payload, prefix, received)
+        )
+
+    def debounce_client(self, payload: dict, prefix: str, received: float) -> bool:
+        """
+        Hold a client state update which changes ``connected`` for the window,
+        so a flap never reaches the retained client topic.
+
+        Later updates for the client are merged into the held one. If the
+        client flips back, ``connected`` is dropped from the changes, along
+        with the update unless something else changed. Returns whether the
+        update was held (or dropped).
+        """
+        key = (prefix, "client", payload["client"]["mac"])
+        changes = payload["changes"]
+        held = self.debounced.get(key)
+        if held is None:
+            if "connected" not in changes:
+                return False
+            self.debounced.schedule(
+                key, self.debounce_window, ("client:update", payload, prefix, received)
+            )
+            return True
+
+        held_changes = held[1]["changes"]
+        merged = {"client": payload["client"], "changes": {**held_changes, **changes}}
+        value = ("client:update", merged, prefix, held[3])
+        if "connected" not in changes:
+            self.debounced.replace(key, value)
+        elif "connected" in held_changes:
+            # a flap: the client is back where it started (counted as such
+            # by the connect/disconnect events)
+            del merged["changes"]["connected"]
+            if merged["changes"]:
+                # what else changed is published on the next tick
+                self.debounced.schedule(key, 0, value)
+            else:
+                self.debounced.cancel(key)
+        else:
+            self.debounced.schedule(key, self.debounce_window, value)
+        return True
+
+    async def _enqueue(self, messages, received: float):
+        publish_queues = self.publish_queues
+        for topic, message, kind in messages:
+            shard = publish_queues[hash(topic) % len(publish_queues)]
+            await shard.put((topic, message, kind, received), key=topic)
+
+    async def publish_after(
+        self, after: str, topic: str, message: bytes, kind: str, received: float
+    ):
+        """
+        Queue a message on the same shard as topic ``after``, so it's published
+        after any message already queued for that topic.
+        """
+        shard = self.publish_queues[hash(after) % len(self.publish_queues)]
+        await shard.put((topic, message, kind, received), key=topic)
+
+    def add_observer(self, observer: Callable[[str, str, str, dict], None]):
+        """
+        Call ``observer(prefix, service, event, payload)`` for each event once
+        it's past dedup and debouncing, so it sees what's published.
+        """
+        self.observers.append(observer)
+
+    async def process(
+        self,
+        service_name: str,
+        event_name: str,
+        payload: dict,
+        prefix: str,
+        received: float,
+    ):
+        for observer in self.observers:
+            try:
+                observer(prefix, service_name, event_name, payload)
+            except Exception:
+                logger.exception("observer-error")
+        messages = self.translate(service_name, event_name, payload, prefix)
+        await self._enqueue(messages, received)
+        if self.media is not None:
+            self.media.submit(
+                service_name, event_name, payload, prefix, messages, received
+            )
+
+    async def _translate_worker(self):
+        queue = self.translate_queue
+        while True:
+            service_name, event_name, payload, prefix, received = await queue.get()
+            if self.dedup is not None and self.is_duplicate(
+                service_name, event_name, payload, prefix
+            ):
+                queue.task_done()
+                continue
+            if self.debounced is not None and service_name == "network":
+                if event_name in NETWORK_CLIENT_EVENTS and "user" in payload:
+                    self.debounce(event_name, payload, prefix, received)
+                    queue.task_done()
+                    continue
+                if event_name == "client:update" and self.debounce_client(
+                    payload, prefix, received
+                ):
+                    queue.task_done()
+                    continue
+            await self.process(service_name, event_name, payload, prefix, received)
+            queue.task_done()
+
+    async def _debounce_worker(self):
+        wheel = self.debounced
+        deadline = monotonic()
+        while True:
+            deadline += wheel.tick
+            await asyncio.sleep(max(0.0, deadline - monotonic()))
+            for _, (event_name, payload, prefix, received) in wheel.advance():
+                await self.process("network", event_name, payload, prefix, received)
+
+    async def _publish_worker(self, queue: BoundedQueue):
+        while True:
+            topic, message, kind, received = await queue.get()
+            try:
+                await self.mqtt.publish(topic, message, kind)
+            except Exception:
+                logger.exception("publish-error")
+            else:
+                latency = perf_counter() - received
+                metrics.MESSAGES.labels(kind).inc()
+                metrics.PUBLISH_LATENCY.observe(latency)
+                if self.observe_latency is not None:
+                    self.observe_latency(latency)
+            queue.task_done()
@@ -0,0 +1,122 @@
+import asyncio
+import base64
+import json
+import logging
+
+import aiohttp
+
+from time import time
+from typing import Callable, Optional
+
+from .. import metrics
+
+logger = logging.getLogger("unifi_mqtt.unifi.auth")
+
+# how long before the session token expires we'll proactively log in again
+REFRESH_MARGIN = 60
+
+
+def token_expiry(token: str) -> Optional[float]:
+    """
+    Return the ``exp`` claim of a JWT session token, if it has one.
+    """
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+class AuthManager:
+    """
+    Manages the controller session.
+
+    Requests assume the session is valid. When one is rejected the caller asks
+    for a re-auth, and concurrent callers are coalesced onto a single login.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], aiohttp.ClientSession],
+        url: str,
+        username: str,
+        password: str,
+        verify_ssl: bool = True,
+    ):
+        self.session_factory = session_factory
+        self._session = None
+        self.url = url
+        self.username = username
+        self.password = password
+        self.verify_ssl = verify_ssl
+
+        # bumped on every successful login so callers can tell whether the
+        # session was already refreshed since their request was sent
+        self.generation = 0
+        self.expires_at = None
+        self.logins = 0
+        self.reauths = 0
+
+        self._login_task = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        # created on first use, so it's bound to the running loop
+        if self._session is None:
+            self._session = self.session_factory()
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def needs_refresh(self) -> bool:
+        return self.expires_at is not None and time() > self.expires_at - REFRESH_MARGIN
+
+    async def login(self):
+        if self._login_task is None or self._login_task.done():
+            self._login_task = asyncio.ensure_future(self._login())
+        return await asyncio.shield(self._login_task)
+
+    async def reauth(self, generation: int):
+        """
+        Log in again after a request made during ``generation`` was rejected.
+        """
+        if generation != self.generation:
+            return
+        if self._login_task is None or self._login_task.done():
+            self.reauths += 1
+            metrics.REAUTHS.inc()
+            logger.info("auth.reauth")
+        await self.login()
+
+    async def _login(self):
+        # clear cookies otherwise unifi throws a 404 on next login
+        self.session.cookie_jar.clear()
+        try:
+            await self.session.post(
+                f"{self.url}/api/auth/login",
+                data={
+                    "username": self.username,
+                    "password": self.password,
+                },
+                headers={
+                    "Referer": f"{self.url}/login",
+                },
+                verify_ssl=self.verify_ssl,
+            )
+            logger.info("auth.success")
+        except aiohttp.ClientError:
+            logger.info("auth.failed")
+            raise
+
+        self.logins += 1
+        metrics.LOGINS.inc()
+        self.generation += 1
+        self.expires_at = None
+        for cookie in self.session.cookie_jar:
+            if cookie.key == "TOKEN":
+                self.expires_at = token_expiry(cookie.value)
+                break
@@ -0,0 +1,141 @@
+"""
+Delivers a controller's events to its handlers.
+
+Each handler subscribes with an optional filter on service and event name,
+and matching handlers are looked up once per (service, event) rather than
+tested on every event. A handler either runs inline (``direct``, for a
+handler like the translator which only hands the event to its own queue) or
+gets its own drop-oldest queue and workers, so a slow or failing handler
+falls behind on its own without holding up the websocket or other handlers.
+"""
+
+import asyncio
+import logging
+
+from time import monotonic
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Tuple
+
+from .. import metrics
+from ..constants import BUS_DEFAULT_QUEUE_SIZE
+from ..pipeline import BoundedQueue, OverflowPolicy
+
+logger = logging.getLogger("unifi_mqtt.unifi.bus")
+
+Handler = Callable[[str, str, Optional[dict]], Awaitable[None]]
+
+
+class Subscription:
+    def __init__(
+        self,
+        callback: Handler,
+        name: Optional[str] = None,
+        services: Optional[Iterable[str]] = None,
+        events: Optional[Iterable[str]] = None,
+        direct: bool = False,
+        concurrency: int = 1,
+        queue_size: int = BUS_DEFAULT_QUEUE_SIZE,
+    ):
+        self.callback = callback
+        self.name = name or getattr(callback, "__qualname__", repr(callback))
+        self.services = frozenset(services) if services is not None else None
+        self.events = frozenset(events) if events is not None else None
+        self.direct = direct
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+
+        self.queue = None
+        self.tasks = []
+
+        self.lag = metrics.HANDLER_LAG.labels(self.name)
+        self.errors = metrics.HANDLER_ERRORS.labels(self.name)
+        self.dropped = metrics.HANDLER_DROPPED.labels(self.name)
+
+    def matches(self, service_name: str, event_name: str) -> bool:
+        return (self.services is None or service_name in self.services) and (
+            self.events is None or event_name in self.events
+        )
+
+    async def dispatch(self, service_name: str, event_name: str, payload):
+        if self.direct:
+            await self._call(service_name, event_name, payload)
+            return
+        if self.queue is None:
+            self.start()
+        if self.queue.full():
+            self.dropped.inc()
+        self.queue.put_nowait((service_name, event_name, payload, monotonic()))
+
+    def start(self):
+        # started on first use, so the queue binds to the running loop
+        self.queue = BoundedQueue(
+            f"handler-{self.name}", self.queue_size, OverflowPolicy.DROP_OLDEST
+        )
+        self.tasks = [
+            asyncio.ensure_future(self._worker()) for _ in range(self.concurrency)
+        ]
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def _worker(self):
+        queue = self.queue
+        while True:
+            service_name, event_name, payload, queued = await queue.get()
+            self.lag.observe(monotonic() - queued)
+            await self._call(service_name, event_name, payload)
+            queue.task_done()
+
+    async def _call(self, service_name: str, event_name: str, payload):
+        try:
+            await self.callback(service_name, event_name, payload)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.errors.inc()
+            logger.exception("handler-error: %s", self.name)
+
+
+class HandlerBus:
+    def __init__(self):
+        self.subscriptions = []
+        # (service, event) -> the subscriptions it's delivered to
+        self._routes: Dict[Tuple[str, str], Tuple[Subscription, ...]] = {}
+
+    def subscribe(self, callback: Handler, **options) -> Subscription:
+        subscription = Subscription(callback, **options)
+        self.subscriptions.append(subscription)
+        self._routes.clear()
+        return subscription
+
+    def unsubscribe(self, callback: Handler):
+        for subscription in self.subscriptions:
+            if subscription.callback == callback:
+                self.subscriptions.remove(subscription)
+                self._routes.clear()
+                # anything still queued for it is abandoned
+                for task in subscription.tasks:
+                    task.cancel()
+                return
+        raise ValueError(f"not subscribed: {callback!r}")
+
+    async def publish(self, service_name: str, event_name: str, payload=None):
+        routes = self._routes.get((service_name, event_name))
+        if routes is None:
+            routes = self._routes[(service_name, event_name)] = tuple(
+                s for s in self.subscriptions if s.matches(service_name, event_name)
+            )
+        for subscription in routes:
+            await subscription.dispatch(service_name, event_name, payload)
+
+    async def close(self):
+        await asyncio.gather(*(s.close() for s in self.subscriptions))
+
+    def stats(self) -> dict:
+        return {
+            s.queue.name: s.queue.stats()
+            for s in self.subscriptions
+            if s.queue is not None
+        }
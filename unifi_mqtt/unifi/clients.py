@@ -0,0 +1,103 @@
+from time import monotonic
+from typing import Dict, List, Optional
+
+from ..constants import CLIENTS_DEFAULT_TTL
+
+# the client attributes we track; anything else in a sync payload is ignored
+FIELDS = ("hostname", "ip", "ap_mac", "essid", "network", "is_wired", "connected")
+
+
+class ClientRecord:
+    __slots__ = ("mac", "last_seen") + FIELDS
+
+    def __init__(self, mac: str):
+        self.mac = mac
+        self.last_seen = monotonic()
+        for field in FIELDS:
+            setattr(self, field, None)
+
+    def as_dict(self) -> dict:
+        return {"mac": self.mac, **{f: getattr(self, f) for f in FIELDS}}
+
+
+class ClientTable:
+    """
+    The current state of every client on a site, keyed by MAC address.
+
+    Updates return only the fields which actually changed, so a sync message
+    restating what we already know produces nothing to publish. Disconnected
+    clients which haven't been heard from in ``ttl`` seconds are evicted by
+    ``expire``, so rotating private MACs don't accumulate forever.
+    """
+
+    def __init__(self, ttl: float = CLIENTS_DEFAULT_TTL):
+        self.ttl = ttl
+        self.records: List[Optional[ClientRecord]] = []
+        self.index: Dict[str, int] = {}
+        self.free: List[int] = []
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def get(self, mac: str) -> Optional[ClientRecord]:
+        idx = self.index.get(mac)
+        if idx is None:
+            return None
+        return self.records[idx]
+
+    def update(self, mac: str, values: dict) -> dict:
+        idx = self.index.get(mac)
+        if idx is None:
+            record = ClientRecord(mac)
+            if self.free:
+                idx = self.free.pop()
+                self.records[idx] = record
+            else:
+                idx = len(self.records)
+                self.records.append(record)
+            self.index[mac] = idx
+        else:
+            record = self.records[idx]
+        record.last_seen = monotonic()
+
+        changes = {}
+        for field, value in values.items():
+            if getattr(record, field) != value:
+                setattr(record, field, value)
+                changes[field] = value
+        return changes
+
+    def remove(self, mac: str):
+        idx = self.index.pop(mac, None)
+        if idx is not None:
+            self.records[idx] = None
+            self.free.append(idx)
+
+    def expire(self, now: Optional[float] = None) -> List[str]:
+        """
+        Evict disconnected clients idle for longer than the TTL, returning
+        their MACs.
+        """
+        cutoff = (monotonic() if now is None else now) - self.ttl
+        expired = [
+            record.mac
+            for record in self.records
+            if record is not None and not record.connected and record.last_seen < cutoff
+        ]
+        for mac in expired:
+            self.remove(mac)
+        return expired
+
+
+def client_values(entry: dict) -> dict:
+    """
+    Extract the tracked fields present in a ``sta:sync`` entry.
+    """
+    values = {"connected": True}
+    hostname = entry.get("hostname") or entry.get("name")
+    if hostname:
+        values["hostname"] = hostname
+    for field in ("ip", "ap_mac", "essid", "network", "is_wired"):
+        if field in entry:
+            values[field] = entry[field]
+    return values
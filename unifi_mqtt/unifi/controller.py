@@ -1,8 +1,9 @@
 import asyncio
 import aiohttp
+import importlib
 import logging
 
-from typing import List
+from typing import Dict, List, Optional, Type
 
 from ..constants import (
     UNIFI_DEFAULT_HOST,
@@ -10,24 +11,31 @@ from ..constants import (
     UNIFI_DEFAULT_PORT,
     UNIFI_DEFAULT_USERNAME,
     UNIFI_DEFAULT_SITE,
+    UNIFI_DEFAULT_HEARTBEAT,
 )
+from ..pipeline import LoadShedder
+from ..recorder import FrameRecorder
+from ..state import StateStore
+from .bus import Handler, HandlerBus, Subscription
+from .poller import Poller
+from .pool import SessionPool
 from .services.base import UnifiService
-from .services.access import UnifiAccessService
-from .services.network import UnifiNetworkService
-from .services.protect import UnifiProtectService
 
 logger = logging.getLogger("unifi_mqtt.unifi")
 
-
-USER_AGENT = "unifi-mqtt/1.0"
-
+# service -> where its class lives, imported only when it's enabled
 SERVICES = {
-    "access": UnifiAccessService,
-    "network": UnifiNetworkService,
-    "protect": UnifiProtectService,
+    "access": "unifi_mqtt.unifi.services.access:UnifiAccessService",
+    "network": "unifi_mqtt.unifi.services.network:UnifiNetworkService",
+    "protect": "unifi_mqtt.unifi.services.protect:UnifiProtectService",
 }
 
 
+def load_service(name: str) -> Type[UnifiService]:
+    module, _, attr = SERVICES[name].partition(":")
+    return getattr(importlib.import_module(module), attr)
+
+
 class UnifiController:
     def __init__(
         self,
@@ -39,6 +47,13 @@ class UnifiController:
         verify_ssl: bool = True,
         use_unsafe_cookie_jar: bool = False,
         services: List[str] = ["network"],
+        state: Optional[StateStore] = None,
+        recorder: Optional[FrameRecorder] = None,
+        pool: Optional[SessionPool] = None,
+        topic_prefix: str = "",
+        poll: Optional[Dict[str, float]] = None,
+        heartbeat: float = UNIFI_DEFAULT_HEARTBEAT,
+        shedder: Optional[LoadShedder] = None,
     ):
         self.host = host
         self.port = port
@@ -46,142 +61,143 @@ class UnifiController:
         self.password = password
         self.site = site
         self.verify_ssl = verify_ssl
+        # prepended to every topic published for this controller, which keeps
+        # sites apart when several are handled by one process
+        self.topic_prefix = topic_prefix
+        # websocket ping interval, which also detects a dead connection
+        self.heartbeat = heartbeat
+        # sheds low priority frames while whatever handles events is backed up
+        self.shedder = shedder
 
         self.url = f"https://{host}:{port}"
 
-        self.services = tuple(SERVICES[k](self) for k in services)
-
-        self.session = aiohttp.ClientSession(
-            raise_for_status=True, headers={"User-Agent": USER_AGENT},
-            cookie_jar=aiohttp.CookieJar(unsafe=use_unsafe_cookie_jar)
+        self.state = state if state is not None else StateStore()
+        self.recorder = recorder
+
+        self.services = tuple(load_service(k)(self) for k in services)
+
+        # endpoint -> interval, for state which isn't on the event stream
+        self.poller = None
+        if poll:
+            network = [s for s in self.services if s.name == "network"]
+            if network:
+                self.poller = Poller(network[0], poll)
+            else:
+                logger.warning("poll.ignored: the network service isn't enabled")
+
+        # sites on the same host share a session (and its login)
+        self.owns_pool = pool is None
+        self.pool = pool if pool is not None else SessionPool()
+        self.auth = self.pool.get(
+            host,
+            port,
+            username,
+            password,
+            verify_ssl=verify_ssl,
+            use_unsafe_cookie_jar=use_unsafe_cookie_jar,
         )
 
-        self.is_closed = False
-        self.is_reconnecting = False
-        self.auto_reconnect_interval = 5
-        self.handlers = []
+        self.bus = HandlerBus()
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        return self.auth.session
 
-    async def connect(self, reconnect=False):
-        self.is_closed = False
-        self.is_reconnecting = False
-        await self.login(reconnect=reconnect)
+    async def connect(self):
+        await self.ensure_login()
         await self.listen()
 
+    async def ensure_login(self):
+        try:
+            # another site on this host may have logged in already
+            if not self.auth.generation:
+                await self.login()
+        except Exception:
+            # each service retries (and logs in again) on its own schedule
+            logger.exception("auth.error")
+
     async def close(self):
-        self.is_closed = True
-        self.ws.close()
+        await asyncio.gather(*(service.close() for service in self.services))
+        if self.poller is not None:
+            await self.poller.close()
+        await self.bus.close()
+        if self.owns_pool:
+            await self.pool.close()
 
-    async def login(self, reconnect=False):
-        # clear cookies otherwise unifi throws a 404 on next login
-        self.session.cookie_jar.clear()
-        await self.emit("controller", "login")
-        try:
-            await self.session.post(
-                f"{self.url}/api/auth/login",
-                data={
-                    "username": self.username,
-                    "password": self.password,
-                },
-                headers={
-                    "Referer": f"{self.url}/login",
-                },
-                verify_ssl=self.verify_ssl,
-            )
-            logger.info("auth.success")
-        except aiohttp.ClientError as exc:
-            logger.info("auth.failed")
-            if reconnect:
-                await self._reconnect()
-        except Exception as exc:
-            logger.exception(str(exc))
+    async def login(self):
+        return await self.auth.login()
 
-    def add_handler(self, callback):
-        self.handlers.append(callback)
+    def add_handler(self, callback: Handler, **options) -> Subscription:
+        """
+        Call ``callback(service, event, payload)`` for emitted events.
 
-    def remove_handler(self, callback):
-        self.handlers.remove(callback)
+        Options (see ``Subscription``) filter by ``services`` and ``events``,
+        and unless ``direct``, give the handler its own queue and workers.
+        """
+        return self.bus.subscribe(callback, **options)
+
+    def remove_handler(self, callback: Handler):
+        self.bus.unsubscribe(callback)
 
     async def emit(self, name: str, event: str, payload: dict = None):
-        logger.debug(f"controller.emit {name}.{event}")
-        for handler in self.handlers:
-            await handler(name, event, payload)
+        await self.bus.publish(name, event, payload)
 
     async def listen(self):
-        for service in self.services:
-            await service.close()
-
-        listeners = []
-        for service in self.services:
-            listeners.append([service, service.listen()])
-
-        results = await asyncio.gather(
-            *[x for _, x in listeners], return_exceptions=True
-        )
-        for service, result in results:
-            if isinstance(result, BaseException):
-                await self.on_websocket_error(service, result)
+        tasks = [service.run() for service in self.services]
+        if self.poller is not None:
+            tasks.append(self.poller.run())
+        await asyncio.gather(*tasks)
 
     async def on_websocket_open(self, service: UnifiService):
-        self.is_reconnecting = False
         await self.emit(service.name, "connected")
 
     async def on_websocket_close(self, service: UnifiService):
-        logger.debug(f"WebSocket close code {service.ws.close_code}")
+        logger.debug("WebSocket close code %s", service.ws.close_code)
         await self.emit(service.name, "disconnected")
-        await self._reconnect()
 
     async def on_websocket_error(self, service: UnifiService, exc: BaseException):
-        logger.exception(str(exc))
-        await self.emit(service.name, "error", exc)
-        await self._reconnect()
+        # logged and counted (frame errors, reconnects) but not emitted: there
+        # is nothing to publish for it
+        logger.error("%s: %s", service.name, exc, exc_info=exc)
 
-    async def _reconnect(self):
-        if self.is_reconnecting or self.is_closed:
-            return
+    def _url(self, path: str) -> str:
+        if path.startswith("/"):
+            return f"{self.url}{path}"
+        return f"{self.url}/api/s/{self.site}/{path}"
 
-        self.is_reconnecting = True
+    async def request(self, method: str, path: str, **kwargs):
+        """
+        Make a request against the controller, assuming the session is valid.
 
-        await asyncio.sleep(self.auto_reconnect_interval)
-        await self.emit("controller", "reconnect")
-        await self.connect(True)
+        If it's been rejected we log in again (once, shared with any other
+        rejected callers) and retry the request.
+        """
+        auth = self.auth
+        if auth.needs_refresh():
+            await auth.login()
 
-    async def _ensure_logged_in(self):
+        generation = auth.generation
         try:
-            await self.session.get(
-                f"{self.url}/api/users/self",
-                verify_ssl=self.verify_ssl,
+            return await self.session.request(
+                method, self._url(path), verify_ssl=self.verify_ssl, **kwargs
             )
-        except Exception as exc:
-            await self.login()
+        except aiohttp.ClientResponseError as exc:
+            if exc.status != 401:
+                raise
 
-    def _url(self, path: str) -> str:
-        if path.startswith("/"):
-            return f"{self.url}{path}"
-        return f"{self.url}/api/s/{self.site}/{path}"
+        await auth.reauth(generation)
+        return await self.session.request(
+            method, self._url(path), verify_ssl=self.verify_ssl, **kwargs
+        )
 
     async def get(self, path):
-        await self._ensure_logged_in()
-        return await self.session.get(
-            self._url(path),
-            verify_ssl=self.verify_ssl,
-        )
+        return await self.request("GET", path)
 
     async def delete(self, path):
-        await self._ensure_logged_in()
-        return await self.session.delete(self._url(path))
+        return await self.request("DELETE", path)
 
     async def post(self, path, data):
-        await self._ensure_logged_in()
-        return await self.session.post(
-            self._url(path),
-            data=data,
-            verify_ssl=self.verify_ssl,
-        )
+        return await self.request("POST", path, data=data)
 
     async def put(self, path, data):
-        await self._ensure_logged_in()
-        return await self.session.put(
-            self._url(path),
-            data=data,
-            verify_ssl=self.verify_ssl,
-        )
+        return await self.request("PUT", path, data=data)
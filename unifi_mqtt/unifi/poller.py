@@ -0,0 +1,184 @@
+"""
+Polls REST endpoints for state that isn't pushed over the websocket.
+
+Each response is reduced to a snapshot of the fields we publish for each
+entity, and only entities whose snapshot differs from the previous poll are
+emitted, so a quiet site produces no traffic however often it's polled.
+"""
+
+import asyncio
+import heapq
+import logging
+
+from time import monotonic
+from typing import Dict, NamedTuple, Optional, Tuple
+
+from .. import codec, metrics
+from .clients import client_values
+
+logger = logging.getLogger("unifi_mqtt.unifi.poller")
+
+
+class Endpoint(NamedTuple):
+    # the field identifying each entity in the response
+    key: str
+    # the fields published for each entity; anything else (byte counters,
+    # uptime) changes on every poll and is ignored
+    fields: Tuple[str, ...]
+    # the event emitted for changed entities
+    event: Optional[str]
+
+
+ENDPOINTS = {
+    "stat/device": Endpoint(
+        "mac",
+        (
+            "name",
+            "model",
+            "type",
+            "version",
+            "ip",
+            "state",
+            "adopted",
+            "upgradable",
+            "num_sta",
+            "user-num_sta",
+            "guest-num_sta",
+            "satisfaction",
+        ),
+        "device:state",
+    ),
+    "stat/health": Endpoint(
+        "subsystem",
+        (
+            "status",
+            "num_user",
+            "num_guest",
+            "num_iot",
+            "num_ap",
+            "num_sw",
+            "num_gw",
+            "num_adopted",
+            "num_disconnected",
+            "wan_ip",
+            "isp_name",
+        ),
+        "health:state",
+    ),
+    # clients are fed through the network service's client table instead
+    "stat/sta": Endpoint("mac", (), None),
+}
+
+
+class Poller:
+    def __init__(self, service, intervals: Dict[str, float]):
+        unknown = set(intervals) - set(ENDPOINTS)
+        if unknown:
+            raise ValueError(f"unknown poll endpoints: {', '.join(sorted(unknown))}")
+
+        # the network service we emit through
+        self.service = service
+        self.controller = service.controller
+        self.intervals = intervals
+
+        # endpoint -> {entity key: snapshot}
+        self.snapshots = {path: {} for path in intervals}
+        self.tasks = {}
+
+    async def run(self):
+        """
+        Poll each endpoint on its own interval from a single schedule.
+
+        A poll which is still running when it's next due is skipped rather
+        than stacked up behind a slow controller.
+        """
+        now = monotonic()
+        schedule = [(now, path) for path in self.intervals]
+        heapq.heapify(schedule)
+        try:
+            while True:
+                due, path = schedule[0]
+                delay = due - monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                heapq.heapreplace(
+                    schedule, (max(due + self.intervals[path], monotonic()), path)
+                )
+                task = self.tasks.get(path)
+                if task is None or task.done():
+                    self.tasks[path] = asyncio.ensure_future(self.poll(path))
+        finally:
+            await self.close()
+
+    async def close(self):
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.tasks.clear()
+
+    async def poll(self, path: str):
+        try:
+            response = await self.controller.get(path)
+            # decoded straight from the body bytes, without an interim str
+            entries = codec.loads(await response.read())["data"]
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            metrics.POLLS.labels(path, "error").inc()
+            logger.warning("poll.failed %s: %s", path, exc)
+            return
+        metrics.POLLS.labels(path, "ok").inc()
+
+        if path == "stat/sta":
+            await self.update_clients(entries)
+        else:
+            await self.update_snapshot(path, entries)
+
+    async def update_snapshot(self, path: str, entries: list):
+        endpoint = ENDPOINTS[path]
+        previous = self.snapshots[path]
+        current = {}
+        changed = metrics.POLL_CHANGES.labels(path)
+        for entry in entries:
+            key = entry.get(endpoint.key)
+            if key is None:
+                continue
+            snapshot = tuple(entry.get(field) for field in endpoint.fields)
+            current[key] = snapshot
+            if previous.get(key) != snapshot:
+                changed.inc()
+                await self.service.emit(
+                    endpoint.event,
+                    {
+                        "id": key,
+                        **{
+                            f: v
+                            for f, v in zip(endpoint.fields, snapshot)
+                            if v is not None
+                        },
+                    },
+                )
+        for key in previous.keys() - current.keys():
+            changed.inc()
+            await self.service.emit(endpoint.event, {"id": key, "removed": True})
+        self.snapshots[path] = current
+
+    async def update_clients(self, entries: list):
+        clients = self.service.clients
+        seen = set()
+        for entry in entries:
+            mac = entry.get("mac")
+            if mac is None:
+                continue
+            seen.add(mac)
+            await self.service.update_client(mac, client_values(entry))
+        # the table itself diffs, so only clients which changed are emitted
+        for mac in list(clients.index):
+            if mac in seen:
+                continue
+            if clients.get(mac).connected:
+                await self.service.update_client(mac, {"connected": False})
+            else:
+                # already gone as of the last sync, so there's nothing to keep
+                await self.service.remove_client(mac)
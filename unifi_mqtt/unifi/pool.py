@@ -0,0 +1,49 @@
+import aiohttp
+
+from .auth import AuthManager
+
+USER_AGENT = "unifi-mqtt/1.0"
+
+
+class SessionPool:
+    """
+    Shares one HTTP session, and so one login, between every controller
+    (site) on the same host.
+    """
+
+    def __init__(self):
+        # (host, port, username) -> the auth manager owning the session
+        self.sessions = {}
+
+    def get(
+        self,
+        host: str,
+        port: int,
+        username: str,
+        password: str,
+        verify_ssl: bool = True,
+        use_unsafe_cookie_jar: bool = False,
+    ) -> AuthManager:
+        key = (host, port, username)
+        if key not in self.sessions:
+
+            def create_session():
+                return aiohttp.ClientSession(
+                    raise_for_status=True,
+                    headers={"User-Agent": USER_AGENT},
+                    cookie_jar=aiohttp.CookieJar(unsafe=use_unsafe_cookie_jar),
+                )
+
+            self.sessions[key] = AuthManager(
+                create_session,
+                url=f"https://{host}:{port}",
+                username=username,
+                password=password,
+                verify_ssl=verify_ssl,
+            )
+        return self.sessions[key]
+
+    async def close(self):
+        for auth in self.sessions.values():
+            await auth.close()
+        self.sessions.clear()
@@ -0,0 +1,79 @@
+"""
+Decoder for the binary frames sent over the Protect ``ws/updates`` websocket.
+
+Each frame holds two packets, an action packet followed by a data packet, and
+each packet starts with an 8 byte header:
+
+    0: packet type (1 = action, 2 = data)
+    1: payload format (1 = JSON, 2 = UTF-8 string, 3 = raw buffer)
+    2: deflated (zlib) flag
+    3: unused
+    4: payload size (big endian uint32)
+
+Payloads are never copied out of the frame: they're handed around as
+``memoryview`` slices and only decoded when a caller asks for them.
+"""
+
+import struct
+import zlib
+
+from typing import Tuple, Union
+
+from .. import codec
+
+HEADER = struct.Struct("!BBBxI")
+
+PACKET_ACTION = 1
+PACKET_DATA = 2
+
+FORMAT_JSON = 1
+FORMAT_UTF8 = 2
+FORMAT_BUFFER = 3
+
+
+class FrameError(ValueError):
+    pass
+
+
+class Packet:
+    __slots__ = ("type", "format", "deflated", "payload")
+
+    def __init__(self, type: int, format: int, deflated: bool, payload: memoryview):
+        self.type = type
+        self.format = format
+        self.deflated = deflated
+        self.payload = payload
+
+    def decode(self) -> Union[dict, str, memoryview]:
+        payload = self.payload
+        if self.deflated:
+            payload = zlib.decompress(payload)
+        if self.format == FORMAT_JSON:
+            return codec.loads(payload)
+        if self.format == FORMAT_UTF8:
+            return str(payload, "utf-8")
+        if self.format == FORMAT_BUFFER:
+            return memoryview(payload)
+        raise FrameError(f"unknown payload format: {self.format}")
+
+
+def read_packet(view: memoryview, offset: int) -> Tuple[Packet, int]:
+    if len(view) - offset < HEADER.size:
+        raise FrameError("truncated packet header")
+    type, format, deflated, size = HEADER.unpack_from(view, offset)
+    start = offset + HEADER.size
+    end = start + size
+    if end > len(view):
+        raise FrameError("truncated packet payload")
+    return Packet(type, format, bool(deflated), view[start:end]), end
+
+
+def split_frame(data: bytes) -> Tuple[Packet, Packet]:
+    view = memoryview(data)
+    action, offset = read_packet(view, 0)
+    if action.type != PACKET_ACTION:
+        raise FrameError(f"expected action packet, got {action.type}")
+    payload, _ = read_packet(view, offset)
+    if payload.type != PACKET_DATA:
+        raise FrameError(f"expected data packet, got {payload.type}")
+    return action, payload
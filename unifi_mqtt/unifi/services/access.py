@@ -1,5 +1,4 @@
-import json
-
+from ... import codec
 from .base import UnifiService
 
 
@@ -17,6 +16,6 @@ class UnifiAccessService(UnifiService):
             return
 
         if msg["event"] in ("access.logs.add", "access.capture.add"):
-            msg["data"] = json.loads(msg["data"])
+            msg["data"] = codec.loads(msg["data"])
 
         await self.emit(msg["event"], msg)
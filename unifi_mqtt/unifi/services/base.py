@@ -1,13 +1,29 @@
-from enum import Enum
+import asyncio
 
 import aiohttp
 import logging
 
+from time import perf_counter
+from typing import Dict, FrozenSet, Optional
+
+from ... import codec, metrics
+from ...backoff import Backoff
+from ...pipeline import Priority
+from ...constants import UNIFI_DEFAULT_RECONNECT_INITIAL, UNIFI_DEFAULT_RECONNECT_MAX
+
 USER_AGENT = "unifi-mqtt/1.0"
 
 
+def is_auth_error(exc: BaseException) -> bool:
+    return isinstance(exc, aiohttp.ClientResponseError) and exc.status in (401, 403)
+
+
 class UnifiService:
     name = None
+    # messages thrown away unread, skipped before decoding where possible
+    ignored_messages: FrozenSet[str] = frozenset()
+    # message -> priority, for those which can be shed when backed up
+    priorities: Dict[str, Priority] = {}
 
     def __init__(
         self,
@@ -18,11 +34,19 @@ class UnifiService:
         self.ws = None
 
         self.is_closed = False
-        self.is_reconnecting = False
-        self.auto_reconnect_interval = 5
+        self.backoff = Backoff(
+            initial=UNIFI_DEFAULT_RECONNECT_INITIAL,
+            maximum=UNIFI_DEFAULT_RECONNECT_MAX,
+        )
 
         self.logger = logging.getLogger(f"unifi_mqtt.unifi.{self.name}")
 
+        self.frames = metrics.FRAMES.labels(self.name)
+        self.frame_errors = metrics.FRAME_ERRORS.labels(self.name)
+        self.decode_seconds = metrics.DECODE_SECONDS.labels(self.name)
+        self.reconnects = metrics.RECONNECTS.labels(self.name)
+        self.frames_skipped = metrics.FRAMES_SKIPPED.labels(self.name)
+
     def websocket_url(self) -> str:
         raise NotImplementedError
 
@@ -32,15 +56,49 @@ class UnifiService:
     async def on_binary_message(self, msg):
         raise NotImplementedError
 
-    async def connect(self, reconnect=False):
+    def peek_message(self, data: str) -> Optional[str]:
+        """
+        Return a text frame's message type if it can be read without decoding
+        the frame, otherwise None.
+        """
+        return None
+
+    async def run(self):
+        """
+        Keep this service's websocket connected until it's closed.
+
+        Each service supervises its own connection, so one failing stream
+        backs off and recovers without interrupting any of the others.
+        """
         self.is_closed = False
-        self.is_reconnecting = False
-        await self.login(reconnect=reconnect)
-        await self.listen()
+        while not self.is_closed:
+            needs_login = False
+            generation = self.controller.auth.generation
+            try:
+                await self.listen()
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                needs_login = is_auth_error(exc)
+                await self._on_error(exc)
+
+            if self.is_closed:
+                break
+
+            delay = self.backoff.next()
+            self.logger.info("reconnect in %.1fs", delay)
+            self.reconnects.inc()
+            await asyncio.sleep(delay)
+
+            if needs_login:
+                # the session cookie is otherwise reused across reconnects
+                try:
+                    await self.controller.auth.reauth(generation)
+                except Exception:
+                    self.logger.exception("auth.error")
 
     async def close(self):
         self.is_closed = True
-        self.is_reconnected = False
         if self.ws:
             await self.ws.close()
 
@@ -48,33 +106,52 @@ class UnifiService:
         return await self.controller.emit(self.name, event, payload)
 
     async def listen(self):
+        self.ws = await self.controller.session.ws_connect(
+            url=self.websocket_url(),
+            heartbeat=self.controller.heartbeat,
+            verify_ssl=self.controller.verify_ssl,
+            compress=False,
+        )
+
+        self.backoff.reset()
+        await self._on_open()
         try:
-            self.ws = await self.controller.session.ws_connect(
-                url=self.websocket_url(),
-                heartbeat=15,
-                verify_ssl=self.controller.verify_ssl,
-                compress=False,
-            )
-        except aiohttp.ClientError as exc:
-            await self.emit(self.name, "error", exc)
-            return
+            await self._read_loop()
+        finally:
+            await self.ws.close()
 
-        await self._on_open()
+    async def _read_loop(self):
         while True:
             msg = await self.ws.receive()
-            if msg.type == aiohttp.WSMsgType.TEXT:
-                await self._on_message(msg.json())
-            elif msg.type == aiohttp.WSMsgType.BINARY:
-                await self._on_binary_message(msg)
-            elif msg.type == aiohttp.WSMsgType.CLOSED:
+            if msg.type in (aiohttp.WSMsgType.TEXT, aiohttp.WSMsgType.BINARY):
+                await self.handle_frame(msg.type, msg.data)
+            elif msg.type in (
+                aiohttp.WSMsgType.CLOSE,
+                aiohttp.WSMsgType.CLOSING,
+                aiohttp.WSMsgType.CLOSED,
+            ):
                 await self._on_close()
                 break
             elif msg.type == aiohttp.WSMsgType.ERROR:
                 await self._on_error(self.ws.exception())
                 break
 
+    async def handle_frame(self, msg_type: aiohttp.WSMsgType, data):
+        """
+        Handle a single text or binary websocket frame.
+
+        This is the entry point for both live and replayed frames.
+        """
+        self.frames.inc()
+        recorder = self.controller.recorder
+        if recorder is not None:
+            recorder.record(self.name, msg_type, data)
+        if msg_type == aiohttp.WSMsgType.TEXT:
+            await self._on_message(data)
+        else:
+            await self._on_binary_message(data)
+
     async def _on_open(self):
-        self.is_reconnecting = False
         return await self.controller.on_websocket_open(self)
 
     async def _on_close(self):
@@ -83,14 +160,37 @@ class UnifiService:
     async def _on_error(self, exc):
         return await self.controller.on_websocket_error(self, exc)
 
-    async def _on_binary_message(self, msg):
+    async def _on_binary_message(self, data: bytes):
+        # binary frames are decoded lazily by the service as it handles them,
+        # so it times (into decode_seconds) just its decoding
         try:
-            await self.on_binary_message(msg)
+            await self.on_binary_message(data)
         except Exception as exc:
+            self.frame_errors.inc()
             await self._on_error(exc)
 
-    async def _on_message(self, msg):
+    def should_skip(self, data: str) -> bool:
+        message = self.peek_message(data)
+        if message is None:
+            return False
+        if message in self.ignored_messages:
+            self.frames_skipped.inc()
+            return True
+        shedder = self.controller.shedder
+        priority = self.priorities.get(message)
+        if shedder is not None and priority is not None and shedder.sheds(priority):
+            metrics.FRAMES_SHED.labels(self.name, message).inc()
+            return True
+        return False
+
+    async def _on_message(self, data: str):
+        if self.should_skip(data):
+            return
         try:
+            started = perf_counter()
+            msg = codec.loads(data)
+            self.decode_seconds.observe(perf_counter() - started)
             await self.on_message(msg)
         except Exception as exc:
+            self.frame_errors.inc()
             await self._on_error(exc)
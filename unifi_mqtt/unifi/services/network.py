@@ -1,14 +1,43 @@
+import re
+
+from time import monotonic
+from typing import Optional
+
 from .base import UnifiService
+from ...constants import CLIENTS_EXPIRE_INTERVAL
+from ..clients import ClientTable, client_values
+from ...pipeline import Priority
+
+IGNORE_EVENTS = frozenset(["device:sync", "device:update"])
 
-IGNORE_EVENTS = frozenset(["sta:sync", "device:sync", "device:update"])
+CONNECTED_EVENTS = frozenset(["EVT_WU_Connected", "EVT_LU_Connected"])
+DISCONNECTED_EVENTS = frozenset(["EVT_WU_Disconnected", "EVT_LU_Disconnected"])
+
+# frames lead with a small, flat "meta" object naming the message, so it can be
+# read without decoding the (often large) data which follows
+MESSAGE_RE = re.compile(r'\s*\{\s*"meta"\s*:\s*\{[^{}]*?"message"\s*:\s*"([^"\\]*)"')
 
 
 class UnifiNetworkService(UnifiService):
     name = "network"
+    ignored_messages = IGNORE_EVENTS
+    # each sync repeats the client's full state, so a shed one is caught up
+    # by the next
+    priorities = {"sta:sync": Priority.LOW}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.clients = ClientTable()
+        self.next_expiry = monotonic() + CLIENTS_EXPIRE_INTERVAL
 
     def websocket_url(self):
         return f"wss://{self.controller.host}/proxy/network/wss/s/{self.controller.site}/events"
 
+    def peek_message(self, data: str) -> Optional[str]:
+        match = MESSAGE_RE.match(data)
+        return match.group(1) if match else None
+
     async def on_message(self, msg):
         meta = msg["meta"]
         for entry in msg["data"]:
@@ -17,6 +46,32 @@ class UnifiNetworkService(UnifiService):
     async def handle_event(self, event_type: str, data):
         if event_type in IGNORE_EVENTS:
             return
-        if event_type == "events":
+        if event_type == "sta:sync":
+            await self.update_client(data["mac"], client_values(data))
+        elif event_type == "events":
             key = data["key"]
             await self.emit(key, data)
+            if key in CONNECTED_EVENTS:
+                await self.update_client(data["user"], {"connected": True})
+            elif key in DISCONNECTED_EVENTS:
+                await self.update_client(data["user"], {"connected": False})
+
+    async def update_client(self, mac: str, values: dict):
+        now = monotonic()
+        if now >= self.next_expiry:
+            self.next_expiry = now + CLIENTS_EXPIRE_INTERVAL
+            for expired in self.clients.expire(now):
+                await self.emit_removal(expired)
+        changes = self.clients.update(mac, values)
+        if changes:
+            await self.emit(
+                "client:update",
+                {"client": self.clients.get(mac).as_dict(), "changes": changes},
+            )
+
+    async def remove_client(self, mac: str):
+        self.clients.remove(mac)
+        await self.emit_removal(mac)
+
+    async def emit_removal(self, mac: str):
+        await self.emit("client:remove", {"client": {"mac": mac}})
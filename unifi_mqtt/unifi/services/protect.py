@@ -1,4 +1,20 @@
+from collections import OrderedDict
+from time import perf_counter
+from typing import Optional, Tuple
+
 from .base import UnifiService
+from ..protect_frames import split_frame
+
+# map of Protect event types to the typed events we emit
+EVENT_TYPES = {
+    "motion": "motion",
+    "ring": "ring",
+    "smartDetectZone": "smart_detect",
+    "smartDetectLine": "smart_detect",
+}
+
+# number of in-progress events we remember so updates can be attributed
+MAX_OPEN_EVENTS = 1024
 
 
 class UnifiProtectService(UnifiService):
@@ -7,13 +23,67 @@ class UnifiProtectService(UnifiService):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-        self.last_update_id = "51b1b10b-6d9f-4817-ab2c-811db24f6bf0"
+        self.state_key = f"{self.controller.host}/protect/last_update_id"
+        self.last_update_id = self.controller.state.get(self.state_key)
+        self.open_events = OrderedDict()
 
     def websocket_url(self):
         if self.last_update_id:
             return f"wss://{self.controller.host}/proxy/protect/ws/updates?lastUpdateId={self.last_update_id}"
         return f"wss://{self.controller.host}/proxy/protect/ws/updates"
 
-    async def on_binary_message(self, msg):
-        # TODO: need to identify format
-        pass
+    async def on_binary_message(self, data):
+        # timed apart from emitting, which may wait on a full queue
+        started = perf_counter()
+        event = self.decode(data)
+        self.decode_seconds.observe(perf_counter() - started)
+        if event is not None:
+            await self.emit(*event)
+
+    def decode(self, data: bytes) -> Optional[Tuple[str, dict]]:
+        """
+        Decode a frame, returning the (event, payload) to emit, if any.
+        """
+        action_packet, data_packet = split_frame(data)
+        action = action_packet.decode()
+
+        update_id = action.get("newUpdateId")
+        if update_id:
+            # the stream resumes *after* this id on reconnect, so anything
+            # we've already seen is never redelivered
+            self.last_update_id = update_id
+            self.controller.state.set(self.state_key, update_id)
+
+        # the vast majority of frames are camera/device state updates; only
+        # pay to decode the data packet for the event model
+        if action.get("modelKey") != "event":
+            return None
+
+        if action["action"] == "add":
+            data = data_packet.decode()
+            event_type = EVENT_TYPES.get(data.get("type"))
+            if event_type is None:
+                return None
+            self._track_event(action["id"], event_type, data)
+        elif action["action"] == "update":
+            info = self.open_events.get(action["id"])
+            if info is None:
+                return None
+            event_type, camera = info
+            data = data_packet.decode()
+            data.setdefault("camera", camera)
+            if data.get("end"):
+                self.open_events.pop(action["id"], None)
+        else:
+            return None
+
+        data["id"] = action["id"]
+        data["action"] = action["action"]
+        return event_type, data
+
+    def _track_event(self, event_id: str, event_type: str, data: dict):
+        if data.get("end"):
+            return
+        self.open_events[event_id] = (event_type, data.get("camera"))
+        if len(self.open_events) > MAX_OPEN_EVENTS:
+            self.open_events.popitem(last=False)